@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+
+# Runs the in-process benchmarks of every service and collects their results
+# in one JSON file. With --baseline, every compared latency (*_ms) or
+# throughput (*_per_second) metric that got worse by more than --tolerance
+# fails the run. Tail latencies of short runs are noisy, so only medians
+# and throughput are compared unless --compare says otherwise
+#
+#   python bench_suite.py --output baseline.json
+#   python bench_suite.py --baseline baseline.json
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+COMPARED_METRICS = ["p50_ms", "ops_per_second"]
+
+BENCHMARKS = {
+    "fms": ("fleet_management_service", "bench_api.py", ["--requests", "100"]),
+    "serialization": ("fleet_management_service", "bench_serialization.py", ["--repeats", "500"]),
+    "vms": ("vehicle_monitoring_system", "bench_ingestion.py", ["--messages", "500", "--sample-counts", "10", "100", "1000", "--trips", "50"]),
+    "archive": ("vehicle_monitoring_system", "bench_archive.py", ["--trips", "200"]),
+    "dispatch": ("fleet_management_service", "bench_dispatch.py", ["--trips", "2000", "--vehicles", "2000", "--end-to-end-trips", "200"])
+}
+
+
+def run_benchmark(name, quick):
+    directory, script, quick_arguments = BENCHMARKS[name]
+    completed = subprocess.run(
+        [sys.executable, script, *(quick_arguments if quick else [])],
+        cwd=os.path.join(ROOT, directory),
+        capture_output=True,
+        text=True
+    )
+    if completed.returncode != 0:
+        sys.stderr.write(completed.stderr)
+        raise RuntimeError(f"{name} benchmark failed with exit code {completed.returncode}")
+    return json.loads(completed.stdout)
+
+
+def flatten(results):
+    # {"fms": {"create_driver": {"p50_ms": 1}}} -> {"fms.create_driver.p50_ms": 1}
+    metrics = {}
+    for service, cases in results.items():
+        for case, values in cases.items():
+            for metric, value in values.items():
+                metrics[f"{service}.{case}.{metric}"] = value
+    return metrics
+
+
+def best_of(runs):
+    # Lowest latency and highest throughput of every metric over all runs
+    metrics = {}
+    for run in runs:
+        for name, value in run.items():
+            if name not in metrics:
+                metrics[name] = value
+            elif name.endswith("_ms"):
+                metrics[name] = min(metrics[name], value)
+            elif name.endswith("_per_second"):
+                metrics[name] = max(metrics[name], value)
+    return metrics
+
+
+def regressions(metrics, baseline, tolerance, compared):
+    found = []
+    for name, value in metrics.items():
+        previous = baseline.get(name)
+        if name.rsplit(".", 1)[-1] not in compared:
+            continue
+        if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or previous <= 0:
+            continue
+
+        if name.endswith("_ms") and value > previous * (1 + tolerance):
+            found.append((name, previous, value))
+        elif name.endswith("_per_second") and value < previous * (1 - tolerance):
+            found.append((name, previous, value))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run all benchmarks and compare them with a baseline")
+    parser.add_argument("--benchmarks", nargs="+", choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="Smaller workloads")
+    parser.add_argument("--output", help="Write results as JSON, usable as a baseline later")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown")
+    parser.add_argument("--compare", nargs="+", default=COMPARED_METRICS, help="Metrics compared with the baseline")
+    parser.add_argument("--runs", type=int, default=1, help="Runs of every benchmark, the best result counts")
+    arguments = parser.parse_args(argv)
+
+    metrics = best_of([
+        flatten({name: run_benchmark(name, arguments.quick) for name in arguments.benchmarks})
+        for _ in range(arguments.runs)
+    ])
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "quick": arguments.quick,
+        "runs": arguments.runs,
+        "metrics": metrics
+    }
+
+    if arguments.output:
+        with open(arguments.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    failed = False
+    errors = {name: value for name, value in metrics.items() if name.endswith(".errors") and value}
+    for name, value in errors.items():
+        print(f"ERROR {name}: {value} failed requests")
+        failed = True
+
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline:
+            baseline_metrics = json.load(baseline)["metrics"]
+
+        found = regressions(metrics, baseline_metrics, arguments.tolerance, arguments.compare)
+        for name, previous, value in found:
+            print(f"REGRESSION {name}: {previous} -> {value} ({(value - previous) / previous:+.0%})")
+        failed = failed or bool(found)
+
+        compared = sum(1 for name in metrics if name in baseline_metrics and name.rsplit(".", 1)[-1] in arguments.compare)
+        print(f"{compared} metrics compared with {arguments.baseline}, {len(found)} regressions")
+    else:
+        print(json.dumps(metrics, indent=2, sort_keys=True))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+# Latency and throughput of the FMS API, in process against an in-memory
+# Mongo, with published trip dispatches captured instead of sent.
+# Prints one JSON object, bench_suite.py in the repository root
+# compares it with a baseline
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summary(latencies, elapsed, errors=0):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "ops_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3)
+    }
+
+
+async def measure(client, requests, concurrency):
+    # requests are (method, url, json body) tuples, sent by concurrency
+    # clients at once. Returns summary and responses in request order
+    latencies, responses, errors = [None] * len(requests), [None] * len(requests), 0
+    pending = iter(range(len(requests)))
+
+    async def send():
+        nonlocal errors
+        for index in pending:
+            method, url, body = requests[index]
+            started = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            latencies[index] = time.perf_counter() - started
+            responses[index] = response
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(concurrency)))
+    return summary(latencies, time.perf_counter() - started, errors), responses
+
+
+async def run(arguments):
+    try:
+        import httpx
+        from mongomock_motor import AsyncMongoMockClient, AsyncMongoMockCollection
+    except ImportError:
+        sys.exit("API benchmark needs httpx and mongomock-motor, pip install httpx mongomock-motor")
+
+    # with_options of mongomock-motor returns a synchronous collection,
+    # write concerns mean nothing to it anyway
+    AsyncMongoMockCollection.with_options = lambda collection, **options: collection
+
+    import cache
+    import consumers
+    import dispatch
+    import rollups
+    from main import app
+    from pika_client import pika_client
+    from routers import drivers, stats, trips, vehicles
+
+    fake_db = AsyncMongoMockClient().fleet_management_service
+    for module in (cache, consumers, dispatch, rollups, drivers, stats, trips, vehicles):
+        module.db = fake_db
+
+    dispatched = []
+
+    async def send_messages(messages):
+        dispatched.extend(messages)
+
+    pika_client.send_messages = send_messages
+
+    count, concurrency = arguments.requests, arguments.concurrency
+    results = {}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        results["create_driver"], responses = await measure(client, [
+            ("POST", "/api/drivers/", {"full_name": f"Driver {index}", "points": 0}) for index in range(count)
+        ], concurrency)
+        driver_ids = [response.json()["_id"] for response in responses]
+
+        results["show_driver"], _ = await measure(client, [
+            ("GET", f"/api/drivers/{driver_ids[index % len(driver_ids)]}", None) for index in range(count)
+        ], concurrency)
+
+        results["update_driver"], _ = await measure(client, [
+            ("PUT", f"/api/drivers/{driver_id}", {"full_name": f"Driver {driver_id}"}) for driver_id in driver_ids
+        ], concurrency)
+
+        results["list_drivers"], _ = await measure(client, [
+            ("GET", f"/api/drivers/?limit={arguments.page_size}", None) for _ in range(max(count // 10, 1))
+        ], concurrency)
+
+        results["create_vehicle"], responses = await measure(client, [
+            ("POST", "/api/vehicles/", {"type": "Truck", "registration": f"BENCH-{index}"}) for index in range(count)
+        ], concurrency)
+        vehicle_ids = [response.json()["_id"] for response in responses]
+
+        results["assign_driver"], _ = await measure(client, [
+            ("PUT", f"/api/vehicles/{vehicle_id}/assign_driver/{driver_id}", None)
+            for vehicle_id, driver_id in zip(vehicle_ids, driver_ids)
+        ], concurrency)
+
+        geo_point = {"lat": 43.85, "long": 18.38}
+        results["create_trip"], responses = await measure(client, [
+            ("POST", "/api/trips/", {"depature_geo_point": geo_point, "destination_geo_point": geo_point}) for _ in range(count)
+        ], concurrency)
+        trip_ids = [response.json()["_id"] for response in responses]
+
+        results["assign_vehicle"], _ = await measure(client, [
+            ("PUT", f"/api/trips/{trip_id}/assign_vehicle/{vehicle_id}", None)
+            for trip_id, vehicle_id in zip(trip_ids, vehicle_ids)
+        ], concurrency)
+
+        bulk_size = arguments.bulk_size
+        batches = max(count // bulk_size, 1)
+        results["bulk_create_drivers"], _ = await measure(client, [
+            ("POST", "/api/drivers/bulk", [{"full_name": f"Bulk {batch} {index}", "points": 0} for index in range(bulk_size)])
+            for batch in range(batches)
+        ], 1)
+        # Drivers inserted per second, not requests
+        results["bulk_create_drivers"]["ops_per_second"] = round(
+            results["bulk_create_drivers"]["ops_per_second"] * bulk_size, 1
+        )
+
+        # Points messages as the consumer gets them, all of them in flight at once
+        latencies = []
+
+        async def apply_points(trip_id, driver_id, vehicle_id):
+            started = time.perf_counter()
+            await consumers.consume_point_messages({
+                "trip_id": trip_id,
+                "driver_id": driver_id,
+                "vehicle_id": vehicle_id,
+                "points": 1,
+                "kilometres": {"0-60": 1.5, "60-80": 1.2, "80-100": 0.0, "100+": 0.0},
+                "finished_at": time.time()
+            })
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            apply_points(trip_id, driver_id, vehicle_id)
+            for trip_id, driver_id, vehicle_id in zip(trip_ids, driver_ids, vehicle_ids)
+        ))
+        results["points_to_driver"] = summary(latencies, time.perf_counter() - started)
+
+        results["driver_leaderboard"], _ = await measure(client, [
+            ("GET", f"/api/stats/drivers/leaderboard?limit={arguments.leaderboard_size}", None) for _ in range(max(count // 10, 1))
+        ], concurrency)
+
+        results["delete_driver"], _ = await measure(client, [
+            ("DELETE", f"/api/drivers/{driver_id}", None) for driver_id in driver_ids
+        ], concurrency)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FMS API routes in process")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--bulk-size", type=int, default=100)
+    parser.add_argument("--leaderboard-size", type=int, default=10)
+    arguments = parser.parse_args(argv)
+
+    print(json.dumps(asyncio.run(run(arguments)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
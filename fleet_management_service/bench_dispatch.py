@@ -0,0 +1,192 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from dispatch import chord_to_km, match, to_unit_vectors
+
+# Matching of pending trips to available vehicles, greedy over the whole
+# batch and optimal over a small one, then a whole dispatch in process
+# against an in-memory Mongo with published messages captured.
+# Prints one JSON object, bench_suite.py in the repository root
+# compares it with a baseline
+
+CENTER_LAT, CENTER_LONG = 43.85, 18.38
+
+
+def generate_points(rng, number, spread_degrees):
+    lats = CENTER_LAT + rng.normal(0, spread_degrees, number)
+    longs = CENTER_LONG + rng.normal(0, spread_degrees, number)
+    return [{"lat": float(lat), "long": float(long)} for lat, long in zip(lats, longs)]
+
+
+def measure_match(trips, vehicles, mode):
+    started = time.perf_counter()
+    _, matches = match(trips, vehicles, mode)
+    seconds = time.perf_counter() - started
+    return matches, {
+        "trips": len(trips),
+        "vehicles": len(vehicles),
+        "assigned": len(matches),
+        "seconds": round(seconds, 3),
+        "ops_per_second": round(len(trips) / seconds, 1),
+        "mean_km": round(sum(distance_km for _, _, distance_km in matches) / max(len(matches), 1), 3)
+    }
+
+
+def closest_pairs_first(trips, vehicles):
+    # Every pair sorted by distance, the reference greedy matches
+    trip_points = to_unit_vectors([trip["lat"] for trip in trips], [trip["long"] for trip in trips])
+    vehicle_points = to_unit_vectors([vehicle["lat"] for vehicle in vehicles], [vehicle["long"] for vehicle in vehicles])
+    chords = np.linalg.norm(trip_points[:, None, :] - vehicle_points[None, :, :], axis=2)
+
+    matched_trips, matched_vehicles, total = set(), set(), 0.0
+    for flat in np.argsort(chords, axis=None, kind="stable"):
+        trip, vehicle = divmod(int(flat), len(vehicles))
+        if trip not in matched_trips and vehicle not in matched_vehicles:
+            matched_trips.add(trip)
+            matched_vehicles.add(vehicle)
+            total += float(chord_to_km(chords[trip, vehicle]))
+    return total
+
+
+async def dispatch_in_process(rng, number_of_trips, number_of_vehicles, spread_degrees):
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("End to end dispatch needs mongomock-motor, pip install mongomock-motor or pass --end-to-end-trips 0")
+
+    import cache
+    import dispatch
+    from pika_client import pika_client
+    from positions import vehicle_positions
+    from mongo_documents import MongoDocumentsEnum
+
+    fake_db = AsyncMongoMockClient().fleet_management_service
+    for module in (cache, dispatch):
+        module.db = fake_db
+
+    dispatched = []
+
+    async def send_messages(messages):
+        dispatched.extend(messages)
+
+    pika_client.send_messages = send_messages
+
+    # A tenth of the vehicles is on a trip already, a tenth has no driver
+    vehicles = generate_points(rng, number_of_vehicles, spread_degrees)
+    vehicle_documents, busy = [], []
+    for index, vehicle in enumerate(vehicles):
+        document = {"_id": f"vehicle-{index}"}
+        if index % 10 != 1:
+            document["driver_id"] = f"driver-{index}"
+        if index % 10 == 2:
+            busy.append(document["_id"])
+        vehicle_documents.append(document)
+        vehicle_positions.update({"vehicle_id": document["_id"], "timestamp": 0, **vehicle})
+
+    trip_documents = [
+        {
+            "_id": f"trip-{index}",
+            "depature_geo_point": trip,
+            "destination_geo_point": {"lat": CENTER_LAT, "long": CENTER_LONG},
+            "trip_completed": False
+        }
+        for index, trip in enumerate(generate_points(rng, number_of_trips, spread_degrees))
+    ]
+    trip_documents.extend(
+        {
+            "_id": f"busy-trip-{index}",
+            "depature_geo_point": {"lat": CENTER_LAT, "long": CENTER_LONG},
+            "destination_geo_point": {"lat": CENTER_LAT, "long": CENTER_LONG},
+            "vehicle_id": vehicle_id
+        }
+        for index, vehicle_id in enumerate(busy)
+    )
+    await fake_db[MongoDocumentsEnum.VEHICLES.value].insert_many(vehicle_documents)
+    await fake_db[MongoDocumentsEnum.TRIPS.value].insert_many(trip_documents)
+
+    started = time.perf_counter()
+    result = await dispatch.dispatch()
+    seconds = time.perf_counter() - started
+
+    assigned = {
+        trip["_id"]: trip["vehicle_id"]
+        async for trip in fake_db[MongoDocumentsEnum.TRIPS.value].find({"dispatch_id": {"$exists": True}})
+    }
+    vehicle_ids = [assignment["vehicle_id"] for assignment in result["assignments"]]
+    errors = sum([
+        len(set(vehicle_ids)) != len(vehicle_ids),
+        bool(set(vehicle_ids) & set(busy)),
+        assigned != {assignment["trip_id"]: assignment["vehicle_id"] for assignment in result["assignments"]},
+        {message["trip_id"] for message in dispatched} != set(assigned)
+    ])
+
+    return {
+        "trips": number_of_trips,
+        "vehicles": number_of_vehicles,
+        "available_vehicles": result["available_vehicles"],
+        "assigned": len(result["assignments"]),
+        "dispatched": len(dispatched),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "ops_per_second": round(number_of_trips / seconds, 1)
+    }
+
+
+def run(arguments):
+    rng = np.random.default_rng(arguments.seed)
+    results = {}
+
+    # Trips and vehicles spread over the same city, and trips from
+    # downtown with vehicles all over it, every vehicle is wanted there
+    vehicles = generate_points(rng, arguments.vehicles, arguments.spread_degrees)
+    for layout, trip_spread in (("city", arguments.spread_degrees), ("downtown", arguments.spread_degrees / 10)):
+        trips = generate_points(rng, arguments.trips, trip_spread)
+        _, results[f"greedy_{layout}"] = measure_match(trips, vehicles, "greedy")
+
+    # Small batch with few vehicles to spare, where greedy falls behind most
+    trips = generate_points(rng, arguments.optimal_trips, arguments.spread_degrees)
+    spare_vehicles = vehicles[:arguments.optimal_trips * 3 // 2]
+    optimal_matches, results["optimal"] = measure_match(trips, spare_vehicles, "optimal")
+    greedy_matches, _ = measure_match(trips, spare_vehicles, "greedy")
+    optimal_km = sum(distance_km for _, _, distance_km in optimal_matches)
+    greedy_km = sum(distance_km for _, _, distance_km in greedy_matches)
+    results["optimal"]["greedy_excess_percent"] = round((greedy_km / optimal_km - 1) * 100, 2) if optimal_km else 0.0
+
+    # Greedy has to match the same pairs as sorting all of them
+    trips = generate_points(rng, arguments.reference_size, arguments.spread_degrees)
+    reference_vehicles = generate_points(rng, arguments.reference_size, arguments.spread_degrees)
+    greedy_matches, _ = measure_match(trips, reference_vehicles, "greedy")
+    greedy_km = sum(distance_km for _, _, distance_km in greedy_matches)
+    results["reference"] = {
+        "trips": arguments.reference_size,
+        "greedy_km": round(greedy_km, 3),
+        "closest_pairs_first_km": round(closest_pairs_first(trips, reference_vehicles), 3)
+    }
+
+    if arguments.end_to_end_trips:
+        results["end_to_end"] = asyncio.run(dispatch_in_process(
+            rng, arguments.end_to_end_trips, arguments.end_to_end_trips, arguments.spread_degrees
+        ))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark trip dispatch")
+    parser.add_argument("--trips", type=int, default=10000)
+    parser.add_argument("--vehicles", type=int, default=10000)
+    parser.add_argument("--optimal-trips", type=int, default=200)
+    parser.add_argument("--reference-size", type=int, default=500)
+    parser.add_argument("--end-to-end-trips", type=int, default=1000, help="0 skips the in-process dispatch")
+    parser.add_argument("--spread-degrees", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args(argv)
+
+    print(json.dumps(run(arguments), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import time
+import random
+import asyncio
+import argparse
+from live import LivePositions, Subscriber
+
+# Fan-out of positions to many subscribers on one process.
+# Every subscriber drains its buffer in its own task like a connection would,
+# slow ones only drain every --slow-delay-ms
+
+
+async def drain(subscriber, delay):
+    while True:
+        await subscriber.next_batch()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def random_subscriber(vehicles, buffer_size):
+    kind = random.random()
+    if kind < 0.45:
+        return Subscriber(vehicle_ids=[str(random.randrange(vehicles)) for _ in range(5)], buffer_size=buffer_size)
+    if kind < 0.95:
+        lat, long = random.uniform(42, 46), random.uniform(16, 20)
+        return Subscriber(bounding_box=(lat, long, lat + 0.5, long + 0.5), buffer_size=buffer_size)
+    return Subscriber(buffer_size=buffer_size)
+
+
+async def run(arguments):
+    random.seed(arguments.seed)
+    hub = LivePositions(max_subscribers=arguments.subscribers)
+    subscribers = [random_subscriber(arguments.vehicles, arguments.buffer_size) for _ in range(arguments.subscribers)]
+
+    drains = []
+    for index, subscriber in enumerate(subscribers):
+        hub.subscribe(subscriber)
+        slow = index < arguments.subscribers * arguments.slow_fraction
+        drains.append(asyncio.create_task(drain(subscriber, arguments.slow_delay_ms / 1000 if slow else 0)))
+
+    positions = [
+        {
+            "vehicle_id": str(random.randrange(arguments.vehicles)),
+            "trip_id": None,
+            "lat": random.uniform(42, 46),
+            "long": random.uniform(16, 20),
+            "speed": 60,
+            "timestamp": index
+        }
+        for index in range(arguments.messages)
+    ]
+
+    started = time.perf_counter()
+    for index, position in enumerate(positions):
+        hub.publish(position)
+        # Lets subscribers drain the way the consumer yields between messages
+        if index % arguments.yield_every == 0:
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+
+    for task in drains:
+        task.cancel()
+
+    stats = hub.stats()
+    print(f"subscribers:          {arguments.subscribers}")
+    print(f"messages:             {arguments.messages}")
+    print(f"publish:              {arguments.messages / elapsed:,.0f} msgs/s")
+    print(f"delivered:            {stats['delivered']} ({stats['delivered'] / elapsed:,.0f}/s)")
+    print(f"coalesced:            {stats['coalesced']}")
+    print(f"dropped:              {stats['dropped']}")
+    print(f"still buffered:       {stats['buffered']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark live position fan-out")
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--vehicles", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--buffer-size", type=int, default=1000)
+    parser.add_argument("--slow-fraction", type=float, default=0.1)
+    parser.add_argument("--slow-delay-ms", type=float, default=500)
+    parser.add_argument("--yield-every", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import time
+import random
+import argparse
+import tracemalloc
+from positions import GeoGrid, distance
+
+# Radius and bounding box queries over the in-memory grid,
+# results are checked against a scan of all vehicles
+
+
+def generate_positions(vehicles, center_lat, center_long, spread_degrees):
+    return [
+        {
+            "vehicle_id": str(vehicle),
+            "lat": center_lat + random.uniform(-spread_degrees, spread_degrees),
+            "long": center_long + random.uniform(-spread_degrees, spread_degrees),
+            "speed": random.uniform(0, 120),
+            "timestamp": time.time(),
+            "trip_id": None
+        }
+        for vehicle in range(vehicles)
+    ]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vehicle position queries")
+    parser.add_argument("--vehicles", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--radius-km", type=float, default=5)
+    parser.add_argument("--spread-degrees", type=float, default=2)
+    parser.add_argument("--cell-size-degrees", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    random.seed(arguments.seed)
+    center_lat, center_long = 43.85, 18.38
+    positions = generate_positions(arguments.vehicles, center_lat, center_long, arguments.spread_degrees)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    grid = GeoGrid(arguments.cell_size_degrees)
+    for position in positions:
+        grid.update(position)
+    load_seconds = time.perf_counter() - started
+    grid_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    points = [
+        (center_lat + random.uniform(-arguments.spread_degrees, arguments.spread_degrees),
+         center_long + random.uniform(-arguments.spread_degrees, arguments.spread_degrees))
+        for _ in range(arguments.queries)
+    ]
+
+    latencies, found = [], 0
+    for lat, long in points:
+        started = time.perf_counter()
+        found += len(grid.nearby(lat, long, arguments.radius_km))
+        latencies.append(time.perf_counter() - started)
+
+    box_latencies = []
+    box_delta = arguments.radius_km / 111.195
+    for lat, long in points:
+        started = time.perf_counter()
+        grid.within(lat - box_delta, long - box_delta, lat + box_delta, long + box_delta)
+        box_latencies.append(time.perf_counter() - started)
+
+    # Scanning all vehicles is the reference, checked on a few queries
+    mismatches, scan_seconds = 0, 0
+    for lat, long in points[:20]:
+        started = time.perf_counter()
+        expected = {
+            position["vehicle_id"] for position in positions
+            if distance(lat, long, position["lat"], position["long"]) <= arguments.radius_km
+        }
+        scan_seconds += time.perf_counter() - started
+        if expected != {position["vehicle_id"] for position in grid.nearby(lat, long, arguments.radius_km)}:
+            mismatches += 1
+
+    print(f"vehicles:             {arguments.vehicles}")
+    print(f"cells:                {len(grid.cells)}")
+    print(f"load:                 {load_seconds:.2f} s")
+    print(f"grid memory:          {grid_bytes / 2 ** 20:.1f} MiB")
+    print(f"nearby avg found:     {found / len(points):.1f}")
+    print(f"nearby avg:           {sum(latencies) / len(latencies) * 1000:.3f} ms")
+    print(f"nearby p99:           {percentile(latencies, 0.99) * 1000:.3f} ms")
+    print(f"within avg:           {sum(box_latencies) / len(box_latencies) * 1000:.3f} ms")
+    print(f"scan avg:             {scan_seconds / 20 * 1000:.3f} ms")
+    print(f"mismatches:           {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import List
+from bson import ObjectId
+
+# CPU spent serializing responses and messages, before and after the codec.
+# Responses compare what FastAPI did for every read route (validating with
+# the response model, jsonable_encoder and json.dumps) with the orjson
+# response, validated and with the read path bypass. Messages compare
+# json.dumps/json.loads with the JSON and msgpack formats of the codec.
+# Prints one JSON object, bench_suite.py in the repository root
+# compares it with a baseline
+
+
+def measure(function, repeats, size=None):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    elapsed = time.perf_counter() - started
+    result = {"us_per_op": round(elapsed / repeats * 1e6, 3), "ops_per_second": round(repeats / elapsed, 1)}
+    if size is not None:
+        result["bytes"] = size
+    return result
+
+
+def drivers(count, rng):
+    return [
+        {
+            "_id": str(ObjectId()),
+            "full_name": f"Driver {index}",
+            "points": rng.randint(0, 10000),
+            # Left on drivers by older consumers, not part of the model
+            "applied_trip_ids": [str(ObjectId()) for _ in range(20)]
+        }
+        for index in range(count)
+    ]
+
+
+def vehicles(count, rng):
+    return [
+        {"_id": str(ObjectId()), "type": "Truck", "registration": f"BENCH-{index}", "driver": driver}
+        for index, driver in enumerate(drivers(count, rng))
+    ]
+
+
+def trips(count, rng):
+    def geo_point():
+        return {"lat": rng.uniform(-90, 90), "long": rng.uniform(-180, 180)}
+
+    return [
+        {
+            "_id": str(ObjectId()),
+            "depature_geo_point": geo_point(),
+            "destination_geo_point": geo_point(),
+            "vehicle": vehicle,
+            "trip_completed": False
+        }
+        for vehicle in vehicles(count, rng)
+    ]
+
+
+def gps_data(rng):
+    return {
+        "current_geo_point": {"lat": rng.uniform(-90, 90), "long": rng.uniform(-180, 180)},
+        "speed": rng.randint(0, 150),
+        "driver_id": str(ObjectId()),
+        "trip_id": str(ObjectId()),
+        "vehicle_id": str(ObjectId()),
+        "timestamp": int(time.time())
+    }
+
+
+def trip_dispatch(rng):
+    return {
+        "trip_id": str(ObjectId()),
+        "driver_id": str(ObjectId()),
+        "vehicle_id": str(ObjectId()),
+        "depature_geo_point": {"lat": rng.uniform(-90, 90), "long": rng.uniform(-180, 180)},
+        "destination_geo_point": {"lat": rng.uniform(-90, 90), "long": rng.uniform(-180, 180)}
+    }
+
+
+def response_cases(name, model, content, repeats, loop):
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_cloned_field, create_response_field
+    from responses import FastJSONResponse, documents_response, trim
+
+    many = isinstance(content, list)
+    field = create_cloned_field(create_response_field(name=f"Response_{name}", type_=List[model] if many else model))
+
+    def validated():
+        # What FastAPI does with a document returned from a route
+        return loop.run_until_complete(serialize_response(field=field, response_content=content, is_coroutine=True))
+
+    def bypass():
+        if many:
+            return documents_response(content, model).body
+        return FastJSONResponse(content=trim(content, model)).body
+
+    # Same output, or the bypass isn't a bypass
+    if json.loads(bypass()) != json.loads(JSONResponse(content=validated()).body):
+        raise RuntimeError(f"{name} differs with the read path bypass")
+
+    return {
+        f"{name}.json_validated": measure(lambda: JSONResponse(content=validated()).body, repeats),
+        f"{name}.orjson_validated": measure(lambda: FastJSONResponse(content=validated()).body, repeats),
+        f"{name}.orjson_bypass": measure(bypass, repeats, len(bypass()))
+    }
+
+
+def message_cases(name, body, repeats):
+    from codec import decode_message, encode_message
+
+    encoded_json = json.dumps(body).encode()
+    results = {
+        f"{name}.stdlib_json": measure(lambda: json.loads(json.dumps(body).encode()), repeats, len(encoded_json))
+    }
+    for message_format in ("json", "msgpack"):
+        encoded = encode_message(body, message_format)
+        if decode_message(**encoded) != json.loads(encoded_json):
+            raise RuntimeError(f"{name} changes through {message_format}")
+        results[f"{name}.codec_{message_format}"] = measure(
+            lambda: decode_message(**encode_message(body, message_format)), repeats, len(encoded["body"])
+        )
+    return results
+
+
+def run(arguments):
+    from models import DriverModel, TripModel, VehicleModel
+
+    rng = random.Random(arguments.seed)
+    loop = asyncio.new_event_loop()
+    results = {}
+
+    try:
+        for name, model, content in (
+            ("show_driver", DriverModel, drivers(1, rng)[0]),
+            ("show_trip", TripModel, trips(1, rng)[0]),
+            ("list_drivers", DriverModel, drivers(arguments.page_size, rng)),
+            ("list_vehicles", VehicleModel, vehicles(arguments.page_size, rng)),
+            ("list_trips", TripModel, trips(arguments.page_size, rng))
+        ):
+            repeats = arguments.repeats if not isinstance(content, list) else max(arguments.repeats // 20, 1)
+            results.update(response_cases(name, model, content, repeats, loop))
+    finally:
+        loop.close()
+
+    for name, body in (("gps_data", gps_data(rng)), ("trip_dispatch", trip_dispatch(rng))):
+        results.update(message_cases(name, body, arguments.repeats * 10))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark response and message serialization")
+    parser.add_argument("--repeats", type=int, default=2000, help="Single document responses, lists get a twentieth")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args(argv)
+
+    print(json.dumps(run(arguments), indent=2))
+
+
+if __name__ == "__main__":
+    main()
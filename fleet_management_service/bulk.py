@@ -0,0 +1,43 @@
+from fastapi import status
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def item_result(index, id=None, status_code=status.HTTP_200_OK, detail=None):
+    return {"index": index, "id": id, "status": status_code, "detail": detail}
+
+
+async def find_ids(collection, query, field="_id"):
+    return {document[field] async for document in collection.find(query, {field: 1})}
+
+
+async def insert_items(collection, model, items):
+    # Every item is validated on its own, so one invalid item
+    # fails only its own result and the rest are inserted at once
+    results = [None] * len(items)
+    documents, indexes = [], []
+
+    for index, item in enumerate(items):
+        try:
+            document = jsonable_encoder(model.parse_obj(item))
+        except ValidationError as error:
+            results[index] = item_result(index, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(error))
+            continue
+
+        documents.append(document)
+        indexes.append(index)
+        results[index] = item_result(index, document["_id"], status.HTTP_201_CREATED)
+
+    if documents:
+        try:
+            await collection.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details["writeErrors"]:
+                index = indexes[write_error["index"]]
+                status_code = status.HTTP_409_CONFLICT if write_error["code"] == DUPLICATE_KEY_ERROR else status.HTTP_400_BAD_REQUEST
+                results[index] = item_result(index, documents[write_error["index"]]["_id"], status_code, write_error["errmsg"])
+
+    return results
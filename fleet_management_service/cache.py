@@ -0,0 +1,156 @@
+import os
+import copy
+import time
+import bson
+from collections import OrderedDict
+from dependencies import db
+
+CACHE_MAX_SIZE = int(os.environ.get("CACHE_MAX_SIZE", 10000))
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 30))
+
+# local keeps documents in every FMS process, redis shares them
+# between all of them through the server at CACHE_REDIS_URL
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local").lower()
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+# How long an invalidated key can't be cached again, longer than
+# it takes any process to load a document it missed
+CACHE_TOMBSTONE_SECONDS = float(os.environ.get("CACHE_TOMBSTONE_SECONDS", 5))
+
+if CACHE_BACKEND not in ("local", "redis"):
+    raise ValueError(f"Unknown CACHE_BACKEND {CACHE_BACKEND}, expected local or redis")
+
+
+class LocalCacheBackend:
+    # In-process LRU cache with expiring entries.
+    # Any object with the same async get/set/delete/size methods
+    # and counters can replace it, like RedisCacheBackend
+    def __init__(self, max_size=CACHE_MAX_SIZE, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key):
+        self.entries.pop(key, None)
+
+    async def size(self):
+        return len(self.entries)
+
+
+class RedisCacheBackend:
+    # Cache shared by all FMS processes, documents are stored BSON encoded
+    # and expire in Redis. A process can't see what another one is loading,
+    # so delete leaves an empty tombstone that set doesn't overwrite, a
+    # document read before a write in another process isn't cached after it.
+    # Redis evicts by its own maxmemory policy, max_size is only reported
+    def __init__(self, client, ttl_seconds=CACHE_TTL_SECONDS, tombstone_seconds=CACHE_TOMBSTONE_SECONDS, prefix="fms:"):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.tombstone_seconds = tombstone_seconds
+        self.prefix = prefix
+        self.max_size = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_url(cls, url=CACHE_REDIS_URL, **kwargs):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise ImportError("CACHE_BACKEND is redis, pip install redis")
+        return cls(redis.asyncio.from_url(url), **kwargs)
+
+    async def get(self, key):
+        value = await self.client.get(self.prefix + key)
+        if not value:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return bson.decode(value)
+
+    async def set(self, key, value):
+        await self.client.set(self.prefix + key, bson.encode(value), px=int(self.ttl_seconds * 1000), nx=True)
+
+    async def delete(self, key):
+        await self.client.set(self.prefix + key, b"", px=int(self.tombstone_seconds * 1000))
+
+    async def size(self):
+        return await self.client.dbsize()
+
+
+class DocumentCache:
+    # Read-through cache of documents by _id. Every write to a cached
+    # collection has to invalidate the written ids
+    def __init__(self, backend):
+        self.backend = backend
+        self.loading = {}
+
+    @staticmethod
+    def key(document, id):
+        return f"{document.value}:{id}"
+
+    async def get(self, document, id):
+        key = self.key(document, id)
+
+        if (cached := await self.backend.get(key)) is not None:
+            return copy.deepcopy(cached)
+
+        # An invalidation while the document is loaded drops the token,
+        # so a document read before a write never gets cached after it
+        token = object()
+        self.loading[key] = token
+        try:
+            loaded = await db[document.value].find_one({"_id": id})
+            if loaded is not None and self.loading.get(key) is token:
+                await self.backend.set(key, copy.deepcopy(loaded))
+        finally:
+            if self.loading.get(key) is token:
+                del self.loading[key]
+
+        return loaded
+
+    async def invalidate(self, document, *ids):
+        for id in ids:
+            key = self.key(document, id)
+            self.loading.pop(key, None)
+            await self.backend.delete(key)
+
+    async def stats(self):
+        return {
+            "size": await self.backend.size(),
+            "max_size": self.backend.max_size,
+            "hits": self.backend.hits,
+            "misses": self.backend.misses,
+            "evictions": self.backend.evictions
+        }
+
+
+cache = DocumentCache(RedisCacheBackend.from_url() if CACHE_BACKEND == "redis" else LocalCacheBackend())
@@ -1,16 +1,129 @@
+import os
+import asyncio
+import logging
+from pymongo import UpdateOne
+from pymongo.write_concern import WriteConcern
 from dependencies import db
 from mongo_documents import MongoDocumentsEnum
+from cache import cache
+from rollups import credits_of, find_unapplied_results, insert_trip_results, mark_applied, store_corrections, update_rollups
 
+logger = logging.getLogger(__name__)
 
-async def consume_point_messages(message):
-    driver = await db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": message["driver_id"]})
+# Points messages are collected until POINTS_BATCH_SIZE messages arrived
+# or POINTS_BATCH_TIMEOUT_MS passed, then applied with one bulk write
+# per collection
+POINTS_BATCH_SIZE = int(os.environ.get("POINTS_BATCH_SIZE", 100))
+POINTS_BATCH_TIMEOUT_MS = int(os.environ.get("POINTS_BATCH_TIMEOUT_MS", 50))
+
+
+def driver_updates(results):
+    # Credits of trip results not added to their drivers yet. The driver
+    # records the id of every credit it got until the result is marked
+    # applied, a credit added before a failure isn't added again
+    return [
+        UpdateOne(
+            {"_id": result["driver_id"], "applied_credits": {"$ne": credit["_id"]}},
+            {"$inc": {"points": credit["points"]}, "$push": {"applied_credits": credit["_id"]}}
+        )
+        for result in results if result["driver_id"] is not None
+        for credit in credits_of(result)
+    ]
+
+
+def forget_credits(results):
+    credits = {}
+    for result in results:
+        if result["driver_id"] is not None:
+            credits.setdefault(result["driver_id"], []).extend(credit["_id"] for credit in credits_of(result))
+    return [
+        UpdateOne({"_id": driver_id}, {"$pull": {"applied_credits": {"$in": credit_ids}}})
+        for driver_id, credit_ids in credits.items() if credit_ids
+    ]
+
+
+def trip_updates(messages):
+    return [UpdateOne({"_id": message["trip_id"]}, {"$set": {"trip_completed": True}}) for message in messages]
+
+
+class PointsBatcher:
+    def __init__(self, batch_size=POINTS_BATCH_SIZE, batch_timeout_ms=POINTS_BATCH_TIMEOUT_MS):
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout_ms / 1000
+
+        self.buffer = []
+        self.timer = None
+        self.lock = asyncio.Lock()
 
-    driver["points"] += message["points"]
+    async def add(self, message):
+        # Returns once the points of message are stored,
+        # raises if they couldn't be, so the caller can ack afterwards
+        stored = asyncio.get_running_loop().create_future()
+        self.buffer.append((message, stored))
 
-    await db[MongoDocumentsEnum.DRIVERS.value].update_one({"_id": message["driver_id"]}, {"$set": driver})
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self.flush_after_timeout())
 
-    trip = await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": message["trip_id"]})
+        await stored
 
-    trip["trip_completed"] = True
+    async def flush_after_timeout(self):
+        await asyncio.sleep(self.batch_timeout)
+        self.timer = None
+        await self.flush()
 
-    await db[MongoDocumentsEnum.TRIPS.value].update_one({"_id": message["trip_id"]}, {"$set": trip})
+    async def flush(self):
+        async with self.lock:
+            if self.timer is not None and self.timer is not asyncio.current_task():
+                self.timer.cancel()
+                self.timer = None
+
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+
+            messages = [message for message, _ in batch]
+
+            try:
+                # Results left unapplied by a failed attempt are applied
+                # with the new ones once their message is redelivered.
+                # Corrections of rescored trips carry previous_points
+                finished = [message for message in messages if "previous_points" not in message]
+                corrections = [message for message in messages if "previous_points" in message]
+                if finished:
+                    await insert_trip_results(finished)
+                if corrections:
+                    await store_corrections(corrections)
+                results = await find_unapplied_results({message["trip_id"] for message in messages})
+
+                for document, updates in ((MongoDocumentsEnum.DRIVERS, driver_updates(results)), (MongoDocumentsEnum.TRIPS, trip_updates(finished))):
+                    if updates:
+                        collection = db[document.value].with_options(write_concern=WriteConcern(j=True))
+                        await collection.bulk_write(updates, ordered=False)
+                # Marked before the rollups are updated, a failure to update
+                # them leaves the trips out until rollups are rebuilt
+                await mark_applied(results)
+                if forgotten := forget_credits(results):
+                    await db[MongoDocumentsEnum.DRIVERS.value].bulk_write(forgotten, ordered=False)
+                await update_rollups(results)
+            except Exception as error:
+                logger.exception("Failed to store %d points messages", len(batch))
+                for _, stored in batch:
+                    if not stored.done():
+                        stored.set_exception(error)
+                return
+            finally:
+                await cache.invalidate(MongoDocumentsEnum.DRIVERS, *{message["driver_id"] for message in messages})
+                await cache.invalidate(MongoDocumentsEnum.TRIPS, *{message["trip_id"] for message in messages})
+
+            for _, stored in batch:
+                if not stored.done():
+                    stored.set_result(None)
+
+
+points_batcher = PointsBatcher()
+
+
+async def consume_point_messages(message):
+    await points_batcher.add(message)
@@ -1,10 +1,18 @@
 import os
 import motor.motor_asyncio
+from metrics import MongoCommandListener
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # db
-client = motor.motor_asyncio.AsyncIOMotorClient(os.environ.get("MONGODB_URL"))
+client = motor.motor_asyncio.AsyncIOMotorClient(os.environ.get("MONGODB_URL"), event_listeners=[MongoCommandListener()])
 db = client.fleet_management_service
+
+# Database of the vehicle monitoring system. The FMS reads its
+# vehicle_positions (positions.py) and trip_scores (rollups.py backfill)
+# collections directly, so their documents are shared by both services:
+# a change to their fields in the VMS has to be made here as well
+vms_client = motor.motor_asyncio.AsyncIOMotorClient(os.environ.get("VMS_MONGODB_URL"), event_listeners=[MongoCommandListener()])
+vms_db = vms_client.vehicle_monitoring_system
@@ -0,0 +1,426 @@
+import os
+import math
+import asyncio
+import logging
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+from positions import EARTH_RADIUS_KM, vehicle_positions
+from pika_client import pika_client
+from cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Chooses vehicles for pending trips, nearest departure first.
+#
+# A trip is pending while it has no vehicle and isn't completed, a vehicle
+# is available when it has a driver, no trip that isn't completed and a
+# known position (see positions.py).
+#
+# greedy matches the closest trip and vehicle pair first, then the closest
+# of the rest and so on, looking up nearest points in grids of both.
+# optimal finds the smallest total distance (Hungarian algorithm) and is
+# used by auto for batches of up to DISPATCH_OPTIMAL_MAX_TRIPS trips
+DISPATCH_MAX_TRIPS = int(os.environ.get("DISPATCH_MAX_TRIPS", 10000))
+DISPATCH_OPTIMAL_MAX_TRIPS = int(os.environ.get("DISPATCH_OPTIMAL_MAX_TRIPS", 200))
+
+MODES = ("auto", "greedy", "optimal")
+# Points per grid cell an index is sized for
+POINTS_PER_CELL = 4
+# About 60 metres, cell coordinates fit in CELL_KEY_BITS
+MIN_CELL_SIZE = 1e-5
+CELL_KEY_BITS = 18
+
+# One dispatch at a time per process, so two of them don't choose the same vehicle
+dispatch_lock = asyncio.Lock()
+
+
+def to_unit_vectors(lats, longs):
+    # Points on the unit sphere, the straight (chord) distance between two
+    # of them orders pairs the same way as the great circle distance
+    lats, longs = np.radians(np.asarray(lats, dtype=np.float64)), np.radians(np.asarray(longs, dtype=np.float64))
+    return np.column_stack((np.cos(lats) * np.cos(longs), np.cos(lats) * np.sin(longs), np.sin(lats)))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord) / 2, 1))
+
+
+def km_to_chord(km):
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+def cell_key(x, y, z):
+    # One integer per cell, coordinates are within +-1 / MIN_CELL_SIZE
+    offset = 1 << (CELL_KEY_BITS - 1)
+    return (((x + offset) << CELL_KEY_BITS) + (y + offset) << CELL_KEY_BITS) + (z + offset)
+
+
+# Key offsets of a cell and the 26 around it
+CUBE_OFFSETS = [
+    cell_key(x, y, z) - cell_key(0, 0, 0) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)
+]
+
+
+def norms(vectors):
+    return np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+
+
+class GridIndex:
+    # Grid of cubic cells over some of the unit vectors, sized so a cell
+    # holds a few points of the area they are spread over. Points are
+    # kept sorted by cell, a cell is a range of them
+    def __init__(self, points, indexes):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        selected = points[indexes]
+        extents = np.sort(np.ptp(selected, axis=0)) if len(selected) else np.zeros(3)
+        area = max(extents[1] * extents[2], MIN_CELL_SIZE ** 2)
+        self.cell_size = max(math.sqrt(area * POINTS_PER_CELL / max(len(selected), 1)), MIN_CELL_SIZE)
+
+        coordinates = np.floor(selected / self.cell_size).astype(np.int64)
+        keys = cell_key(*coordinates.T)
+        order = np.argsort(keys, kind="stable")
+        self.indexes, self.selected, keys = indexes[order], selected[order], keys[order]
+        unique_keys, self.starts, cells = np.unique(keys, return_index=True, return_inverse=True)
+        self.cells = dict(zip(unique_keys.tolist(), range(len(unique_keys))))
+        self.lengths = np.diff(np.append(self.starts, len(keys)))
+        self.corners = coordinates[order][self.starts] * self.cell_size
+
+        # Free points left in every cell
+        self.free = self.lengths.copy()
+        self.cell_of = np.full(len(points), -1, dtype=np.int64)
+        self.cell_of[self.indexes] = cells
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def take(self, index):
+        self.free[self.cell_of[index]] -= 1
+
+    def chords(self, cells, point, free):
+        # Positions of the free points of cells and their chords
+        lengths = self.lengths[cells]
+        positions = np.repeat(self.starts[cells] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        positions = positions[free[self.indexes[positions]]]
+        return positions, norms(self.selected[positions] - point)
+
+    def nearest(self, point, k, free, max_chord=math.inf):
+        # Up to k (chord, index) of free points within max_chord, nearest first
+        positions, chords = self.nearest_around(point, k, free)
+        if positions is None:
+            positions, chords = self.nearest_anywhere(point, k, free, max_chord)
+
+        within = chords <= max_chord
+        indexes, chords = self.indexes[positions[within]], chords[within]
+        if k == 1:
+            if not len(chords):
+                return []
+            nearest = int(np.argmin(chords))
+            return [(float(chords[nearest]), int(indexes[nearest]))]
+        order = np.argsort(chords, kind="stable")[:k]
+        return list(zip(chords[order].tolist(), indexes[order].tolist()))
+
+    def nearest_around(self, point, k, free):
+        # Points in the cell of point and the 26 around it, when k of them
+        # are closer than a cell, anything further out is too
+        origin = cell_key(*(math.floor(coordinate / self.cell_size) for coordinate in point.tolist()))
+        cells = [cell for cell in map(self.cells.get, (origin + offset for offset in CUBE_OFFSETS)) if cell is not None]
+        if not cells:
+            return None, None
+        positions, chords = self.chords(np.array(cells, dtype=np.int64), point, free)
+        if len(chords) < k or np.partition(chords, k - 1)[k - 1] > self.cell_size:
+            return None, None
+        return positions, chords
+
+    def nearest_anywhere(self, point, k, free, max_chord):
+        # A cell can't be closer than its closest corner, and k free points
+        # are within the furthest corners of the nearest cells that hold k,
+        # only cells closer than that are looked at
+        lows = self.corners - point
+        highs = lows + self.cell_size
+        closest = norms(np.maximum(lows, 0) + np.maximum(-highs, 0))
+        furthest = norms(np.maximum(np.abs(lows), np.abs(highs)))
+        furthest[self.free == 0] = np.inf
+
+        if k == 1:
+            reach = furthest.min()
+        else:
+            order = np.argsort(furthest)
+            enough = np.searchsorted(np.cumsum(self.free[order]), k)
+            reach = furthest[order[enough]] if enough < len(order) else np.inf
+
+        cells = np.flatnonzero((closest <= min(reach, max_chord)) & (self.free > 0))
+        return self.chords(cells, point, free)
+
+
+class FreePoints:
+    # Points of one side that can still be matched, in a grid that is
+    # rebuilt once half of the points in it are taken
+    def __init__(self, points):
+        self.points = points
+        self.free = np.ones(len(points), dtype=bool)
+        self.number_free = len(points)
+        self.index = GridIndex(points, np.arange(len(points)))
+
+    def take(self, index):
+        self.free[index] = False
+        self.number_free -= 1
+        self.index.take(index)
+        if self.number_free and self.number_free * 2 < len(self.index):
+            self.index = GridIndex(self.points, np.flatnonzero(self.free))
+
+    def nearest(self, point, max_chord):
+        nearest = self.index.nearest(point, 1, self.free, max_chord)
+        return nearest[0] if nearest else (None, None)
+
+
+def greedy_matching(trip_points, vehicle_points, max_chord=math.inf):
+    # Returns (trip index, vehicle index) pairs, the same ones as matching
+    # the closest free pair over and over. A chain goes from a trip to its
+    # nearest vehicle, to that vehicle's nearest trip and so on, every
+    # step is shorter than the one before, until two points are each
+    # other's nearest, they are matched and the chain goes on from the rest
+    sides = (FreePoints(trip_points), FreePoints(vehicle_points))
+    matched = []
+
+    for start in range(len(trip_points)):
+        if not sides[0].free[start]:
+            continue
+        chain = [(0, start, math.inf)]
+        while chain and sides[0].number_free and sides[1].number_free:
+            side, point, _ = chain[-1]
+            other = 1 - side
+            chord, nearest = sides[other].nearest(sides[side].points[point], max_chord)
+            if len(chain) > 1 and (nearest is None or chain[-2][2] <= chord):
+                # Nothing closer than the point it came from, ties included
+                nearest = chain[-2][1]
+            elif nearest is None:
+                # Nothing within reach, and it only gets further
+                sides[side].take(point)
+                chain.pop()
+                continue
+            else:
+                chain[-1] = (side, point, chord)
+                chain.append((other, nearest, math.inf))
+                continue
+
+            chain.pop()
+            chain.pop()
+            sides[side].take(point)
+            sides[other].take(nearest)
+            matched.append((point, nearest) if side == 0 else (nearest, point))
+
+    return sorted(matched)
+
+
+def hungarian(cost):
+    # Row and column of every row of a cost matrix with at most as many
+    # rows as columns, shortest augmenting paths with potentials, O(n^2 m)
+    rows, columns = cost.shape
+    u, v = np.zeros(rows + 1), np.zeros(columns + 1)
+    # Row matched to every column, both counted from 1, 0 is none
+    matched = np.zeros(columns + 1, dtype=np.int64)
+    way = np.zeros(columns + 1, dtype=np.int64)
+
+    for row in range(1, rows + 1):
+        matched[0] = row
+        column = 0
+        shortest = np.full(columns + 1, np.inf)
+        used = np.zeros(columns + 1, dtype=bool)
+        while matched[column] != 0:
+            used[column] = True
+            current_row = matched[column]
+            reduced = cost[current_row - 1] - u[current_row] - v[1:]
+            unused = ~used[1:]
+            shorter = unused & (reduced < shortest[1:])
+            shortest[1:][shorter] = reduced[shorter]
+            way[1:][shorter] = column
+
+            candidates = np.where(unused, shortest[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+            u[matched[used]] += delta
+            v[used] -= delta
+            shortest[1:][unused] -= delta
+            column = next_column
+
+        while column != 0:
+            previous = way[column]
+            matched[column] = matched[previous]
+            column = previous
+
+    return [(matched[column] - 1, column - 1) for column in range(1, columns + 1) if matched[column] != 0]
+
+
+def optimal_matching(trip_points, vehicle_points, max_chord=math.inf):
+    # A trip is never matched to a vehicle further than its n nearest,
+    # with n trips one of those is left for it, so only they are costed
+    number_of_trips = len(trip_points)
+    if not number_of_trips or not len(vehicle_points):
+        return []
+
+    free = np.ones(len(vehicle_points), dtype=bool)
+    index = GridIndex(vehicle_points, np.arange(len(vehicle_points)))
+    vehicles = sorted({
+        vehicle
+        for point in trip_points
+        for _, vehicle in index.nearest(point, min(number_of_trips, len(vehicle_points)), free, max_chord)
+    })
+    if not vehicles:
+        return []
+
+    # |p - q|^2 = 2 - 2 p.q for unit vectors
+    chords = np.sqrt(np.maximum(2 - 2 * trip_points @ vehicle_points[vehicles].T, 0))
+    # Pairs out of reach cost more than any matching of pairs within it,
+    # so as many trips as possible get a vehicle
+    reachable = chords <= max_chord
+    cost = np.where(reachable, chords, 2 * number_of_trips + 1)
+
+    if number_of_trips <= len(vehicles):
+        pairs = hungarian(cost)
+    else:
+        pairs = [(trip, vehicle) for vehicle, trip in hungarian(cost.T)]
+
+    return sorted((trip, vehicles[vehicle]) for trip, vehicle in pairs if reachable[trip, vehicle])
+
+
+def match(trips, vehicles, mode="auto", max_distance_km=None):
+    # trips and vehicles are dicts with lat and long, returns the mode used
+    # and (trip, vehicle, distance_km) of every match
+    if mode == "auto":
+        mode = "optimal" if len(trips) <= DISPATCH_OPTIMAL_MAX_TRIPS else "greedy"
+    if not trips or not vehicles:
+        return mode, []
+
+    trip_points = to_unit_vectors([trip["lat"] for trip in trips], [trip["long"] for trip in trips])
+    vehicle_points = to_unit_vectors([vehicle["lat"] for vehicle in vehicles], [vehicle["long"] for vehicle in vehicles])
+    max_chord = math.inf if max_distance_km is None else km_to_chord(max_distance_km)
+
+    if mode == "optimal":
+        pairs = optimal_matching(trip_points, vehicle_points, max_chord)
+    else:
+        pairs = greedy_matching(trip_points, vehicle_points, max_chord)
+
+    if not pairs:
+        return mode, []
+    trip_indexes, vehicle_indexes = map(np.array, zip(*pairs))
+    distances = chord_to_km(np.linalg.norm(trip_points[trip_indexes] - vehicle_points[vehicle_indexes], axis=1))
+    return mode, [
+        (trips[trip], vehicles[vehicle], distance_km)
+        for trip, vehicle, distance_km in zip(trip_indexes.tolist(), vehicle_indexes.tolist(), distances.tolist())
+    ]
+
+
+async def find_pending_trips(trip_ids=None, limit=DISPATCH_MAX_TRIPS):
+    query = {"vehicle_id": None, "trip_completed": {"$ne": True}}
+    if trip_ids is not None:
+        query["_id"] = {"$in": list(trip_ids)}
+
+    return [
+        {**trip, "lat": trip["depature_geo_point"]["lat"], "long": trip["depature_geo_point"]["long"]}
+        async for trip in db[MongoDocumentsEnum.TRIPS.value].find(
+            query, {"depature_geo_point": 1, "destination_geo_point": 1}
+        ).limit(limit)
+    ]
+
+
+async def find_available_vehicles(positions=vehicle_positions):
+    busy = set(await db[MongoDocumentsEnum.TRIPS.value].distinct(
+        "vehicle_id", {"vehicle_id": {"$ne": None}, "trip_completed": {"$ne": True}}
+    ))
+
+    vehicles = []
+    async for vehicle in db[MongoDocumentsEnum.VEHICLES.value].find({"driver_id": {"$exists": True}}, {"driver_id": 1}):
+        if vehicle["_id"] in busy or vehicle["driver_id"] is None:
+            continue
+        if (position := positions.get(vehicle["_id"])) is not None:
+            vehicles.append({**vehicle, "lat": position["lat"], "long": position["long"]})
+    return vehicles
+
+
+def to_dispatch(trip, vehicle):
+    return {
+        "vehicle_id": vehicle["_id"],
+        "trip_id": trip["_id"],
+        "driver_id": vehicle["driver_id"],
+        "depature_geo_point": trip["depature_geo_point"],
+        "destination_geo_point": trip["destination_geo_point"]
+    }
+
+
+async def apply_assignments(matches):
+    # All trips are updated in one bulk write, each only while it is still
+    # pending, and tagged with the id of this dispatch. Dispatch messages
+    # go out for the trips that were tagged. When they can't be sent,
+    # the trips are pending again. Returns the trip ids that were assigned
+    if not matches:
+        return set()
+    trips = db[MongoDocumentsEnum.TRIPS.value]
+    dispatch_id = str(ObjectId())
+
+    await trips.bulk_write([
+        UpdateOne(
+            {"_id": trip["_id"], "vehicle_id": None, "trip_completed": {"$ne": True}},
+            {"$set": {"vehicle_id": vehicle["_id"], "dispatch_id": dispatch_id}}
+        )
+        for trip, vehicle, _ in matches
+    ], ordered=False)
+    assigned = {trip["_id"] async for trip in trips.find({"dispatch_id": dispatch_id}, {"_id": 1})}
+
+    # A vehicle may have been given another trip since it was found
+    # available, e.g. through the trips API. Checked after the write,
+    # so of two assignments racing for it at least one sees the other.
+    # Trips of those vehicles are pending again
+    vehicle_ids = {trip["_id"]: vehicle["_id"] for trip, vehicle, _ in matches if trip["_id"] in assigned}
+    taken = set(await trips.distinct("vehicle_id", {
+        "vehicle_id": {"$in": list(set(vehicle_ids.values()))},
+        "dispatch_id": {"$ne": dispatch_id},
+        "trip_completed": {"$ne": True}
+    }))
+    released = {trip_id for trip_id, vehicle_id in vehicle_ids.items() if vehicle_id in taken}
+    if released:
+        logger.warning("Dispatch %s lost %d vehicles to other trips, unassigning their trips", dispatch_id, len(released))
+        await trips.update_many(
+            {"_id": {"$in": list(released)}, "dispatch_id": dispatch_id},
+            {"$unset": {"vehicle_id": "", "dispatch_id": ""}}
+        )
+        assigned -= released
+    await cache.invalidate(MongoDocumentsEnum.TRIPS, *assigned, *released)
+
+    try:
+        await pika_client.send_messages([to_dispatch(trip, vehicle) for trip, vehicle, _ in matches if trip["_id"] in assigned])
+    except Exception:
+        logger.exception("Failed to send dispatch %s, unassigning its %d trips", dispatch_id, len(assigned))
+        await trips.update_many({"dispatch_id": dispatch_id}, {"$unset": {"vehicle_id": "", "dispatch_id": ""}})
+        await cache.invalidate(MongoDocumentsEnum.TRIPS, *assigned)
+        raise
+
+    return assigned
+
+
+async def dispatch(trip_ids=None, limit=DISPATCH_MAX_TRIPS, mode="auto", max_distance_km=None, dry_run=False):
+    async with dispatch_lock:
+        trips = await find_pending_trips(trip_ids, limit)
+        vehicles = await find_available_vehicles()
+        # A batch of thousands takes seconds, requests are served meanwhile
+        mode, matches = await asyncio.get_running_loop().run_in_executor(
+            None, match, trips, vehicles, mode, max_distance_km
+        )
+        assigned = {trip["_id"] for trip, _, _ in matches} if dry_run else await apply_assignments(matches)
+
+    assignments = [
+        {"trip_id": trip["_id"], "vehicle_id": vehicle["_id"], "driver_id": vehicle["driver_id"], "distance_km": distance_km}
+        for trip, vehicle, distance_km in matches if trip["_id"] in assigned
+    ]
+    logger.info("Dispatched %d of %d trips to %d available vehicles (%s)", len(assignments), len(trips), len(vehicles), mode)
+    return {
+        "mode": mode,
+        "dry_run": dry_run,
+        "pending_trips": len(trips),
+        "available_vehicles": len(vehicles),
+        "assignments": assignments,
+        "unassigned_trip_ids": [trip["_id"] for trip in trips if trip["_id"] not in assigned],
+        "total_distance_km": sum(assignment["distance_km"] for assignment in assignments)
+    }
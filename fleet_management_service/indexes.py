@@ -0,0 +1,99 @@
+import sys
+import asyncio
+import logging
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+
+logger = logging.getLogger(__name__)
+
+# Indexes of every collection, ensured at startup.
+# create_indexes is a no-op for indexes that already exist
+INDEXES = {
+    MongoDocumentsEnum.VEHICLES: [
+        # A driver can be assigned to one vehicle only,
+        # vehicles without a driver are left out of the index
+        IndexModel(
+            [("driver_id", ASCENDING)],
+            name="driver_id_unique",
+            unique=True,
+            partialFilterExpression={"driver_id": {"$exists": True}}
+        )
+    ],
+    # Pending trips and vehicles on a trip are looked up
+    # among trips that aren't completed, see dispatch.py
+    MongoDocumentsEnum.TRIPS: [
+        IndexModel([("trip_completed", ASCENDING), ("vehicle_id", ASCENDING)], name="trip_completed_vehicle_id")
+    ],
+    # Leaderboards read the first K rollups of a period in index order
+    MongoDocumentsEnum.DRIVER_ROLLUPS: [
+        IndexModel([("period", ASCENDING), ("points", DESCENDING)], name="period_points")
+    ],
+    MongoDocumentsEnum.VEHICLE_ROLLUPS: [
+        IndexModel([("period", ASCENDING), ("distance_km", DESCENDING)], name="period_distance_km")
+    ],
+    MongoDocumentsEnum.FLEET_ROLLUPS: [
+        IndexModel([("vehicle_type", ASCENDING), ("granularity", ASCENDING), ("period", ASCENDING)], name="vehicle_type_granularity_period"),
+        IndexModel([("period", ASCENDING)], name="period")
+    ]
+}
+
+# Queries on hot paths, each of them has to be served by an index
+HOT_QUERIES = [
+    (MongoDocumentsEnum.VEHICLES, {"driver_id": "driver"}, None),
+    (MongoDocumentsEnum.TRIPS, {"vehicle_id": None, "trip_completed": {"$ne": True}}, None),
+    (MongoDocumentsEnum.TRIPS, {"vehicle_id": {"$ne": None}, "trip_completed": {"$ne": True}}, None),
+    (MongoDocumentsEnum.DRIVER_ROLLUPS, {"period": "all"}, [("points", -1)]),
+    (MongoDocumentsEnum.VEHICLE_ROLLUPS, {"period": "all"}, [("distance_km", -1)]),
+    (MongoDocumentsEnum.FLEET_ROLLUPS, {"vehicle_type": "all", "granularity": "day", "period": {"$gte": "2022-01-01", "$lte": "2022-12-31"}}, None),
+    (MongoDocumentsEnum.FLEET_ROLLUPS, {"period": "all"}, None)
+]
+
+
+async def ensure_indexes():
+    for document, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                names = await db[document.value].create_indexes([index])
+                logger.info("Ensured indexes %s on %s", names, document.value)
+            except OperationFailure:
+                # Writes rely on unique indexes, the service doesn't start without them
+                if index.document.get("unique"):
+                    raise
+                logger.exception("Failed to ensure index %s on %s", index.document["name"], document.value)
+
+
+def plan_stages(plan):
+    yield plan["stage"]
+    for child in plan.get("inputStages", []) + [plan[key] for key in ("inputStage", "queryPlan") if key in plan]:
+        yield from plan_stages(child)
+
+
+async def check_hot_queries():
+    # Returns hot queries that would scan the whole collection
+    collection_scans = []
+
+    for document, query, sort in HOT_QUERIES:
+        cursor = db[document.value].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+
+        explanation = await cursor.explain()
+        stages = list(plan_stages(explanation["queryPlanner"]["winningPlan"]))
+        logger.info("%s %s: %s", document.value, query, " <- ".join(stages))
+
+        if "COLLSCAN" in stages:
+            collection_scans.append((document.value, query))
+
+    return collection_scans
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    await ensure_indexes()
+    return 1 if await check_hot_queries() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
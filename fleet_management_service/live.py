@@ -0,0 +1,177 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from positions import GeoGrid, from_gps_data, vehicle_positions
+
+logger = logging.getLogger(__name__)
+
+# Every subscriber buffers at most LIVE_BUFFER_SIZE vehicles. A new position
+# of a buffered vehicle replaces the old one, when the buffer is full
+# the longest waiting vehicle is dropped
+LIVE_BUFFER_SIZE = int(os.environ.get("LIVE_BUFFER_SIZE", 1000))
+LIVE_MAX_SUBSCRIBERS = int(os.environ.get("LIVE_MAX_SUBSCRIBERS", 10000))
+LIVE_KEEPALIVE_SECONDS = float(os.environ.get("LIVE_KEEPALIVE_SECONDS", 15))
+# Bounding box subscribers are indexed by the cells of a coarse grid,
+# boxes covering more than LIVE_MAX_INDEXED_CELLS cells are matched
+# against every position instead
+LIVE_CELL_SIZE_DEGREES = float(os.environ.get("LIVE_CELL_SIZE_DEGREES", 1))
+LIVE_MAX_INDEXED_CELLS = int(os.environ.get("LIVE_MAX_INDEXED_CELLS", 400))
+
+
+class Subscriber:
+    def __init__(self, vehicle_ids=None, trip_ids=None, bounding_box=None, buffer_size=LIVE_BUFFER_SIZE):
+        self.vehicle_ids = set(vehicle_ids) if vehicle_ids else None
+        self.trip_ids = set(trip_ids) if trip_ids else None
+        # (min_lat, min_long, max_lat, max_long)
+        self.bounding_box = bounding_box
+        self.buffer_size = buffer_size
+
+        self.buffer = OrderedDict()
+        self.ready = asyncio.Event()
+
+        self.delivered = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def matches(self, position):
+        if self.vehicle_ids is not None and position["vehicle_id"] not in self.vehicle_ids:
+            return False
+        if self.trip_ids is not None and position["trip_id"] not in self.trip_ids:
+            return False
+        if self.bounding_box is not None:
+            min_lat, min_long, max_lat, max_long = self.bounding_box
+            width = 360 if max_long - min_long >= 360 else (max_long - min_long) % 360
+            if not (min_lat <= position["lat"] <= max_lat and (position["long"] - min_long) % 360 <= width):
+                return False
+        return True
+
+    def offer(self, position):
+        vehicle_id = position["vehicle_id"]
+
+        if vehicle_id in self.buffer:
+            self.coalesced += 1
+            self.buffer.pop(vehicle_id)
+        elif len(self.buffer) >= self.buffer_size:
+            self.buffer.popitem(last=False)
+            self.dropped += 1
+
+        self.buffer[vehicle_id] = position
+        self.ready.set()
+
+    async def next_batch(self, timeout=None):
+        # Waits for at least one position, returns all buffered ones.
+        # Returns an empty list if nothing arrived before timeout
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        batch = list(self.buffer.values())
+        self.buffer.clear()
+        self.ready.clear()
+        self.delivered += len(batch)
+        return batch
+
+
+class LivePositions:
+    # Fans GPS data out to subscribers. Subscribers are indexed by
+    # the vehicles, trips or grid cells they filter on, so a position
+    # is only matched against subscribers that may want it
+    def __init__(self, max_subscribers=LIVE_MAX_SUBSCRIBERS, cell_size_degrees=LIVE_CELL_SIZE_DEGREES):
+        self.max_subscribers = max_subscribers
+        self.grid = GeoGrid(cell_size_degrees)
+        self.subscribers = set()
+        self.by_vehicle = {}
+        self.by_trip = {}
+        self.by_cell = {}
+        self.unindexed = set()
+
+        self.received = 0
+        # Counters of subscribers that are gone
+        self.closed = {"delivered": 0, "coalesced": 0, "dropped": 0}
+
+    def cells_of(self, bounding_box):
+        min_lat, min_long, max_lat, max_long = bounding_box
+        rows = range(self.grid.row_of(min_lat), self.grid.row_of(max_lat) + 1)
+        columns = self.grid.columns_between(min_long, max_long)
+        if len(rows) * len(columns) > LIVE_MAX_INDEXED_CELLS:
+            return None
+        return [(row, column) for row in rows for column in columns]
+
+    def index_of(self, subscriber):
+        if subscriber.vehicle_ids is not None:
+            return self.by_vehicle, subscriber.vehicle_ids
+        if subscriber.trip_ids is not None:
+            return self.by_trip, subscriber.trip_ids
+        if subscriber.bounding_box is not None and (cells := self.cells_of(subscriber.bounding_box)) is not None:
+            return self.by_cell, cells
+        return None, None
+
+    def subscribe(self, subscriber):
+        if len(self.subscribers) >= self.max_subscribers:
+            return False
+
+        self.subscribers.add(subscriber)
+        index, keys = self.index_of(subscriber)
+        if index is None:
+            self.unindexed.add(subscriber)
+        else:
+            for key in keys:
+                index.setdefault(key, set()).add(subscriber)
+        return True
+
+    def unsubscribe(self, subscriber):
+        if subscriber not in self.subscribers:
+            return
+
+        self.subscribers.discard(subscriber)
+        for counter in self.closed:
+            self.closed[counter] += getattr(subscriber, counter)
+
+        index, keys = self.index_of(subscriber)
+        if index is None:
+            self.unindexed.discard(subscriber)
+        else:
+            for key in keys:
+                if (subscribers := index.get(key)) is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del index[key]
+
+    def publish(self, position):
+        self.received += 1
+        cell = (self.grid.row_of(position["lat"]), self.grid.column_of(position["long"]))
+        for subscribers in (
+            self.by_vehicle.get(position["vehicle_id"], ()),
+            self.by_trip.get(position["trip_id"], ()),
+            self.by_cell.get(cell, ()),
+            self.unindexed
+        ):
+            for subscriber in subscribers:
+                if subscriber.matches(position):
+                    subscriber.offer(position)
+
+    async def handle_gps_data(self, gps_data):
+        if gps_data.get("vehicle_id", None) is None:
+            return
+
+        position = from_gps_data(gps_data)
+        # Keeps the grid fresh between syncs
+        vehicle_positions.update(position)
+        self.publish(position)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "max_subscribers": self.max_subscribers,
+            "received": self.received,
+            "buffered": sum(len(subscriber.buffer) for subscriber in self.subscribers),
+            **{
+                counter: total + sum(getattr(subscriber, counter) for subscriber in self.subscribers)
+                for counter, total in self.closed.items()
+            }
+        }
+
+
+live_positions = LivePositions()
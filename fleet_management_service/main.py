@@ -1,18 +1,69 @@
+import time
 import asyncio
-from fastapi import FastAPI
-from routers import vehicles, drivers, trips
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from routers import vehicles, drivers, trips, live, stats
 from pika_client import pika_client
+from indexes import ensure_indexes
+from cache import cache
+from positions import positions_sync
+from live import live_positions
+from metrics import HTTP_REQUEST_SECONDS, IN_FLIGHT, render
+from responses import FastJSONResponse
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Labelled by route template, not by path, so ids don't add series
+    IN_FLIGHT.labels(kind="requests").inc()
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.labels(
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status_code
+        ).observe(time.perf_counter() - started)
+        IN_FLIGHT.labels(kind="requests").dec()
 
 
 @app.on_event("startup")
 async def startup_event():
+    await ensure_indexes()
+    positions_sync.start()
+
     # Background task to consume incoming messages
     from consumers import consume_point_messages
     loop = asyncio.get_running_loop()
+    await pika_client.connect(loop)
     await loop.create_task(pika_client.consume(loop, consume_point_messages))
+    await pika_client.subscribe_gps_data(live_positions.handle_gps_data)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await positions_sync.stop()
+    await pika_client.connection.close()
 
 app.include_router(vehicles.router)
 app.include_router(drivers.router)
 app.include_router(trips.router)
+app.include_router(live.router)
+app.include_router(stats.router)
+
+
+@app.get("/api/cache/stats", tags=["cache"], response_description="Document cache counters")
+async def cache_stats():
+    return await cache.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from bson import ObjectId
-from typing import Optional
+from typing import List, Optional
 
 
 class PyObjectId(ObjectId):
@@ -126,3 +126,93 @@ class UpdateTripModel(BaseModel):
                 },
             }
         }
+
+
+class VehicleAssignmentModel(BaseModel):
+    vehicle_id: str = Field(...)
+    driver_id: str = Field(...)
+
+
+class TripAssignmentModel(BaseModel):
+    trip_id: str = Field(...)
+    vehicle_id: str = Field(...)
+
+
+class BulkItemResultModel(BaseModel):
+    index: int = Field(...)
+    id: Optional[str]
+    status: int = Field(...)
+    detail: Optional[str]
+
+
+class VehiclePositionModel(BaseModel):
+    vehicle_id: str = Field(...)
+    lat: float = Field(...)
+    long: float = Field(...)
+    speed: Optional[float]
+    timestamp: Optional[float]
+    trip_id: Optional[str]
+    distance_km: Optional[float]
+
+
+class KilometresModel(BaseModel):
+    # Kilometres per speed band, keys are the bands of the VMS scoring
+    under_60: float = Field(0.0, alias="0-60")
+    from_60_to_80: float = Field(0.0, alias="60-80")
+    from_80_to_100: float = Field(0.0, alias="80-100")
+    over_100: float = Field(0.0, alias="100+")
+
+
+class DriverLeaderboardEntryModel(BaseModel):
+    rank: int = Field(...)
+    driver_id: str = Field(...)
+    full_name: Optional[str]
+    period: str = Field(...)
+    points: int = Field(...)
+    trips: int = Field(...)
+    distance_km: float = Field(...)
+
+
+class VehicleTotalsModel(BaseModel):
+    vehicle_id: str = Field(...)
+    vehicle_type: Optional[str]
+    period: str = Field(...)
+    points: int = Field(...)
+    trips: int = Field(...)
+    distance_km: float = Field(...)
+    kilometres: KilometresModel = Field(...)
+
+
+class FleetTotalsModel(BaseModel):
+    vehicle_type: str = Field(...)
+    period: str = Field(...)
+    points: int = Field(...)
+    trips: int = Field(...)
+    distance_km: float = Field(...)
+    kilometres: KilometresModel = Field(...)
+
+
+class DispatchRequestModel(BaseModel):
+    # Pending trips to dispatch, any of them up to limit when not given
+    trip_ids: Optional[List[str]]
+    limit: Optional[int] = Field(None, ge=1)
+    mode: str = Field("auto", regex="^(auto|greedy|optimal)$")
+    max_distance_km: Optional[float] = Field(None, gt=0)
+    dry_run: bool = Field(False)
+
+
+class DispatchAssignmentModel(BaseModel):
+    trip_id: str = Field(...)
+    vehicle_id: str = Field(...)
+    driver_id: str = Field(...)
+    distance_km: float = Field(...)
+
+
+class DispatchResultModel(BaseModel):
+    mode: str = Field(...)
+    dry_run: bool = Field(...)
+    pending_trips: int = Field(...)
+    available_vehicles: int = Field(...)
+    assignments: List[DispatchAssignmentModel] = Field(...)
+    unassigned_trip_ids: List[str] = Field(...)
+    total_distance_km: float = Field(...)
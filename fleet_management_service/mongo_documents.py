@@ -7,3 +7,13 @@ class MongoDocumentsEnum(Enum):
     VEHICLES = "vehicles"
     DRIVERS = "drivers"
     TRIPS = "trips"
+
+    # Kept by the points consumer, see rollups.py
+    TRIP_RESULTS = "trip_results"
+    DRIVER_ROLLUPS = "driver_rollups"
+    VEHICLE_ROLLUPS = "vehicle_rollups"
+    FLEET_ROLLUPS = "fleet_rollups"
+
+    # Kept in the vehicle monitoring system database
+    VEHICLE_POSITIONS = "vehicle_positions"
+    TRIP_SCORES = "trip_scores"
@@ -0,0 +1,84 @@
+import os
+from typing import Optional
+from fastapi import HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from codec import dumps
+from responses import FastJSONResponse, documents_response, layout_of, trim
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class ListParameters:
+    # Query parameters shared by all list endpoints, used as a dependency
+    def __init__(
+        self,
+        after: Optional[str] = Query(None, description="Return records after this id, taken from the X-Next-Cursor header"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+        fields: Optional[str] = Query(None, description="Comma separated fields to return, e.g. full_name,points"),
+        stream: bool = Query(False, description="Stream all records after the cursor as NDJSON, limit is ignored")
+    ):
+        self.after = after
+        self.limit = limit
+        self.fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+        self.stream = stream
+
+    @property
+    def projection(self):
+        if self.fields is None:
+            return None
+        return {field: 1 for field in self.fields}
+
+
+def check_fields(fields, model=None):
+    # Fields go into the projection, only top level fields of the
+    # response model can be asked for, no operators or nested paths
+    known = {alias for alias, default, nested in layout_of(model)} if model is not None else None
+    invalid = [
+        field for field in fields
+        if field.startswith("$") or "." in field or (known is not None and field not in known)
+    ]
+    if invalid:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(invalid)}"
+        )
+
+
+async def stream_documents(cursor, model=None):
+    # Records are trimmed to the model like a page of them is
+    async for document in cursor:
+        yield dumps(trim(document, model) if model is not None else document) + b"\n"
+
+
+async def list_documents(collection, response, parameters: ListParameters, model=None):
+    if parameters.fields is not None:
+        check_fields(parameters.fields, model)
+
+    # Pages are keyed on _id, so every page is an index range scan
+    # no matter how deep into the collection it is
+    query = {"_id": {"$gt": parameters.after}} if parameters.after is not None else {}
+    cursor = collection.find(query, parameters.projection).sort("_id", 1)
+
+    if parameters.stream:
+        # Partial records are streamed as they are
+        model = model if parameters.fields is None else None
+        return StreamingResponse(stream_documents(cursor, model), media_type="application/x-ndjson")
+
+    documents = await cursor.limit(parameters.limit + 1).to_list(length=parameters.limit + 1)
+
+    headers = {}
+    if len(documents) > parameters.limit:
+        documents = documents[:parameters.limit]
+        headers[NEXT_CURSOR_HEADER] = str(documents[-1]["_id"])
+
+    if parameters.fields is not None:
+        # Partial records don't match the response model
+        return FastJSONResponse(content=documents, headers=headers)
+
+    response.headers.update(headers)
+    if model is not None:
+        return documents_response(documents, model, headers=headers)
+    return documents
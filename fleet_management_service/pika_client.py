@@ -1,56 +1,147 @@
-import pika
 import aio_pika
+import asyncio
+import logging
 import os
-import json
+import time
+from codec import decode_message, encode_message
+from metrics import HANDLER_SECONDS, IN_FLIGHT, MESSAGES_CONSUMED, MESSAGES_FAILED, MESSAGES_PUBLISHED, remember_trace, span, trace_headers
+
+logger = logging.getLogger(__name__)
+
+# Trip dispatches are published over a pool of channels of one robust
+# connection, which reconnects and restores its channels on its own
+PUBLISHER_CHANNELS = int(os.environ.get("PUBLISHER_CHANNELS", 4))
+PUBLISHER_CONFIRMS = os.environ.get("PUBLISHER_CONFIRMS", "true").lower() == "true"
+CONSUMER_PREFETCH_COUNT = int(os.environ.get("CONSUMER_PREFETCH_COUNT", 200))
+# Live GPS data waiting for this process is capped, the oldest is dropped
+LIVE_QUEUE_MAX_LENGTH = int(os.environ.get("LIVE_QUEUE_MAX_LENGTH", 10000))
+# Messages rejected for good are parked in "<queue>.dead" through this
+# exchange instead of being dropped, same as consumer_runtime.py of the
+# other services. Queues get it from the dead-letter policy of the broker,
+# declared with the same arguments as before a running broker keeps them
+DEAD_LETTER_EXCHANGE = os.environ.get("DEAD_LETTER_EXCHANGE", "dead_letter_exchange")
+
+
+async def declare_queue(channel, queue_name):
+    dead_letter_queue = f"{queue_name}.dead"
+    dead_letter_exchange = await channel.declare_exchange(DEAD_LETTER_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True)
+    parked = await channel.declare_queue(dead_letter_queue, durable=True, exclusive=False, auto_delete=False)
+    # Dead lettered messages keep their routing key, the queue name
+    await parked.bind(dead_letter_exchange, routing_key=queue_name)
+
+    return await channel.declare_queue(queue_name, durable=True, exclusive=False, auto_delete=False)
 
 
 class PikaClient:
     def __init__(self):
-        connection_parameters = pika.ConnectionParameters(
-            os.environ.get('RABBITMQ_HOST')
-        )
-        self.connection = pika.BlockingConnection(connection_parameters)
-        self.channel = self.connection.channel()
+        self.connection = None
+        self.channels = None
 
-    async def consume(self, loop, consumer_handler):
-        self.consumer_handler = consumer_handler
-        connection = await aio_pika.connect_robust(
+    async def connect(self, loop=None):
+        self.connection = await aio_pika.connect_robust(
             host=os.environ.get('RABBITMQ_HOST'),
             port=5672,
             loop=loop
         )
-        channel = await connection.channel()
+
+        self.channels = asyncio.Queue()
+        for _ in range(PUBLISHER_CHANNELS):
+            channel = await self.connection.channel(publisher_confirms=PUBLISHER_CONFIRMS)
+            self.channels.put_nowait(channel)
+
+        # Declared once, publishing only needs the routing key
+        channel = await self.connection.channel()
+        await declare_queue(channel, os.environ.get("SEND_TRIP_DATA_QUEUE"))
+        await channel.close()
+
+        return self.connection
+
+    async def consume(self, loop, consumer_handler):
+        self.consumer_handler = consumer_handler
+        channel = await self.connection.channel()
+        # Messages are acked only after they are stored in batches,
+        # prefetch has to let a whole batch in
+        await channel.set_qos(prefetch_count=CONSUMER_PREFETCH_COUNT)
+        queue = await declare_queue(channel, os.environ.get('RECEIVE_POINTS_QUEUE'))
+        await queue.consume(self.process_incoming_message)
+
+        return self.connection
+
+    async def subscribe_gps_data(self, handler):
+        # Every FMS process gets its own copy of the GPS data published
+        # to the exchange, the queue is deleted once the process disconnects.
+        # Live positions aren't worth redelivering, so there are no acks
+        channel = await self.connection.channel()
+        exchange = await channel.declare_exchange(
+            os.environ.get("GPS_DATA_EXCHANGE"),
+            aio_pika.ExchangeType.TOPIC,
+            durable=True
+        )
         queue = await channel.declare_queue(
-            os.environ.get('RECEIVE_POINTS_QUEUE'),
-            durable=True,
-            exclusive=False,
-            auto_delete=False
+            exclusive=True,
+            auto_delete=True,
+            arguments={"x-max-length": LIVE_QUEUE_MAX_LENGTH, "x-overflow": "drop-head"}
         )
-        await queue.consume(self.process_incoming_message)
+        await queue.bind(exchange, routing_key="#")
 
-        return connection
+        async def process_gps_data(message):
+            try:
+                await handler(decode_message(message.body, message.content_type))
+            except Exception:
+                MESSAGES_FAILED.labels(queue=queue.name).inc()
+                logger.exception("Failed to handle GPS data %s", message.message_id)
+            else:
+                MESSAGES_CONSUMED.labels(queue=queue.name).inc()
+
+        await queue.consume(process_gps_data, no_ack=True)
+
+        return self.connection
 
     async def process_incoming_message(self, message):
-        body = message.body
-        await message.ack()
-        await self.consumer_handler(json.loads(body))
+        # Acked once the handler stored the message,
+        # a failed message is requeued once and dead lettered when it fails again
+        queue_name = message.routing_key
+        remember_trace(message.headers)
+        IN_FLIGHT.labels(kind="messages").inc()
+        started = time.perf_counter()
+        try:
+            body = decode_message(message.body, message.content_type)
+            with span("points_applied", body.get("trip_id", None)):
+                await self.consumer_handler(body)
+        except Exception:
+            MESSAGES_FAILED.labels(queue=queue_name).inc()
+            logger.exception("Failed to handle message %s", message.message_id)
+            await message.reject(requeue=not message.redelivered)
+        else:
+            MESSAGES_CONSUMED.labels(queue=queue_name).inc()
+            await message.ack()
+        finally:
+            HANDLER_SECONDS.labels(queue=queue_name).observe(time.perf_counter() - started)
+            IN_FLIGHT.labels(kind="messages").dec()
 
-    def send_message(self, message):
-        publish_properties = pika.BasicProperties(
-            delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE
-        )
-        self.channel.queue_declare(
-            os.environ.get("SEND_TRIP_DATA_QUEUE"),
-            durable=True,
-            exclusive=False,
-            auto_delete=False
-        )
-        self.channel.basic_publish(
-            exchange='',
-            routing_key=os.environ.get("SEND_TRIP_DATA_QUEUE"),
-            body=json.dumps(message),
-            properties=publish_properties
-        )
+    async def send_message(self, message):
+        await self.send_messages([message])
+
+    async def send_messages(self, messages):
+        # All messages are published on one channel without waiting in between,
+        # with confirms enabled this waits for all of them at once
+        channel = await self.channels.get()
+        try:
+            # A dispatched trip starts its trace
+            await asyncio.gather(*(
+                channel.default_exchange.publish(
+                    aio_pika.Message(
+                        **encode_message(message),
+                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                        headers=trace_headers(message.get("trip_id", None))
+                    ),
+                    routing_key=os.environ.get("SEND_TRIP_DATA_QUEUE")
+                )
+                for message in messages
+            ))
+            MESSAGES_PUBLISHED.labels(queue=os.environ.get("SEND_TRIP_DATA_QUEUE")).inc(len(messages))
+        finally:
+            self.channels.put_nowait(channel)
 
 
 pika_client = PikaClient()
@@ -0,0 +1,227 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from dependencies import vms_db
+from mongo_documents import MongoDocumentsEnum
+
+logger = logging.getLogger(__name__)
+
+# Latest positions of all vehicles are kept in a grid of
+# POSITIONS_CELL_SIZE_DEGREES cells, a radius query only looks
+# at the cells its bounding box covers
+POSITIONS_CELL_SIZE_DEGREES = float(os.environ.get("POSITIONS_CELL_SIZE_DEGREES", 0.05))
+POSITIONS_SYNC_INTERVAL_SECONDS = float(os.environ.get("POSITIONS_SYNC_INTERVAL_SECONDS", 1))
+# Positions older than this are dropped from the grid, checked once a minute
+POSITIONS_MAX_AGE_SECONDS = float(os.environ.get("POSITIONS_MAX_AGE_SECONDS", 86400))
+POSITIONS_EXPIRE_INTERVAL_SECONDS = 60
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+POSITION_PROJECTION = {"_id": 0, "vehicle_id": 1, "location": 1, "speed": 1, "timestamp": 1, "trip_id": 1, "updated_at": 1}
+
+
+# Copy of distance() in scoring.py of the vehicle monitoring system,
+# so a radius query and trip scoring agree on kilometres
+def distance(lat1, lon1, lat2, lon2):
+    p = math.pi/180
+    a = 0.5 - math.cos((lat2-lat1)*p)/2 + math.cos(lat1*p) * \
+        math.cos(lat2*p) * (1-math.cos((lon2-lon1)*p))/2
+    return abs(12742 * math.asin(math.sqrt(a)))
+
+
+def to_position(document):
+    long, lat = document["location"]["coordinates"]
+    return {
+        "vehicle_id": document["vehicle_id"],
+        "lat": lat,
+        "long": long,
+        "speed": document.get("speed"),
+        "timestamp": document.get("timestamp"),
+        "trip_id": document.get("trip_id")
+    }
+
+
+def from_gps_data(gps_data):
+    return {
+        "vehicle_id": gps_data["vehicle_id"],
+        "lat": gps_data["current_geo_point"]["lat"],
+        "long": gps_data["current_geo_point"]["long"],
+        "speed": gps_data.get("speed"),
+        "timestamp": gps_data.get("timestamp"),
+        "trip_id": gps_data.get("trip_id")
+    }
+
+
+class GeoGrid:
+    def __init__(self, cell_size_degrees=POSITIONS_CELL_SIZE_DEGREES):
+        self.cell_size = cell_size_degrees
+        self.rows = math.ceil(180 / cell_size_degrees)
+        self.columns = math.ceil(360 / cell_size_degrees)
+
+        # (row, column) -> {vehicle_id: position}, empty cells are dropped,
+        # so memory grows with the number of vehicles only
+        self.cells = {}
+        # vehicle_id -> cell it is in
+        self.vehicles = {}
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def row_of(self, lat):
+        return min(max(int((lat + 90) // self.cell_size), 0), self.rows - 1)
+
+    def column_of(self, long):
+        return int((long + 180) // self.cell_size) % self.columns
+
+    def update(self, position):
+        vehicle_id = position["vehicle_id"]
+        cell = (self.row_of(position["lat"]), self.column_of(position["long"]))
+
+        previous = self.vehicles.get(vehicle_id)
+        if previous is not None:
+            # Positions come from the live stream and from syncs,
+            # an older one never replaces a newer one
+            current = self.cells[previous][vehicle_id]
+            if (position["timestamp"] or 0) < (current["timestamp"] or 0):
+                return
+            if previous != cell:
+                self.discard(previous, vehicle_id)
+
+        self.cells.setdefault(cell, {})[vehicle_id] = position
+        self.vehicles[vehicle_id] = cell
+
+    def remove(self, vehicle_id):
+        if (cell := self.vehicles.pop(vehicle_id, None)) is not None:
+            self.discard(cell, vehicle_id)
+
+    def discard(self, cell, vehicle_id):
+        positions = self.cells[cell]
+        del positions[vehicle_id]
+        if not positions:
+            del self.cells[cell]
+
+    def expire(self, older_than):
+        # Vehicles that haven't reported since older_than, e.g. retired ones
+        expired = [
+            vehicle_id for vehicle_id, cell in self.vehicles.items()
+            if (self.cells[cell][vehicle_id]["timestamp"] or 0) < older_than
+        ]
+        for vehicle_id in expired:
+            self.remove(vehicle_id)
+        return len(expired)
+
+    def get(self, vehicle_id):
+        if (cell := self.vehicles.get(vehicle_id)) is not None:
+            return self.cells[cell][vehicle_id]
+        return None
+
+    def columns_between(self, min_long, max_long):
+        if max_long - min_long >= 360:
+            return range(self.columns)
+        first, last = self.column_of(min_long), self.column_of(max_long)
+        if first <= last:
+            return range(first, last + 1)
+        # Box crosses the antimeridian
+        return [*range(first, self.columns), *range(0, last + 1)]
+
+    def candidates(self, min_lat, min_long, max_lat, max_long):
+        columns = self.columns_between(min_long, max_long)
+        rows = range(self.row_of(min_lat), self.row_of(max_lat) + 1)
+        if len(rows) * len(columns) > len(self.cells):
+            # A box over more cells than there are vehicles, e.g. the whole
+            # world, looks at the occupied cells instead of every cell in it
+            columns = columns if isinstance(columns, range) else set(columns)
+            for (row, column), positions in self.cells.items():
+                if row in rows and column in columns:
+                    yield from positions.values()
+            return
+
+        for row in rows:
+            for column in columns:
+                if (positions := self.cells.get((row, column))) is not None:
+                    yield from positions.values()
+
+    def within(self, min_lat, min_long, max_lat, max_long):
+        # min_long > max_long is a box crossing the antimeridian
+        width = 360 if max_long - min_long >= 360 else (max_long - min_long) % 360
+        return [
+            position for position in self.candidates(min_lat, min_long, max_lat, max_long)
+            if min_lat <= position["lat"] <= max_lat and (position["long"] - min_long) % 360 <= width
+        ]
+
+    def nearby(self, lat, long, radius_km, limit=None):
+        lat_delta = radius_km / KM_PER_DEGREE
+        # Longitude degrees get shorter towards the poles, the box is wide
+        # enough for the widest latitude it covers
+        widest_lat = min(abs(lat) + lat_delta, 90)
+        if widest_lat >= 90:
+            long_delta = 180
+        else:
+            long_delta = min(lat_delta / math.cos(math.radians(widest_lat)), 180)
+
+        found = []
+        for position in self.candidates(lat - lat_delta, long - long_delta, lat + lat_delta, long + long_delta):
+            if (position_distance := distance(lat, long, position["lat"], position["long"])) <= radius_km:
+                found.append((position_distance, position))
+
+        found.sort(key=lambda item: item[0])
+        if limit is not None:
+            found = found[:limit]
+
+        return [{**position, "distance_km": position_distance} for position_distance, position in found]
+
+
+class PositionsSync:
+    # Loads all positions once, then every POSITIONS_SYNC_INTERVAL_SECONDS
+    # only the ones updated since the last sync
+    def __init__(self, grid, interval_seconds=POSITIONS_SYNC_INTERVAL_SECONDS, max_age_seconds=POSITIONS_MAX_AGE_SECONDS):
+        self.grid = grid
+        self.interval = interval_seconds
+        self.max_age = max_age_seconds
+        self.last_update = None
+        self.last_expired = time.monotonic()
+        self.task = None
+
+    async def sync(self):
+        # Positions updated at the same time as the last one seen may be
+        # written after it was read, so they are read again
+        query = {"updated_at": {"$gte": self.last_update}} if self.last_update is not None else {}
+        collection = vms_db[MongoDocumentsEnum.VEHICLE_POSITIONS.value]
+
+        synced = 0
+        async for document in collection.find(query, POSITION_PROJECTION):
+            self.grid.update(to_position(document))
+            if self.last_update is None or document["updated_at"] > self.last_update:
+                self.last_update = document["updated_at"]
+            synced += 1
+
+        return synced
+
+    async def run(self):
+        while True:
+            try:
+                synced = await self.sync()
+                logger.debug("Synced %d vehicle positions, %d in total", synced, len(self.grid))
+                if time.monotonic() - self.last_expired >= POSITIONS_EXPIRE_INTERVAL_SECONDS:
+                    self.last_expired = time.monotonic()
+                    if expired := self.grid.expire(time.time() - self.max_age):
+                        logger.info("Dropped %d vehicle positions older than %d seconds", expired, self.max_age)
+            except Exception:
+                logger.exception("Failed to sync vehicle positions")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+vehicle_positions = GeoGrid()
+positions_sync = PositionsSync(vehicle_positions)
@@ -0,0 +1,57 @@
+import os
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON
+from starlette.responses import JSONResponse
+from codec import dumps
+
+# Documents read back from Mongo were validated by their model when they
+# were written. Read routes trim them to the fields of the response model
+# instead of validating and encoding them again, with
+# VALIDATE_READ_RESPONSES=true FastAPI validates them like any other response
+VALIDATE_READ_RESPONSES = os.environ.get("VALIDATE_READ_RESPONSES", "false").lower() == "true"
+
+
+class FastJSONResponse(JSONResponse):
+    # orjson when it is installed, ObjectId and datetime are handled by the codec
+    def render(self, content):
+        return dumps(content)
+
+
+layouts = {}
+
+
+def layout_of(model):
+    # Alias, default and nested model of every field, nested only for
+    # single models, lists are returned as they are
+    if (layout := layouts.get(model)) is None:
+        layout = layouts[model] = [
+            (
+                field.alias,
+                field.default,
+                field.type_ if field.shape == SHAPE_SINGLETON and isinstance(field.type_, type) and issubclass(field.type_, BaseModel) else None
+            )
+            for field in model.__fields__.values()
+        ]
+    return layout
+
+
+def trim(document, model):
+    # Same keys a validated response would have: fields the model doesn't
+    # know are dropped, missing ones get their default
+    result = {}
+    for alias, default, nested in layout_of(model):
+        value = document.get(alias, default)
+        result[alias] = trim(value, nested) if nested is not None and isinstance(value, dict) else value
+    return result
+
+
+def document_response(document, model, **kwargs):
+    if VALIDATE_READ_RESPONSES:
+        return document
+    return FastJSONResponse(content=trim(document, model), **kwargs)
+
+
+def documents_response(documents, model, **kwargs):
+    if VALIDATE_READ_RESPONSES:
+        return documents
+    return FastJSONResponse(content=[trim(document, model) for document in documents], **kwargs)
@@ -0,0 +1,321 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timezone
+from bson import ObjectId
+from pymongo import UpdateOne
+from dependencies import db, vms_db
+from mongo_documents import MongoDocumentsEnum
+
+logger = logging.getLogger(__name__)
+
+# Leaderboards and fleet totals are read from rollup documents kept up to
+# date by the points consumer, one document per period and driver, vehicle
+# or vehicle type, so a read doesn't depend on the size of the fleet.
+#
+# Every trip is kept in trip_results, inserted once per trip, so a
+# redelivered points message doesn't add it again. A result holds the
+# points not yet added to its driver and the rollups in pending_points,
+# and whether the trip is counted in the rollups in counted. Every amount
+# made pending, the trip's points or a correction, is a credit with its
+# own id. The consumer adds credits to the driver only while the driver
+# hasn't recorded their ids, then marks the result applied and lets the
+# driver forget them. A message redelivered after a failure anywhere in
+# between finishes the job without crediting the driver twice. It updates
+# the rollups next, a failure there leaves the trip out of the rollups
+# until they are rebuilt from trip_results.
+#
+# Rescoring in the VMS sends corrections as points messages with the
+# previous_points of the trip. A correction changes the points of the
+# trip result and leaves the difference pending, so it reaches the driver
+# and the rollups the same way, and rebuilt rollups use corrected points:
+#
+#   python3 rollups.py rebuild
+#   python3 rollups.py rebuild --backfill    first adds trips scored before rollups, from the VMS
+#
+# Rebuild swaps in new collections, trips applied while it runs are only
+# in the next rebuild, run it with the points consumer stopped or run it twice
+
+ROLLUP_BATCH_SIZE = int(os.environ.get("ROLLUP_BATCH_SIZE", 1000))
+
+BANDS = ("0-60", "60-80", "80-100", "100+")
+# Fleet rollups of every vehicle type together
+ALL_VEHICLE_TYPES = "all"
+UNKNOWN_VEHICLE_TYPE = "unknown"
+
+ROLLUP_DOCUMENTS = (MongoDocumentsEnum.DRIVER_ROLLUPS, MongoDocumentsEnum.VEHICLE_ROLLUPS, MongoDocumentsEnum.FLEET_ROLLUPS)
+
+
+def periods_of(finished_at):
+    # UTC day and month of the trip, and all time
+    finished = datetime.fromtimestamp(finished_at, timezone.utc)
+    return [("all", "all"), ("month", finished.strftime("%Y-%m")), ("day", finished.strftime("%Y-%m-%d"))]
+
+
+def trip_result(message, vehicle_type, applied=False):
+    # Points messages of an older VMS have no kilometres, vehicle or finish time.
+    # Results of applied trips are counted and their points are with the driver,
+    # the driver of a corrected trip unknown here has its previous points
+    kilometres = {band: float((message.get("kilometres") or {}).get(band, 0.0)) for band in BANDS}
+    return {
+        "_id": message["trip_id"],
+        "driver_id": message.get("driver_id"),
+        "vehicle_id": message.get("vehicle_id"),
+        "vehicle_type": vehicle_type,
+        "points": message["points"],
+        "kilometres": kilometres,
+        "distance_km": sum(kilometres.values()),
+        "finished_at": message.get("finished_at") or time.time(),
+        "pending_points": 0 if applied else message["points"] - message.get("previous_points", 0),
+        "credits": [] if applied else [new_credit(message["points"] - message.get("previous_points", 0))],
+        "counted": applied
+    }
+
+
+def new_credit(points):
+    return {"_id": str(ObjectId()), "points": points}
+
+
+def credits_of(result):
+    # Pending points of results stored before credits are one credit named after the trip
+    credits = result.get("credits") or []
+    remainder = (result.get("pending_points") or 0) - sum(credit["points"] for credit in credits)
+    return credits + [{"_id": result["_id"], "points": remainder}] if remainder else credits
+
+
+def add_to_rollups(rollups, result, trips, points):
+    # rollups maps (document, _id) to the fields of a new rollup
+    # and the increments of its counters. trips is 1 when the trip
+    # is counted with its kilometres, 0 when only points are added
+    def add(document, key, fields, increments):
+        rollup = rollups.setdefault((document, key), (fields, {}))
+        for name, value in increments.items():
+            rollup[1][name] = rollup[1].get(name, 0) + value
+
+    totals = {"trips": trips, "points": points, "distance_km": result["distance_km"] * trips}
+    band_totals = {**totals, **{f"kilometres.{band}": kilometres * trips for band, kilometres in result["kilometres"].items()}}
+
+    for granularity, period in periods_of(result["finished_at"]):
+        period_fields = {"granularity": granularity, "period": period}
+        if result["driver_id"] is not None:
+            add(
+                MongoDocumentsEnum.DRIVER_ROLLUPS, f"{period}:{result['driver_id']}",
+                {**period_fields, "driver_id": result["driver_id"]}, totals
+            )
+        if result["vehicle_id"] is not None:
+            add(
+                MongoDocumentsEnum.VEHICLE_ROLLUPS, f"{period}:{result['vehicle_id']}",
+                {**period_fields, "vehicle_id": result["vehicle_id"], "vehicle_type": result["vehicle_type"]}, band_totals
+            )
+        for vehicle_type in (ALL_VEHICLE_TYPES, result["vehicle_type"]):
+            add(
+                MongoDocumentsEnum.FLEET_ROLLUPS, f"{period}:{vehicle_type}",
+                {**period_fields, "vehicle_type": vehicle_type}, band_totals
+            )
+    return rollups
+
+
+def to_rollup_document(key, fields, increments):
+    document = {"_id": key, **fields}
+    for name, value in increments.items():
+        if "." in name:
+            parent, child = name.split(".", 1)
+            document.setdefault(parent, {})[child] = value
+        else:
+            document[name] = value
+    return document
+
+
+async def find_trip_vehicles(trip_ids):
+    return {
+        trip["_id"]: trip.get("vehicle_id")
+        async for trip in db[MongoDocumentsEnum.TRIPS.value].find({"_id": {"$in": list(trip_ids)}}, {"vehicle_id": 1})
+    }
+
+
+async def find_vehicle_types(vehicle_ids):
+    vehicle_types = {}
+    if vehicle_ids:
+        async for vehicle in db[MongoDocumentsEnum.VEHICLES.value].find({"_id": {"$in": list(vehicle_ids)}}, {"type": 1}):
+            vehicle_types[vehicle["_id"]] = vehicle.get("type") or UNKNOWN_VEHICLE_TYPE
+    return vehicle_types
+
+
+async def insert_trip_results(messages, applied=False):
+    # Returns results of the trips that weren't in trip_results yet
+    vehicle_types = await find_vehicle_types({message.get("vehicle_id") for message in messages} - {None})
+    results = list({
+        message["trip_id"]: trip_result(message, vehicle_types.get(message.get("vehicle_id"), UNKNOWN_VEHICLE_TYPE), applied)
+        for message in messages
+    }.values())
+    if not results:
+        return []
+
+    inserted = await db[MongoDocumentsEnum.TRIP_RESULTS.value].bulk_write([
+        UpdateOne({"_id": result["_id"]}, {"$setOnInsert": {k: v for k, v in result.items() if k != "_id"}}, upsert=True)
+        for result in results
+    ], ordered=False)
+    return [results[index] for index in sorted(inserted.upserted_ids)]
+
+
+async def store_corrections(corrections):
+    # Points of a trip are corrected only while they are the previous
+    # points, a redelivered correction doesn't change them twice. Trips
+    # scored before rollups get a result, vehicles come from the trips
+    await db[MongoDocumentsEnum.TRIP_RESULTS.value].bulk_write([
+        UpdateOne(
+            {"_id": correction["trip_id"], "points": correction["previous_points"]},
+            {
+                "$set": {"points": correction["points"]},
+                "$inc": {"pending_points": correction["points"] - correction["previous_points"]},
+                "$push": {"credits": new_credit(correction["points"] - correction["previous_points"])}
+            }
+        )
+        for correction in corrections
+    ])
+
+    vehicles = await find_trip_vehicles({correction["trip_id"] for correction in corrections if correction.get("vehicle_id") is None})
+    await insert_trip_results([
+        {**correction, "vehicle_id": correction.get("vehicle_id") or vehicles.get(correction["trip_id"])}
+        for correction in corrections
+    ])
+
+
+async def find_unapplied_results(trip_ids):
+    # Results of these trips whose points aren't all with the driver and
+    # the rollups yet, results stored before pending_points count as applied
+    return [
+        result async for result in db[MongoDocumentsEnum.TRIP_RESULTS.value].find({
+            "_id": {"$in": list(trip_ids)},
+            "$or": [{"counted": False}, {"pending_points": {"$nin": [0, None]}}]
+        })
+    ]
+
+
+async def update_rollups(results):
+    rollups = {}
+    for result in results:
+        if result.get("counted", True):
+            add_to_rollups(rollups, result, 0, result.get("pending_points", 0))
+        else:
+            add_to_rollups(rollups, result, 1, result["points"])
+
+    for document in ROLLUP_DOCUMENTS:
+        requests = [
+            UpdateOne({"_id": key}, {"$setOnInsert": fields, "$inc": increments}, upsert=True)
+            for (rollup_document, key), (fields, increments) in rollups.items() if rollup_document is document
+        ]
+        if requests:
+            await db[document.value].bulk_write(requests, ordered=False)
+
+
+async def mark_applied(results):
+    # Pending points and credits are taken off rather than cleared,
+    # a correction stored in the meantime stays pending
+    if results:
+        await db[MongoDocumentsEnum.TRIP_RESULTS.value].bulk_write([
+            UpdateOne(
+                {"_id": result["_id"]},
+                {
+                    "$set": {"counted": True},
+                    "$inc": {"pending_points": -result.get("pending_points", 0)},
+                    "$pull": {"credits": {"_id": {"$in": [credit["_id"] for credit in credits_of(result)]}}}
+                }
+            )
+            for result in results
+        ], ordered=False)
+
+
+async def backfill_trip_results(batch_size=ROLLUP_BATCH_SIZE):
+    # Trips scored before rollups existed. Points, kilometres and the last
+    # sample are kept with the trip scores of the VMS, vehicles with the trips.
+    # Their drivers have the points already, rebuild counts them
+    trip_scores = vms_db[MongoDocumentsEnum.TRIP_SCORES.value].find(
+        {"points": {"$exists": True}},
+        {"trip_id": 1, "driver_id": 1, "points": 1, "kilometres": 1, "last_sample.timestamp": 1, "started": 1}
+    )
+    backfilled = 0
+    batch = []
+
+    async def insert(batch):
+        vehicles = await find_trip_vehicles({trip_score["trip_id"] for trip_score in batch})
+        return await insert_trip_results([
+            {
+                "trip_id": trip_score["trip_id"],
+                "driver_id": trip_score.get("driver_id"),
+                "vehicle_id": vehicles.get(trip_score["trip_id"]),
+                "points": trip_score["points"],
+                "kilometres": trip_score.get("kilometres"),
+                "finished_at": (trip_score.get("last_sample") or {}).get("timestamp") or trip_score.get("started")
+            }
+            for trip_score in batch
+        ], applied=True)
+
+    async for trip_score in trip_scores:
+        batch.append(trip_score)
+        if len(batch) >= batch_size:
+            backfilled += len(await insert(batch))
+            batch = []
+    if batch:
+        backfilled += len(await insert(batch))
+
+    return backfilled
+
+
+async def rebuild(backfill=False, batch_size=ROLLUP_BATCH_SIZE):
+    from indexes import INDEXES
+
+    if backfill:
+        logger.info("Backfilled %d trip results", await backfill_trip_results(batch_size))
+
+    # Results not counted yet and pending points are
+    # added by the consumer once their message is redelivered
+    rollups, trips = {}, 0
+    async for result in db[MongoDocumentsEnum.TRIP_RESULTS.value].find({"counted": {"$ne": False}}):
+        add_to_rollups(rollups, result, 1, result["points"] - result.get("pending_points", 0))
+        trips += 1
+
+    # New rollups are written next to the old ones and renamed over them
+    for document in ROLLUP_DOCUMENTS:
+        rebuilt = db[f"{document.value}_rebuild"]
+        await rebuilt.drop()
+        if INDEXES.get(document):
+            await rebuilt.create_indexes(INDEXES[document])
+
+        documents = [
+            to_rollup_document(key, fields, increments)
+            for (rollup_document, key), (fields, increments) in rollups.items() if rollup_document is document
+        ]
+        for start in range(0, len(documents), batch_size):
+            await rebuilt.insert_many(documents[start:start + batch_size], ordered=False)
+
+        if documents:
+            await rebuilt.rename(document.value, dropTarget=True)
+        else:
+            await db[document.value].delete_many({})
+        logger.info("Rebuilt %d %s", len(documents), document.value)
+
+    return trips
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain leaderboard and fleet rollups")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = commands.add_parser("rebuild", help="Regenerate rollups from trip results")
+    rebuild_parser.add_argument("--backfill", action="store_true", help="First add trip results of trips scored by the VMS")
+    rebuild_parser.add_argument("--batch-size", type=int, default=ROLLUP_BATCH_SIZE)
+
+    arguments = parser.parse_args(argv)
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    trips = asyncio.run(rebuild(arguments.backfill, arguments.batch_size))
+    print(f"rebuilt rollups of {trips} trips")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,15 @@
 from dependencies import db
 from mongo_documents import MongoDocumentsEnum
-from fastapi import APIRouter, Body, HTTPException, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Response, status
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
 from typing import List
-from models import DriverModel, UpdateDriverModel
+from pagination import ListParameters, list_documents
+from responses import document_response
+from cache import cache
+from bulk import insert_items
+from pymongo import ReturnDocument
+from models import DriverModel, UpdateDriverModel, BulkItemResultModel
 
 
 router = APIRouter(
@@ -15,29 +20,28 @@ router = APIRouter(
 
 
 @router.get("/", response_description="Get all drivers", response_model=List[DriverModel])
-async def get_all_drivers():
-    drivers = []
-
-    for result in await db[MongoDocumentsEnum.DRIVERS.value].find().to_list(length=100):
-        drivers.append(result)
-
-    return drivers
+async def get_all_drivers(response: Response, parameters: ListParameters = Depends()):
+    return await list_documents(db[MongoDocumentsEnum.DRIVERS.value], response, parameters, DriverModel)
 
 
 @router.post("/", response_description="Add new driver", response_model=DriverModel)
 async def create_driver(driver: DriverModel = Body(...)):
     driver = jsonable_encoder(driver)
-    new_driver = await db[MongoDocumentsEnum.DRIVERS.value].insert_one(driver)
-    created_driver = await db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": new_driver.inserted_id})
-    return JSONResponse(status_code=status.HTTP_201_CREATED, content=created_driver)
+    await db[MongoDocumentsEnum.DRIVERS.value].insert_one(driver)
+    return JSONResponse(status_code=status.HTTP_201_CREATED, content=driver)
+
+
+@router.post("/bulk", response_description="Add new drivers in bulk", response_model=List[BulkItemResultModel])
+async def create_drivers_in_bulk(drivers: List[dict] = Body(...)):
+    return await insert_items(db[MongoDocumentsEnum.DRIVERS.value], DriverModel, drivers)
 
 
 @router.get(
     "/{id}", response_description="Get a single driver", response_model=DriverModel
 )
 async def show_driver(id: str):
-    if (driver := await db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": id})) is not None:
-        return driver
+    if (driver := await cache.get(MongoDocumentsEnum.DRIVERS, id)) is not None:
+        return document_response(driver, DriverModel)
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -50,16 +54,15 @@ async def update_driver(id: str, driver: UpdateDriverModel = Body(...)):
     driver = {k: v for k, v in driver.dict().items() if v is not None}
 
     if len(driver) >= 1:
-        update_result = await db[MongoDocumentsEnum.DRIVERS.value].update_one({"_id": id}, {"$set": driver})
-
-        if update_result.modified_count == 1:
-            if (
-                updated_driver := await db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": id})
-            ) is not None:
-                return updated_driver
+        updated_driver = await db[MongoDocumentsEnum.DRIVERS.value].find_one_and_update(
+            {"_id": id}, {"$set": driver}, return_document=ReturnDocument.AFTER
+        )
+        await cache.invalidate(MongoDocumentsEnum.DRIVERS, id)
+    else:
+        updated_driver = await db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": id})
 
-    if (existing_driver := await db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": id})) is not None:
-        return existing_driver
+    if updated_driver is not None:
+        return updated_driver
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -70,6 +73,7 @@ async def update_driver(id: str, driver: UpdateDriverModel = Body(...)):
 @router.delete("/{id}", response_description="Delete a driver")
 async def delete_driver(id: str):
     delete_result = await db[MongoDocumentsEnum.DRIVERS.value].delete_one({"_id": id})
+    await cache.invalidate(MongoDocumentsEnum.DRIVERS, id)
 
     if delete_result.deleted_count == 1:
         return JSONResponse(status_code=status.HTTP_200_OK)
@@ -0,0 +1,109 @@
+import asyncio
+from fastapi import APIRouter, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+from live import LIVE_KEEPALIVE_SECONDS, Subscriber, live_positions
+from codec import dumps
+
+
+router = APIRouter(
+    prefix="/api/live",
+    tags=["live"],
+)
+
+
+def subscriber_from_query(vehicle_id, trip_id, min_lat, min_long, max_lat, max_long):
+    bounding_box = (min_lat, min_long, max_lat, max_long)
+    if all(value is None for value in bounding_box):
+        bounding_box = None
+    elif any(value is None for value in bounding_box) or min_lat > max_lat:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Bounding box needs min_lat <= max_lat, min_long and max_long"
+        )
+
+    subscriber = Subscriber(vehicle_id, trip_id, bounding_box)
+    if not live_positions.subscribe(subscriber):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many live subscribers"
+        )
+
+    return subscriber
+
+
+async def server_sent_events(request, subscriber):
+    try:
+        while not await request.is_disconnected():
+            batch = await subscriber.next_batch(LIVE_KEEPALIVE_SECONDS)
+            if not batch:
+                # Keeps proxies from closing an idle connection
+                yield b": keepalive\n\n"
+                continue
+            for position in batch:
+                yield b"event: position\ndata: " + dumps(position) + b"\n\n"
+    finally:
+        live_positions.unsubscribe(subscriber)
+
+
+@router.get("/positions", response_description="Stream vehicle positions as Server-Sent Events")
+async def stream_positions(
+    request: Request,
+    vehicle_id: Optional[List[str]] = Query(None, description="Only these vehicles"),
+    trip_id: Optional[List[str]] = Query(None, description="Only these trips"),
+    min_lat: Optional[float] = Query(None, ge=-90, le=90),
+    min_long: Optional[float] = Query(None, ge=-180, le=180),
+    max_lat: Optional[float] = Query(None, ge=-90, le=90),
+    max_long: Optional[float] = Query(None, ge=-180, le=180)
+):
+    subscriber = subscriber_from_query(vehicle_id, trip_id, min_lat, min_long, max_lat, max_long)
+    return StreamingResponse(
+        server_sent_events(request, subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.websocket("/positions/ws")
+async def websocket_positions(
+    websocket: WebSocket,
+    vehicle_id: Optional[List[str]] = Query(None),
+    trip_id: Optional[List[str]] = Query(None),
+    min_lat: Optional[float] = Query(None),
+    min_long: Optional[float] = Query(None),
+    max_lat: Optional[float] = Query(None),
+    max_long: Optional[float] = Query(None)
+):
+    try:
+        subscriber = subscriber_from_query(vehicle_id, trip_id, min_lat, min_long, max_lat, max_long)
+    except HTTPException as error:
+        await websocket.close(code=1008 if error.status_code == status.HTTP_400_BAD_REQUEST else 1013)
+        return
+
+    await websocket.accept()
+
+    # Client messages are only read to notice it disconnected
+    async def receive():
+        while True:
+            await websocket.receive_text()
+
+    receiver = asyncio.create_task(receive())
+    try:
+        while True:
+            sender = asyncio.create_task(subscriber.next_batch(LIVE_KEEPALIVE_SECONDS))
+            await asyncio.wait({receiver, sender}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                sender.cancel()
+                break
+            if batch := sender.result():
+                await websocket.send_text(dumps(batch).decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        live_positions.unsubscribe(subscriber)
+
+
+@router.get("/stats", response_description="Live subscription counters")
+async def live_stats():
+    return live_positions.stats()
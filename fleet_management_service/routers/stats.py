@@ -0,0 +1,102 @@
+from datetime import date
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+from fastapi import APIRouter, HTTPException, Query, status
+from typing import List, Optional
+from responses import document_response, documents_response
+from rollups import ALL_VEHICLE_TYPES
+from models import DriverLeaderboardEntryModel, FleetTotalsModel, VehicleTotalsModel
+
+# Served from the rollups kept by the points consumer, see rollups.py.
+# Every route reads at most limit (or days) rollup documents
+
+# all, a UTC month (2022-05) or a UTC day (2022-05-01)
+PERIOD_PATTERN = r"^(all|\d{4}-\d{2}(-\d{2})?)$"
+DAY_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
+MAX_LEADERBOARD_SIZE = 1000
+MAX_SUMMARY_DAYS = 366
+
+
+router = APIRouter(
+    prefix="/api/stats",
+    tags=["stats"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.get("/drivers/leaderboard", response_description="Get top drivers by points", response_model=List[DriverLeaderboardEntryModel])
+async def get_driver_leaderboard(
+    period: str = Query("all", regex=PERIOD_PATTERN),
+    limit: int = Query(10, ge=1, le=MAX_LEADERBOARD_SIZE)
+):
+    rollups = await db[MongoDocumentsEnum.DRIVER_ROLLUPS.value].find(
+        {"period": period}
+    ).sort("points", -1).limit(limit).to_list(length=limit)
+
+    names = {
+        driver["_id"]: driver.get("full_name")
+        async for driver in db[MongoDocumentsEnum.DRIVERS.value].find(
+            {"_id": {"$in": [rollup["driver_id"] for rollup in rollups]}}, {"full_name": 1}
+        )
+    }
+    for rank, rollup in enumerate(rollups, 1):
+        rollup.update(rank=rank, full_name=names.get(rollup["driver_id"]))
+
+    return documents_response(rollups, DriverLeaderboardEntryModel)
+
+
+@router.get("/vehicles/leaderboard", response_description="Get vehicles that drove the most", response_model=List[VehicleTotalsModel])
+async def get_vehicle_leaderboard(
+    period: str = Query("all", regex=PERIOD_PATTERN),
+    limit: int = Query(10, ge=1, le=MAX_LEADERBOARD_SIZE)
+):
+    rollups = await db[MongoDocumentsEnum.VEHICLE_ROLLUPS.value].find(
+        {"period": period}
+    ).sort("distance_km", -1).limit(limit).to_list(length=limit)
+
+    return documents_response(rollups, VehicleTotalsModel)
+
+
+@router.get("/vehicles/{id}", response_description="Get distance and points of a vehicle", response_model=VehicleTotalsModel)
+async def show_vehicle_totals(id: str, period: str = Query("all", regex=PERIOD_PATTERN)):
+    if (rollup := await db[MongoDocumentsEnum.VEHICLE_ROLLUPS.value].find_one({"_id": f"{period}:{id}"})) is not None:
+        return document_response(rollup, VehicleTotalsModel)
+
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"No finished trips of vehicle {id} in {period}"
+    )
+
+
+@router.get("/vehicle-types", response_description="Get distance and points per vehicle type", response_model=List[FleetTotalsModel])
+async def get_vehicle_type_totals(period: str = Query("all", regex=PERIOD_PATTERN)):
+    rollups = await db[MongoDocumentsEnum.FLEET_ROLLUPS.value].find(
+        {"period": period, "vehicle_type": {"$ne": ALL_VEHICLE_TYPES}}
+    ).to_list(length=None)
+    rollups.sort(key=lambda rollup: rollup["distance_km"], reverse=True)
+
+    return documents_response(rollups, FleetTotalsModel)
+
+
+@router.get("/fleet/daily", response_description="Get fleet-wide totals per day", response_model=List[FleetTotalsModel])
+async def get_fleet_daily_summaries(
+    date_from: str = Query(..., regex=DAY_PATTERN, description="First UTC day, e.g. 2022-05-01"),
+    date_to: Optional[str] = Query(None, regex=DAY_PATTERN, description="Last UTC day, date_from by default")
+):
+    date_to = date_to or date_from
+    try:
+        days = (date.fromisoformat(date_to) - date.fromisoformat(date_from)).days + 1
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+
+    if not 1 <= days <= MAX_SUMMARY_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"date_to has to be on or after date_from, at most {MAX_SUMMARY_DAYS} days later"
+        )
+
+    rollups = await db[MongoDocumentsEnum.FLEET_ROLLUPS.value].find(
+        {"vehicle_type": ALL_VEHICLE_TYPES, "granularity": "day", "period": {"$gte": date_from, "$lte": date_to}}
+    ).sort("period", 1).to_list(length=days)
+
+    return documents_response(rollups, FleetTotalsModel)
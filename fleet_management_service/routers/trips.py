@@ -1,11 +1,19 @@
 from dependencies import db
 from pika_client import pika_client
 from mongo_documents import MongoDocumentsEnum
-from fastapi import APIRouter, Body, HTTPException, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Response, status
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
 from typing import List
-from models import TripModel, UpdateTripModel
+from collections import Counter
+from pagination import ListParameters, list_documents
+from responses import document_response
+from cache import cache
+from bulk import find_ids, insert_items, item_result
+from dispatch import DISPATCH_MAX_TRIPS, DISPATCH_OPTIMAL_MAX_TRIPS, dispatch
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from models import TripModel, UpdateTripModel, BulkItemResultModel, TripAssignmentModel, DispatchRequestModel, DispatchResultModel
 
 
 router = APIRouter(
@@ -16,29 +24,28 @@ router = APIRouter(
 
 
 @router.get("/", response_description="Get all trips", response_model=List[TripModel])
-async def get_all_trips():
-    trips = []
-
-    for result in await db[MongoDocumentsEnum.TRIPS.value].find().to_list(length=100):
-        trips.append(result)
-
-    return trips
+async def get_all_trips(response: Response, parameters: ListParameters = Depends()):
+    return await list_documents(db[MongoDocumentsEnum.TRIPS.value], response, parameters, TripModel)
 
 
 @router.post("/", response_description="Add new trip", response_model=TripModel)
 async def create_trip(trip: TripModel = Body(...)):
     trip = jsonable_encoder(trip)
-    new_trip = await db[MongoDocumentsEnum.TRIPS.value].insert_one(trip)
-    created_trip = await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": new_trip.inserted_id})
-    return JSONResponse(status_code=status.HTTP_201_CREATED, content=created_trip)
+    await db[MongoDocumentsEnum.TRIPS.value].insert_one(trip)
+    return JSONResponse(status_code=status.HTTP_201_CREATED, content=trip)
+
+
+@router.post("/bulk", response_description="Add new trips in bulk", response_model=List[BulkItemResultModel])
+async def create_trips_in_bulk(trips: List[dict] = Body(...)):
+    return await insert_items(db[MongoDocumentsEnum.TRIPS.value], TripModel, trips)
 
 
 @router.get(
     "/{id}", response_description="Get a single trip", response_model=TripModel
 )
 async def show_trip(id: str):
-    if (trip := await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": id})) is not None:
-        return trip
+    if (trip := await cache.get(MongoDocumentsEnum.TRIPS, id)) is not None:
+        return document_response(trip, TripModel)
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -51,16 +58,15 @@ async def update_trip(id: str, trip: UpdateTripModel = Body(...)):
     trip = {k: v for k, v in trip.dict().items() if v is not None}
 
     if len(trip) >= 1:
-        update_result = await db[MongoDocumentsEnum.TRIPS.value].update_one({"_id": id}, {"$set": trip})
-
-        if update_result.modified_count == 1:
-            if (
-                updated_trip := await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": id})
-            ) is not None:
-                return updated_trip
+        updated_trip = await db[MongoDocumentsEnum.TRIPS.value].find_one_and_update(
+            {"_id": id}, {"$set": trip}, return_document=ReturnDocument.AFTER
+        )
+        await cache.invalidate(MongoDocumentsEnum.TRIPS, id)
+    else:
+        updated_trip = await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": id})
 
-    if (existing_trip := await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": id})) is not None:
-        return existing_trip
+    if updated_trip is not None:
+        return updated_trip
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -71,6 +77,7 @@ async def update_trip(id: str, trip: UpdateTripModel = Body(...)):
 @router.delete("/{id}", response_description="Delete a trip")
 async def delete_trip(id: str):
     delete_result = await db[MongoDocumentsEnum.TRIPS.value].delete_one({"_id": id})
+    await cache.invalidate(MongoDocumentsEnum.TRIPS, id)
 
     if delete_result.deleted_count == 1:
         return JSONResponse(status_code=status.HTTP_200_OK)
@@ -87,47 +94,192 @@ async def delete_trip(id: str):
     response_model=TripModel
 )
 async def assign_vehicle_to_a_trip(trip_id: str, vehicle_id: str):
-    trip = await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": trip_id})
+    vehicle = await find_vehicle_with_driver(vehicle_id)
+
+    trip = None
+    if vehicle is not None and vehicle.get("driver_id", None) is not None:
+        # Completed trip doesn't match the filter, so it can't
+        # complete between the check and the update
+        trip = await db[MongoDocumentsEnum.TRIPS.value].find_one_and_update(
+            {"_id": trip_id, "trip_completed": {"$ne": True}},
+            {"$set": {"vehicle_id": vehicle_id}},
+            return_document=ReturnDocument.AFTER
+        )
+        await cache.invalidate(MongoDocumentsEnum.TRIPS, trip_id)
+
+    if trip is None:
+        await raise_assignment_error(trip_id, vehicle_id, vehicle)
+
+    await pika_client.send_message({
+        "vehicle_id": vehicle_id,
+        "trip_id": trip_id,
+        "driver_id": vehicle["driver_id"],
+        "depature_geo_point": trip["depature_geo_point"],
+        "destination_geo_point": trip["destination_geo_point"]
+    })
+
+    trip["vehicle"] = vehicle
+
+    return trip
+
+
+async def find_vehicle_with_driver(vehicle_id):
+    # Vehicle with its driver embedded, in a single round trip
+    vehicles = await db[MongoDocumentsEnum.VEHICLES.value].aggregate([
+        {"$match": {"_id": vehicle_id}},
+        {"$lookup": {
+            "from": MongoDocumentsEnum.DRIVERS.value,
+            "localField": "driver_id",
+            "foreignField": "_id",
+            "as": "driver"
+        }},
+        {"$set": {"driver": {"$arrayElemAt": ["$driver", 0]}}}
+    ]).to_list(length=1)
+
+    return vehicles[0] if vehicles else None
+
+
+async def raise_assignment_error(trip_id, vehicle_id, vehicle):
+    # Only reached when the assignment failed,
+    # reports the first failed check in the order they are documented
+    trip = await db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": trip_id}, {"trip_completed": 1})
     if trip is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Trip {trip_id} not found"
         )
 
-    if trip["trip_completed"]:
+    if trip.get("trip_completed", False):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Trip is already completed"
         )
 
-    vehicle = await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": vehicle_id})
     if vehicle is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Vehicle {vehicle_id} not found"
         )
 
-    trip["vehicle_id"] = vehicle.get("_id")
-
-    await db[MongoDocumentsEnum.TRIPS.value].update_one({"_id": trip_id}, {"$set": trip})
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"Vehicle doesn't have assigned any drivers"
+    )
 
-    driver_id = vehicle.get("driver_id", None)
 
-    if driver_id is None:
+@router.post(
+    "/bulk-assign",
+    response_description="Assign vehicles to trips in bulk",
+    response_model=List[BulkItemResultModel]
+)
+async def assign_vehicles_to_trips_in_bulk(assignments: List[TripAssignmentModel] = Body(...)):
+    trips = {
+        trip["_id"]: trip
+        async for trip in db[MongoDocumentsEnum.TRIPS.value].find(
+            {"_id": {"$in": list({assignment.trip_id for assignment in assignments})}},
+            {"depature_geo_point": 1, "destination_geo_point": 1, "trip_completed": 1}
+        )
+    }
+    vehicles = {
+        vehicle["_id"]: vehicle
+        async for vehicle in db[MongoDocumentsEnum.VEHICLES.value].find(
+            {"_id": {"$in": list({assignment.vehicle_id for assignment in assignments})}},
+            {"driver_id": 1}
+        )
+    }
+
+    # Trips are tagged with the id of this request, like dispatch does,
+    # to tell which of them were still not completed when written
+    dispatch_id = str(ObjectId())
+
+    # A trip or a vehicle in more than one assignment is ambiguous,
+    # none of its assignments are made
+    trip_counts = Counter(assignment.trip_id for assignment in assignments)
+    vehicle_counts = Counter(assignment.vehicle_id for assignment in assignments)
+
+    results, updates, dispatches = [], [], {}
+    for index, assignment in enumerate(assignments):
+        trip = trips.get(assignment.trip_id)
+        vehicle = vehicles.get(assignment.vehicle_id)
+
+        if trip_counts[assignment.trip_id] > 1:
+            results.append(item_result(
+                index, assignment.trip_id, status.HTTP_400_BAD_REQUEST, f"Trip {assignment.trip_id} is in more than one assignment"
+            ))
+        elif vehicle_counts[assignment.vehicle_id] > 1:
+            results.append(item_result(
+                index, assignment.trip_id, status.HTTP_400_BAD_REQUEST, f"Vehicle {assignment.vehicle_id} is in more than one assignment"
+            ))
+        elif trip is None:
+            results.append(item_result(
+                index, assignment.trip_id, status.HTTP_404_NOT_FOUND, f"Trip {assignment.trip_id} not found"
+            ))
+        elif trip.get("trip_completed"):
+            results.append(item_result(
+                index, assignment.trip_id, status.HTTP_400_BAD_REQUEST, "Trip is already completed"
+            ))
+        elif vehicle is None:
+            results.append(item_result(
+                index, assignment.trip_id, status.HTTP_404_NOT_FOUND, f"Vehicle {assignment.vehicle_id} not found"
+            ))
+        elif vehicle.get("driver_id", None) is None:
+            results.append(item_result(
+                index, assignment.trip_id, status.HTTP_400_BAD_REQUEST, "Vehicle doesn't have assigned any drivers"
+            ))
+        else:
+            updates.append(UpdateOne(
+                {"_id": assignment.trip_id, "trip_completed": {"$ne": True}},
+                {"$set": {"vehicle_id": assignment.vehicle_id, "dispatch_id": dispatch_id}}
+            ))
+            dispatches[index] = {
+                "vehicle_id": assignment.vehicle_id,
+                "trip_id": assignment.trip_id,
+                "driver_id": vehicle["driver_id"],
+                "depature_geo_point": trip["depature_geo_point"],
+                "destination_geo_point": trip["destination_geo_point"]
+            }
+            results.append(item_result(index, assignment.trip_id))
+
+    if updates:
+        trips_collection = db[MongoDocumentsEnum.TRIPS.value]
+        result = await trips_collection.bulk_write(updates, ordered=False)
+
+        assigned = set()
+        if result.matched_count == len(updates):
+            assigned = {dispatch["trip_id"] for dispatch in dispatches.values()}
+        elif result.matched_count:
+            assigned = await find_ids(trips_collection, {"dispatch_id": dispatch_id})
+        await cache.invalidate(MongoDocumentsEnum.TRIPS, *(dispatch["trip_id"] for dispatch in dispatches.values()))
+
+        # Trips completed since they were read aren't assigned
+        for index, dispatch in list(dispatches.items()):
+            if dispatch["trip_id"] not in assigned:
+                results[index] = item_result(index, dispatch["trip_id"], status.HTTP_409_CONFLICT, "Trip was completed meanwhile")
+                del dispatches[index]
+
+        if dispatches:
+            await pika_client.send_messages(list(dispatches.values()))
+
+    return results
+
+
+@router.post(
+    "/dispatch",
+    response_description="Assign the nearest available vehicles to pending trips",
+    response_model=DispatchResultModel
+)
+async def dispatch_pending_trips(request: DispatchRequestModel = Body(...)):
+    limit = request.limit or DISPATCH_MAX_TRIPS
+    trips = min(len(request.trip_ids), limit) if request.trip_ids is not None else limit
+    if trips > DISPATCH_MAX_TRIPS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Vehicle doesn't have assigned any drivers"
+            detail=f"At most {DISPATCH_MAX_TRIPS} trips can be dispatched at once"
+        )
+    if request.mode == "optimal" and trips > DISPATCH_OPTIMAL_MAX_TRIPS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Optimal mode takes at most {DISPATCH_OPTIMAL_MAX_TRIPS} trips, set limit or use greedy"
         )
 
-    # TODO update values
-    pika_client.send_message({
-        "vehicle_id": vehicle_id,
-        "trip_id": trip_id,
-        "driver_id": driver_id,
-        "depature_geo_point": trip["depature_geo_point"],
-        "destination_geo_point": trip["destination_geo_point"]
-    })
-
-    trip["vehicle"] = vehicle
-
-    return trip
+    return await dispatch(request.trip_ids, limit, request.mode, request.max_distance_km, request.dry_run)
@@ -1,10 +1,18 @@
 from dependencies import db
 from mongo_documents import MongoDocumentsEnum
-from fastapi import APIRouter, Body, HTTPException, status
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Response, status
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
-from typing import List
-from models import UpdateVehicleModel, VehicleModel
+from typing import List, Optional
+from collections import Counter
+from pagination import ListParameters, list_documents
+from responses import document_response, documents_response
+from cache import cache
+from bulk import DUPLICATE_KEY_ERROR, find_ids, insert_items, item_result
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from positions import vehicle_positions
+from models import UpdateVehicleModel, VehicleModel, BulkItemResultModel, VehicleAssignmentModel, VehiclePositionModel
 
 
 router = APIRouter(
@@ -15,29 +23,66 @@ router = APIRouter(
 
 
 @router.get("/", response_description="Get all vehicles", response_model=List[VehicleModel])
-async def get_all_vehicles():
-    vehicles = []
-
-    for result in await db[MongoDocumentsEnum.VEHICLES.value].find().to_list(length=100):
-        vehicles.append(result)
-
-    return vehicles
+async def get_all_vehicles(response: Response, parameters: ListParameters = Depends()):
+    return await list_documents(db[MongoDocumentsEnum.VEHICLES.value], response, parameters, VehicleModel)
 
 
 @router.post("/", response_description="Add new vehicle", response_model=VehicleModel)
 async def create_vehicle(vehicle: VehicleModel = Body(...)):
     vehicle = jsonable_encoder(vehicle)
-    new_vehicle = await db[MongoDocumentsEnum.VEHICLES.value].insert_one(vehicle)
-    created_vehicle = await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": new_vehicle.inserted_id})
-    return JSONResponse(status_code=status.HTTP_201_CREATED, content=created_vehicle)
+    await db[MongoDocumentsEnum.VEHICLES.value].insert_one(vehicle)
+    return JSONResponse(status_code=status.HTTP_201_CREATED, content=vehicle)
+
+
+@router.post("/bulk", response_description="Add new vehicles in bulk", response_model=List[BulkItemResultModel])
+async def create_vehicles_in_bulk(vehicles: List[dict] = Body(...)):
+    return await insert_items(db[MongoDocumentsEnum.VEHICLES.value], VehicleModel, vehicles)
+
+
+# Position routes are declared before /{id}, which would match them otherwise
+@router.get("/nearby", response_description="Get vehicles within a radius, nearest first", response_model=List[VehiclePositionModel])
+async def get_nearby_vehicles(
+    lat: float = Query(..., ge=-90, le=90),
+    long: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(..., gt=0, le=20000),
+    limit: Optional[int] = Query(None, ge=1)
+):
+    return documents_response(vehicle_positions.nearby(lat, long, radius_km, limit), VehiclePositionModel)
+
+
+@router.get("/within", response_description="Get vehicles within a bounding box", response_model=List[VehiclePositionModel])
+async def get_vehicles_within(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_long: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_long: float = Query(..., ge=-180, le=180)
+):
+    if min_lat > max_lat:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="min_lat has to be less than or equal to max_lat"
+        )
+
+    return documents_response(vehicle_positions.within(min_lat, min_long, max_lat, max_long), VehiclePositionModel)
+
+
+@router.get("/{id}/position", response_description="Get the latest position of a vehicle", response_model=VehiclePositionModel)
+async def show_vehicle_position(id: str):
+    if (position := vehicle_positions.get(id)) is not None:
+        return document_response(position, VehiclePositionModel)
+
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"Position of vehicle {id} not found"
+    )
 
 
 @router.get(
     "/{id}", response_description="Get a single vehicle", response_model=VehicleModel
 )
 async def show_vehicle(id: str):
-    if (vehicle := await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": id})) is not None:
-        return vehicle
+    if (vehicle := await cache.get(MongoDocumentsEnum.VEHICLES, id)) is not None:
+        return document_response(vehicle, VehicleModel)
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -50,16 +95,15 @@ async def update_vehicle(id: str, vehicle: UpdateVehicleModel = Body(...)):
     vehicle = {k: v for k, v in vehicle.dict().items() if v is not None}
 
     if len(vehicle) >= 1:
-        update_result = await db[MongoDocumentsEnum.VEHICLES.value].update_one({"_id": id}, {"$set": vehicle})
-
-        if update_result.modified_count == 1:
-            if (
-                updated_vehicle := await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": id})
-            ) is not None:
-                return updated_vehicle
+        updated_vehicle = await db[MongoDocumentsEnum.VEHICLES.value].find_one_and_update(
+            {"_id": id}, {"$set": vehicle}, return_document=ReturnDocument.AFTER
+        )
+        await cache.invalidate(MongoDocumentsEnum.VEHICLES, id)
+    else:
+        updated_vehicle = await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": id})
 
-    if (existing_vehicle := await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": id})) is not None:
-        return existing_vehicle
+    if updated_vehicle is not None:
+        return updated_vehicle
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -70,6 +114,8 @@ async def update_vehicle(id: str, vehicle: UpdateVehicleModel = Body(...)):
 @router.delete("/{id}", response_description="Delete a vehicle")
 async def delete_vehicle(id: str):
     delete_result = await db[MongoDocumentsEnum.VEHICLES.value].delete_one({"_id": id})
+    await cache.invalidate(MongoDocumentsEnum.VEHICLES, id)
+    vehicle_positions.remove(id)
 
     if delete_result.deleted_count == 1:
         return JSONResponse(status_code=status.HTTP_200_OK)
@@ -86,32 +132,111 @@ async def delete_vehicle(id: str):
     response_model=VehicleModel
 )
 async def assign_driver_to_a_vehicle(vehicle_id: str, driver_id: str):
-    vehicle = await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": vehicle_id})
+    driver = await cache.get(MongoDocumentsEnum.DRIVERS, driver_id)
+
+    vehicle = None
+    if driver is not None:
+        try:
+            # Unique index on driver_id rejects a driver
+            # that is already assigned to another vehicle
+            vehicle = await db[MongoDocumentsEnum.VEHICLES.value].find_one_and_update(
+                {"_id": vehicle_id, "driver_id": {"$ne": driver_id}},
+                {"$set": {"driver_id": driver_id}},
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            vehicle = None
+
+        await cache.invalidate(MongoDocumentsEnum.VEHICLES, vehicle_id)
+
     if vehicle is None:
+        await raise_assignment_error(vehicle_id, driver_id, driver)
+
+    vehicle["driver"] = driver
+
+    return vehicle
+
+
+async def raise_assignment_error(vehicle_id, driver_id, driver):
+    # Only reached when the assignment failed,
+    # reports the first failed check in the order they are documented
+    if await db[MongoDocumentsEnum.VEHICLES.value].find_one({"_id": vehicle_id}, {"_id": 1}) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Vehicle {vehicle_id} not found"
         )
 
-    driver_assigned = await db[MongoDocumentsEnum.VEHICLES.value].find_one({"driver_id": driver_id})
-
-    if driver_assigned:
+    if driver is not None or await db[MongoDocumentsEnum.VEHICLES.value].find_one({"driver_id": driver_id}, {"_id": 1}):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Driver {driver_id} already assigned a vehicle"
         )
 
-    driver = await db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": driver_id})
-    if driver is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Driver {driver_id} not found"
-        )
-
-    vehicle["driver_id"] = driver.get("_id")
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"Driver {driver_id} not found"
+    )
 
-    await db[MongoDocumentsEnum.VEHICLES.value].update_one({"_id": vehicle_id}, {"$set": vehicle})
 
-    vehicle["driver"] = driver
+@router.post(
+    "/bulk-assign",
+    response_description="Assign drivers to vehicles in bulk",
+    response_model=List[BulkItemResultModel]
+)
+async def assign_drivers_to_vehicles_in_bulk(assignments: List[VehicleAssignmentModel] = Body(...)):
+    vehicle_ids = await find_ids(
+        db[MongoDocumentsEnum.VEHICLES.value],
+        {"_id": {"$in": list({assignment.vehicle_id for assignment in assignments})}}
+    )
+    driver_ids = await find_ids(
+        db[MongoDocumentsEnum.DRIVERS.value],
+        {"_id": {"$in": list({assignment.driver_id for assignment in assignments})}}
+    )
+    assigned_driver_ids = await find_ids(
+        db[MongoDocumentsEnum.VEHICLES.value],
+        {"driver_id": {"$in": list(driver_ids)}},
+        field="driver_id"
+    )
 
-    return vehicle
+    # A vehicle in more than one assignment is ambiguous, none of them are made
+    vehicle_counts = Counter(assignment.vehicle_id for assignment in assignments)
+
+    results, updates, update_indexes = [], [], []
+    for index, assignment in enumerate(assignments):
+        if vehicle_counts[assignment.vehicle_id] > 1:
+            results.append(item_result(
+                index, assignment.vehicle_id, status.HTTP_400_BAD_REQUEST, f"Vehicle {assignment.vehicle_id} is in more than one assignment"
+            ))
+        elif assignment.vehicle_id not in vehicle_ids:
+            results.append(item_result(
+                index, assignment.vehicle_id, status.HTTP_404_NOT_FOUND, f"Vehicle {assignment.vehicle_id} not found"
+            ))
+        elif assignment.driver_id in assigned_driver_ids:
+            results.append(item_result(
+                index, assignment.vehicle_id, status.HTTP_400_BAD_REQUEST, f"Driver {assignment.driver_id} already assigned a vehicle"
+            ))
+        elif assignment.driver_id not in driver_ids:
+            results.append(item_result(
+                index, assignment.vehicle_id, status.HTTP_404_NOT_FOUND, f"Driver {assignment.driver_id} not found"
+            ))
+        else:
+            assigned_driver_ids.add(assignment.driver_id)
+            updates.append(UpdateOne({"_id": assignment.vehicle_id}, {"$set": {"driver_id": assignment.driver_id}}))
+            update_indexes.append(index)
+            results.append(item_result(index, assignment.vehicle_id))
+
+    if updates:
+        try:
+            await db[MongoDocumentsEnum.VEHICLES.value].bulk_write(updates, ordered=False)
+        except BulkWriteError as error:
+            # Unique index on driver_id, driver was assigned in the meantime
+            for write_error in error.details["writeErrors"]:
+                index = update_indexes[write_error["index"]]
+                detail = write_error["errmsg"]
+                if write_error["code"] == DUPLICATE_KEY_ERROR:
+                    detail = f"Driver {assignments[index].driver_id} already assigned a vehicle"
+                results[index] = item_result(index, assignments[index].vehicle_id, status.HTTP_400_BAD_REQUEST, detail)
+
+        await cache.invalidate(MongoDocumentsEnum.VEHICLES, *(assignments[index].vehicle_id for index in update_indexes))
+
+    return results
@@ -0,0 +1,52 @@
+import os
+import sys
+import pytest
+
+# Modules of the service import each other by name, as when run from its folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+httpx = pytest.importorskip("httpx")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    # Every module that imported db gets the same in-memory database
+    import cache
+    import consumers
+    import dispatch
+    import indexes
+    import rollups
+    from routers import drivers, trips, vehicles
+
+    monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "with_options", lambda collection, **options: collection, raising=False)
+    database = mongomock_motor.AsyncMongoMockClient().fleet_management_service
+    for module in (cache, consumers, dispatch, indexes, rollups, drivers, trips, vehicles):
+        monkeypatch.setattr(module, "db", database)
+    return database
+
+
+@pytest.fixture
+def sent_messages(monkeypatch):
+    from pika_client import pika_client
+
+    sent = []
+
+    async def send_messages(messages):
+        sent.extend(messages)
+
+    monkeypatch.setattr(pika_client, "send_messages", send_messages)
+    return sent
+
+
+@pytest.fixture
+async def client(fake_db, sent_messages):
+    from main import app
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://fms") as client:
+        yield client
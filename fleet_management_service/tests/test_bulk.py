@@ -0,0 +1,20 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_duplicates_in_the_request_are_bad_requests(client):
+    # A trip or vehicle in more than one assignment fails the same way on every endpoint
+    response = await client.post("/api/trips/bulk-assign", json=[
+        {"trip_id": "trip-1", "vehicle_id": "vehicle-1"},
+        {"trip_id": "trip-1", "vehicle_id": "vehicle-2"},
+        {"trip_id": "trip-2", "vehicle_id": "vehicle-3"},
+        {"trip_id": "trip-3", "vehicle_id": "vehicle-3"}
+    ])
+    assert [result["status"] for result in response.json()] == [400] * 4
+
+    response = await client.post("/api/vehicles/bulk-assign", json=[
+        {"vehicle_id": "vehicle-1", "driver_id": "driver-1"},
+        {"vehicle_id": "vehicle-1", "driver_id": "driver-2"}
+    ])
+    assert [result["status"] for result in response.json()] == [400] * 2
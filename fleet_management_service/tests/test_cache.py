@@ -0,0 +1,101 @@
+import pytest
+from cache import DocumentCache, LocalCacheBackend, RedisCacheBackend, cache
+from mongo_documents import MongoDocumentsEnum
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeRedis:
+    # The part of redis.asyncio.Redis the cache uses, expiry is ignored
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, px=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    async def dbsize(self):
+        return len(self.values)
+
+
+@pytest.fixture(params=["local", "redis"])
+def backend(request, monkeypatch):
+    backend = LocalCacheBackend() if request.param == "local" else RedisCacheBackend(FakeRedis())
+    monkeypatch.setattr(cache, "backend", backend)
+    return backend
+
+
+async def test_no_stale_read_after_update(client, backend):
+    driver = (await client.post("/api/drivers/", json={"full_name": "Old Name", "points": 1})).json()
+    assert (await client.get(f"/api/drivers/{driver['_id']}")).json()["full_name"] == "Old Name"
+    assert await backend.get(DocumentCache.key(MongoDocumentsEnum.DRIVERS, driver["_id"])) is not None
+
+    await client.put(f"/api/drivers/{driver['_id']}", json={"full_name": "New Name"})
+
+    assert (await client.get(f"/api/drivers/{driver['_id']}")).json()["full_name"] == "New Name"
+
+
+async def test_no_stale_read_after_delete(client, backend):
+    vehicle = (await client.post("/api/vehicles/", json={"type": "Truck", "registration": "ABC-0-EFG"})).json()
+    assert (await client.get(f"/api/vehicles/{vehicle['_id']}")).status_code == 200
+
+    await client.delete(f"/api/vehicles/{vehicle['_id']}")
+
+    assert (await client.get(f"/api/vehicles/{vehicle['_id']}")).status_code == 404
+
+
+async def test_no_stale_read_after_assignment(client, backend):
+    driver = (await client.post("/api/drivers/", json={"full_name": "John Doe", "points": 0})).json()
+    vehicle = (await client.post("/api/vehicles/", json={"type": "Truck", "registration": "ABC-0-EFG"})).json()
+    trip = (await client.post("/api/trips/", json={
+        "depature_geo_point": {"lat": 43.85, "long": 18.38},
+        "destination_geo_point": {"lat": 43.86, "long": 18.4}
+    })).json()
+    await client.get(f"/api/vehicles/{vehicle['_id']}")
+    await client.get(f"/api/trips/{trip['_id']}")
+
+    response = await client.put(f"/api/vehicles/{vehicle['_id']}/assign_driver/{driver['_id']}")
+    assert response.status_code == 200
+    assert (await cache.get(MongoDocumentsEnum.VEHICLES, vehicle["_id"]))["driver_id"] == driver["_id"]
+
+    response = await client.put(f"/api/trips/{trip['_id']}/assign_vehicle/{vehicle['_id']}")
+    assert response.status_code == 200
+    assert (await cache.get(MongoDocumentsEnum.TRIPS, trip["_id"]))["vehicle_id"] == vehicle["_id"]
+
+
+async def test_no_stale_read_after_bulk_assignment(client, backend):
+    driver = (await client.post("/api/drivers/", json={"full_name": "John Doe", "points": 0})).json()
+    vehicle = (await client.post("/api/vehicles/", json={"type": "Truck", "registration": "ABC-0-EFG"})).json()
+    await client.get(f"/api/vehicles/{vehicle['_id']}")
+
+    response = await client.post("/api/vehicles/bulk-assign", json=[{"vehicle_id": vehicle["_id"], "driver_id": driver["_id"]}])
+    assert response.json()[0]["status"] == 200
+
+    assert (await cache.get(MongoDocumentsEnum.VEHICLES, vehicle["_id"]))["driver_id"] == driver["_id"]
+
+
+async def test_shared_backend_skips_document_loaded_before_write_in_another_process(fake_db, monkeypatch):
+    # Two processes share Redis, one invalidates while the other loads
+    backend = RedisCacheBackend(FakeRedis())
+    reader, writer = DocumentCache(backend), DocumentCache(backend)
+    await fake_db.drivers.insert_one({"_id": "driver", "full_name": "Old Name", "points": 0})
+
+    collection = type(fake_db.drivers)
+    find_one = collection.find_one
+
+    async def find_one_then_write(self, *args, **kwargs):
+        loaded = await find_one(self, *args, **kwargs)
+        await fake_db.drivers.update_one({"_id": "driver"}, {"$set": {"full_name": "New Name"}})
+        await writer.invalidate(MongoDocumentsEnum.DRIVERS, "driver")
+        return loaded
+
+    monkeypatch.setattr(collection, "find_one", find_one_then_write)
+    assert (await reader.get(MongoDocumentsEnum.DRIVERS, "driver"))["full_name"] == "Old Name"
+    monkeypatch.setattr(collection, "find_one", find_one)
+
+    assert (await reader.get(MongoDocumentsEnum.DRIVERS, "driver"))["full_name"] == "New Name"
@@ -0,0 +1,27 @@
+import pytest
+import dispatch
+from mongo_documents import MongoDocumentsEnum
+
+pytestmark = pytest.mark.anyio
+
+
+def trip(trip_id):
+    point = {"lat": 43.85, "long": 18.38}
+    return {"_id": trip_id, "depature_geo_point": point, "destination_geo_point": point, "trip_completed": False}
+
+
+async def test_vehicle_taken_meanwhile_is_not_double_booked(fake_db, sent_messages):
+    trips = fake_db[MongoDocumentsEnum.TRIPS.value]
+    await trips.insert_many([trip("trip-1"), trip("trip-2")])
+    vehicles = [{"_id": "vehicle-1", "driver_id": "driver-1"}, {"_id": "vehicle-2", "driver_id": "driver-2"}]
+
+    # vehicle-1 was found available, then given a trip through the trips API
+    await trips.insert_one({**trip("manual"), "vehicle_id": "vehicle-1"})
+
+    assigned = await dispatch.apply_assignments([(trip("trip-1"), vehicles[0], 1.0), (trip("trip-2"), vehicles[1], 1.0)])
+
+    assert assigned == {"trip-2"}
+    assert [message["trip_id"] for message in sent_messages] == ["trip-2"]
+    released = await trips.find_one({"_id": "trip-1"})
+    assert "vehicle_id" not in released and "dispatch_id" not in released
+    assert (await trips.find_one({"_id": "trip-2"}))["vehicle_id"] == "vehicle-2"
@@ -0,0 +1,21 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_fields_of_the_model_are_returned(client):
+    await client.post("/api/drivers/", json={"full_name": "John Doe", "points": 3})
+
+    response = await client.get("/api/drivers/", params={"fields": "full_name,points"})
+    assert response.status_code == 200
+    assert [{key: value for key, value in driver.items() if key != "_id"} for driver in response.json()] == [{"full_name": "John Doe", "points": 3}]
+
+
+@pytest.mark.parametrize("fields", ["password", "$where", "full_name.first", "points,$expr"])
+async def test_other_fields_are_bad_requests(client, fields):
+    for path in ("/api/drivers/", "/api/vehicles/", "/api/trips/"):
+        response = await client.get(path, params={"fields": fields})
+        assert response.status_code == 400, path
+
+    response = await client.get("/api/drivers/", params={"fields": fields, "stream": "true"})
+    assert response.status_code == 400
@@ -0,0 +1,61 @@
+import pytest
+import mongomock_motor
+from consumers import PointsBatcher
+from mongo_documents import MongoDocumentsEnum
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def failing_trips_write(monkeypatch):
+    # The trips write, after the driver write, fails once
+    failures = {"left": 1}
+    bulk_write = mongomock_motor.AsyncMongoMockCollection.bulk_write
+
+    async def flaky_bulk_write(collection, *args, **kwargs):
+        if collection.name == MongoDocumentsEnum.TRIPS.value and failures["left"]:
+            failures["left"] -= 1
+            raise RuntimeError("connection lost")
+        return await bulk_write(collection, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "bulk_write", flaky_bulk_write)
+    return failures
+
+
+def points_message(points, **fields):
+    return {"trip_id": "trip-1", "driver_id": "driver-1", "vehicle_id": None, "points": points, "finished_at": 1650000000, **fields}
+
+
+async def setup_documents(fake_db):
+    await fake_db[MongoDocumentsEnum.DRIVERS.value].insert_one({"_id": "driver-1", "full_name": "Driver", "points": 0})
+    await fake_db[MongoDocumentsEnum.TRIPS.value].insert_one({"_id": "trip-1"})
+
+
+async def test_redelivered_points_are_applied_once(fake_db, failing_trips_write):
+    await setup_documents(fake_db)
+    batcher = PointsBatcher(batch_size=1)
+
+    with pytest.raises(RuntimeError):
+        await batcher.add(points_message(10))
+    await batcher.add(points_message(10))
+    await batcher.add(points_message(10))
+
+    driver = await fake_db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": "driver-1"})
+    assert driver["points"] == 10
+    assert driver["applied_credits"] == []
+    assert (await fake_db[MongoDocumentsEnum.TRIPS.value].find_one({"_id": "trip-1"}))["trip_completed"]
+
+
+async def test_correction_before_redelivery_is_applied_once(fake_db, failing_trips_write):
+    await setup_documents(fake_db)
+    batcher = PointsBatcher(batch_size=1)
+
+    with pytest.raises(RuntimeError):
+        await batcher.add(points_message(10))
+    await batcher.add(points_message(12, previous_points=10))
+    await batcher.add(points_message(10))
+
+    driver = await fake_db[MongoDocumentsEnum.DRIVERS.value].find_one({"_id": "driver-1"})
+    assert driver["points"] == 12
+    result = await fake_db[MongoDocumentsEnum.TRIP_RESULTS.value].find_one({"_id": "trip-1"})
+    assert result["pending_points"] == 0 and result["credits"] == []
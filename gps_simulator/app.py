@@ -1,24 +1,29 @@
 from dotenv import load_dotenv
-import json
 import os
 import asyncio
+import logging
 import aio_pika
 import random
 from datetime import datetime
 import calendar
+from consumer_runtime import WorkerPool, declare_gps_data_exchange, declare_partition_queues, declare_queue, partition_queue_name
+from codec import encode_message
+from metrics import MESSAGES_PUBLISHED, span, start_exporter, trace_headers
 
 
 load_dotenv()
 
 
-async def publish(channel, body, queue_name):
-    await channel.default_exchange.publish(
+async def publish(exchange, body, queue_name):
+    await exchange.publish(
         aio_pika.Message(
-            body=json.dumps(body).encode(),
-            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            **encode_message(body),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            headers=trace_headers(body.get("trip_id", None))
         ),
         routing_key=queue_name
     )
+    MESSAGES_PUBLISHED.labels(queue=queue_name).inc()
 
 
 def get_negative_or_positive():
@@ -32,14 +37,16 @@ def get_current_timestamp():
     return current_timestamp
 
 
-async def consumer_handler(message, sending_channel):
-    send_gps_data_queue = os.environ.get("SEND_GPS_DATA_QUEUE")
+async def consumer_handler(message, sending_exchange):
     depature_geo_point = message.get("depature_geo_point", None)
     destination_geo_point = message.get("destination_geo_point", None)
     driver_id = message.get("driver_id", None)
     trip_id = message.get("trip_id", None)
     vehicle_id = message.get("vehicle_id", None)
 
+    # All points of a trip go to the same partition, so they stay in order
+    send_gps_data_queue = partition_queue_name(os.environ.get("SEND_GPS_DATA_QUEUE"), trip_id)
+
     number_of_points = random.randint(5, 10)
     dep_lat, dep_long = depature_geo_point["lat"], depature_geo_point["long"]
     dest_lat, dest_long = destination_geo_point["lat"], destination_geo_point["long"]
@@ -56,7 +63,7 @@ async def consumer_handler(message, sending_channel):
         "timestamp": get_current_timestamp()
     }
 
-    await publish(sending_channel, body, send_gps_data_queue)
+    await publish(sending_exchange, body, send_gps_data_queue)
 
     await asyncio.sleep(2)
 
@@ -83,7 +90,7 @@ async def consumer_handler(message, sending_channel):
             "timestamp": get_current_timestamp()
 
         }
-        await publish(sending_channel, body, send_gps_data_queue)
+        await publish(sending_exchange, body, send_gps_data_queue)
         await asyncio.sleep(2)
 
     dep_lat, dep_long = dest_lat, dest_long
@@ -103,11 +110,14 @@ async def consumer_handler(message, sending_channel):
 
     }
 
-    await publish(sending_channel, body, send_gps_data_queue)
+    with span("gps_published", trip_id):
+        await publish(sending_exchange, body, send_gps_data_queue)
     await asyncio.sleep(2)
 
 
 async def main() -> None:
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+    await start_exporter()
     connection = await aio_pika.connect_robust(
         host=os.environ.get('RABBITMQ_HOST'),
         port=5672,
@@ -119,36 +129,34 @@ async def main() -> None:
     async with connection:
         channel = await connection.channel()
 
-        await channel.set_qos(prefetch_count=10)
-
-        queue = await channel.declare_queue(
-            queue_name,
-            durable=True,
-            exclusive=False,
-            auto_delete=False
+        sending_channel = await connection.channel()
+        sending_exchange = await declare_gps_data_exchange(sending_channel)
+
+        # Trip is acked once all of its GPS points are published
+        pool = WorkerPool(
+            lambda message: consumer_handler(
+                message=message,
+                sending_exchange=sending_exchange
+            )
         )
 
-        sending_channel = await connection.channel()
+        await channel.set_qos(prefetch_count=pool.prefetch_count)
 
-        await channel.declare_queue(
-            send_gps_data_queue,
-            durable=True,
-            exclusive=False,
-            auto_delete=False
-        )
+        queue = await declare_queue(channel, queue_name)
+
+        # Partitions are bound before the first message is published,
+        # messages the exchange can't route are dropped
+        await declare_partition_queues(channel, send_gps_data_queue, sending_exchange)
+
+        pool.start()
 
         async with queue.iterator() as queue_iter:
             async for message in queue_iter:
-                async with message.process():
-                    loop = asyncio.get_running_loop()
-                    loop.create_task(
-                        consumer_handler(
-                            message=json.loads(message.body),
-                            sending_channel=sending_channel
-                        )
-                    )
-                    if queue.name in message.body.decode():
-                        break
+                await pool.submit(message)
+                if queue.name in message.body.decode(errors="replace"):
+                    break
+
+            await pool.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+import os
+import json
+from datetime import date, datetime
+from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+load_dotenv()
+
+# Same module is used by all three services, every service is built
+# from its own folder so each one keeps a copy.
+#
+# Messages are published as JSON, or as msgpack with MESSAGE_FORMAT=msgpack.
+# The format and its version go in the content type of every message and
+# consumers decode whatever they get, so consumers are upgraded first and
+# publishers are switched to msgpack after them. A message without a
+# content type is JSON, like everything published before the codec
+MESSAGE_FORMAT = os.environ.get("MESSAGE_FORMAT", "json").lower()
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/x-msgpack"
+MSGPACK_VERSION = 1
+
+if MESSAGE_FORMAT not in ("json", "msgpack"):
+    raise ValueError(f"Unknown MESSAGE_FORMAT {MESSAGE_FORMAT}, expected json or msgpack")
+if MESSAGE_FORMAT == "msgpack" and msgpack is None:
+    raise ImportError("MESSAGE_FORMAT is msgpack, pip install msgpack")
+
+
+def default(value):
+    # ObjectId and anything else without a JSON type becomes a str
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+if orjson is not None:
+    def dumps(value):
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    def dumps(value):
+        return json.dumps(value, default=default).encode()
+
+    loads = json.loads
+
+
+def encode_message(body, message_format=MESSAGE_FORMAT):
+    # Keyword arguments of aio_pika.Message: aio_pika.Message(**encode_message(body), ...)
+    if message_format == "msgpack":
+        return {
+            "body": msgpack.packb(body, default=default),
+            "content_type": f"{MSGPACK_CONTENT_TYPE}; version={MSGPACK_VERSION}"
+        }
+    return {"body": dumps(body), "content_type": JSON_CONTENT_TYPE}
+
+
+def decode_message(body, content_type=None):
+    # Raises ValueError for a body or format it can't decode
+    media_type, _, parameters = (content_type or JSON_CONTENT_TYPE).partition(";")
+    media_type = media_type.strip().lower()
+
+    if media_type == MSGPACK_CONTENT_TYPE:
+        parameters = dict(
+            parameter.strip().partition("=")[::2] for parameter in parameters.split(";") if parameter.strip()
+        )
+        if parameters.get("version", str(MSGPACK_VERSION)) != str(MSGPACK_VERSION):
+            raise ValueError(f"Unsupported msgpack message version {parameters['version']}")
+        if msgpack is None:
+            raise ValueError("Got a msgpack message, pip install msgpack")
+        return msgpack.unpackb(body)
+
+    if media_type != JSON_CONTENT_TYPE:
+        raise ValueError(f"Unsupported message content type {content_type}")
+    return loads(body)
@@ -0,0 +1,224 @@
+from dotenv import load_dotenv
+import os
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import aio_pika
+from consumer_runtime import declare_gps_data_exchange, declare_partition_queues, lane_of, partition_queue_name
+from codec import encode_message
+from metrics import MESSAGES_PUBLISHED, start_exporter
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Publishes GPS data of many simulated vehicles at a fixed rate,
+# without waiting for trips from the fleet management service.
+# Every vehicle drives trips of random length one after another,
+# a trip starts and ends standing still like the ones of app.py
+
+EARTH_RADIUS_KM = 6371
+MAX_SPEED = 200
+
+
+class VehicleSimulation:
+    def __init__(self, rng, index, arguments):
+        self.rng = rng
+        self.arguments = arguments
+        self.index = index
+        self.vehicle_id = f"load-vehicle-{arguments.seed}-{index}"
+        self.driver_id = f"load-driver-{arguments.seed}-{index}"
+        self.trips = 0
+
+        self.lat = arguments.center_lat + rng.uniform(-arguments.spread_degrees, arguments.spread_degrees)
+        self.long = arguments.center_long + rng.uniform(-arguments.spread_degrees, arguments.spread_degrees)
+        self.start_trip()
+
+    def start_trip(self):
+        self.trips += 1
+        self.trip_id = f"load-trip-{self.arguments.seed}-{self.index}-{self.trips}"
+        length = self.arguments.trip_length
+        self.remaining = max(2, self.rng.randint(length // 2, length * 3 // 2))
+        self.heading = self.rng.uniform(0, 2 * math.pi)
+        self.cruise_speed = self.random_speed()
+        self.speed = 0
+
+    def random_speed(self):
+        if self.arguments.speed_distribution == "uniform":
+            speed = self.rng.uniform(self.arguments.speed_mean - self.arguments.speed_stddev, self.arguments.speed_mean + self.arguments.speed_stddev)
+        else:
+            speed = self.rng.gauss(self.arguments.speed_mean, self.arguments.speed_stddev)
+        return min(max(speed, 0), MAX_SPEED)
+
+    def move(self, seconds):
+        # Heading and speed drift a little between pings
+        self.heading += self.rng.gauss(0, 0.1)
+        self.speed = min(max(self.speed + self.rng.gauss(0, 3), 0), MAX_SPEED)
+
+        distance_km = self.speed * seconds / 3600
+        self.lat += math.degrees(distance_km * math.cos(self.heading) / EARTH_RADIUS_KM)
+        self.long += math.degrees(distance_km * math.sin(self.heading) / (EARTH_RADIUS_KM * max(math.cos(math.radians(self.lat)), 0.01)))
+        self.lat = min(max(self.lat, -89.9), 89.9)
+        self.long = (self.long + 180) % 360 - 180
+
+    def next_ping(self, timestamp):
+        body = {
+            "current_geo_point": {
+                "lat": self.lat,
+                "long": self.long
+            },
+            "speed": self.speed,
+            "driver_id": self.driver_id,
+            "trip_id": self.trip_id,
+            "vehicle_id": self.vehicle_id,
+            "timestamp": timestamp
+        }
+
+        self.remaining -= 1
+        if self.remaining == 0:
+            body["speed"] = 0
+            body["trip_finished"] = True
+            self.start_trip()
+        else:
+            if self.speed == 0:
+                self.speed = self.cruise_speed
+            self.move(1 / self.arguments.ping_rate)
+
+        return body
+
+
+class Publisher:
+    # One channel, publishing whatever was queued in batches.
+    # Messages of a trip always go through the same publisher, so they stay in order
+    def __init__(self, exchange, queue_name, batch_size, queue_size):
+        self.exchange = exchange
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(queue_size)
+        self.published = 0
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            await asyncio.gather(*(
+                self.exchange.publish(
+                    aio_pika.Message(
+                        **encode_message(body),
+                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+                    ),
+                    routing_key=partition_queue_name(self.queue_name, body["trip_id"])
+                )
+                for body in batch
+            ))
+
+            self.published += len(batch)
+            for body in batch:
+                MESSAGES_PUBLISHED.labels(queue=partition_queue_name(self.queue_name, body["trip_id"])).inc()
+                self.queue.task_done()
+
+
+def report(started, now, rate, published, last):
+    # Lag is how far publishing is behind the schedule, in seconds
+    last_time, last_published = last
+    achieved = (published - last_published) / max(now - last_time, 1e-9)
+    lag = max(now - started - published / rate, 0)
+    logger.info("Published %d messages, %.0f msgs/s (target %.0f), lag %.2f s", published, achieved, rate, lag)
+    return now, published
+
+
+async def run(arguments):
+    rng = random.Random(arguments.seed)
+    vehicles = [VehicleSimulation(rng, index, arguments) for index in range(arguments.vehicles)]
+    rate = arguments.vehicles * arguments.ping_rate
+    queue_name = os.environ.get("SEND_GPS_DATA_QUEUE")
+
+    connection = await aio_pika.connect_robust(
+        host=os.environ.get('RABBITMQ_HOST'),
+        port=5672,
+    )
+
+    await start_exporter()
+
+    async with connection:
+        channel = await connection.channel()
+        exchange = await declare_gps_data_exchange(channel)
+        await declare_partition_queues(channel, queue_name, exchange)
+
+        publishers = []
+        for _ in range(arguments.channels):
+            publishing_channel = await connection.channel(publisher_confirms=arguments.confirms)
+            publishing_exchange = await declare_gps_data_exchange(publishing_channel)
+            publishers.append(Publisher(publishing_exchange, queue_name, arguments.batch_size, arguments.batch_size * 4))
+        tasks = [asyncio.create_task(publisher.run()) for publisher in publishers]
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        scheduled, vehicle_index = 0, 0
+        last = (started, 0)
+        next_report = started + arguments.report_interval
+        total = int(rate * arguments.duration)
+
+        # Vehicles ping round robin, every one of them at ping_rate.
+        # Queues are bounded, a slow broker shows up as lag
+        while scheduled < total:
+            now = loop.time()
+            due = min(int(rate * (now - started)), total) - scheduled
+            timestamp = int(time.time())
+
+            for _ in range(due):
+                body = vehicles[vehicle_index].next_ping(timestamp)
+                vehicle_index = (vehicle_index + 1) % len(vehicles)
+                await publishers[lane_of(body["trip_id"], len(publishers))].queue.put(body)
+                scheduled += 1
+
+            if now >= next_report:
+                last = report(started, now, rate, sum(publisher.published for publisher in publishers), last)
+                next_report += arguments.report_interval
+
+            await asyncio.sleep(arguments.tick_ms / 1000)
+
+        for publisher in publishers:
+            await publisher.queue.join()
+        for task in tasks:
+            task.cancel()
+
+        elapsed = loop.time() - started
+        published = sum(publisher.published for publisher in publishers)
+        print(f"vehicles:             {arguments.vehicles}")
+        print(f"target:               {rate:,.0f} msgs/s")
+        print(f"published:            {published}")
+        print(f"achieved:             {published / elapsed:,.0f} msgs/s")
+        print(f"final lag:            {max(elapsed - arguments.duration, 0):.2f} s")
+
+        return published / elapsed
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Publish GPS data of simulated vehicles at a fixed rate")
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--ping-rate", type=float, default=1, help="Pings per vehicle per second")
+    parser.add_argument("--trip-length", type=int, default=60, help="Average pings per trip")
+    parser.add_argument("--speed-distribution", choices=["normal", "uniform"], default="normal")
+    parser.add_argument("--speed-mean", type=float, default=70, help="km/h")
+    parser.add_argument("--speed-stddev", type=float, default=20, help="km/h, half width for uniform")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--center-lat", type=float, default=43.85)
+    parser.add_argument("--center-long", type=float, default=18.38)
+    parser.add_argument("--spread-degrees", type=float, default=1)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=500, help="Messages published at once on a channel")
+    parser.add_argument("--confirms", action="store_true", help="Wait for publisher confirms")
+    parser.add_argument("--tick-ms", type=float, default=5)
+    parser.add_argument("--report-interval", type=float, default=5, help="Seconds")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+    asyncio.run(run(parse_arguments()))
@@ -1,161 +1,204 @@
 import os
-import json
 import asyncio
+import logging
 import aio_pika
-import enum
-import motor.motor_asyncio
-from dotenv import load_dotenv
-from math import cos, asin, sqrt, pi
+from gps_storage import append_sample, load_trip_samples, update_positions
+from ingestion import GpsBatcher
+from consumer_runtime import CONSUMER_STATS_INTERVAL, CONSUMER_WORKERS, WorkerPool, consume, declare_gps_data_exchange, declare_partition_queues, declare_queue
+from scoring import TripScorer, pair_distances, points_from_kilometres
+from compression import TRAJECTORY_COMPRESSION, TrajectoryCompressor
+from supervisor import VMS_PROCESSES, supervise
+from indexes import ensure_indexes
+from codec import encode_message
+from metrics import METRICS_PORT, MESSAGES_PUBLISHED, span, start_exporter, trace_headers
 
-load_dotenv()
 SEND_POINTS_QUEUE = os.environ.get('SEND_POINTS_QUEUE')
 
-# db
-client = motor.motor_asyncio.AsyncIOMotorClient(os.environ.get("MONGODB_URL"))
-db = client.vehicle_monitoring_system
+logger = logging.getLogger(__name__)
 
+trip_scorer = TripScorer()
+trajectory_compressor = TrajectoryCompressor() if TRAJECTORY_COMPRESSION else None
 
-class MongoDocumentsEnum(enum.Enum):
-    GPS_DATA = "gps_data"
 
-
-async def publish(channel, body, queue_name):
+async def publish(channel, body, queue_name, headers=None):
     await channel.default_exchange.publish(
         aio_pika.Message(
-            body=json.dumps(body).encode(),
-            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            **encode_message(body),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            headers=headers
         ),
         routing_key=queue_name
     )
+    MESSAGES_PUBLISHED.labels(queue=queue_name).inc()
 
 
 async def save_gps_data(gps_data):
-
-    if (gps_data_db := await db[MongoDocumentsEnum.GPS_DATA.value].find_one({"trip_id": gps_data.get("trip_id", None)})) is not None:
-        gps_data_db["trip_data"].append(
-            {
-                "current_geo_point": gps_data.get("current_geo_point"),
-                "speed": gps_data.get("speed"),
-                "timestamp": gps_data.get("timestamp")
-            }
-        )
-        await db[MongoDocumentsEnum.GPS_DATA.value].update_one({"_id": gps_data_db["_id"]}, {"$set": gps_data_db})
-
-    else:
-        trip_data = {
-            "current_geo_point": gps_data.pop("current_geo_point"),
-            "speed": gps_data.pop("speed"),
-            "timestamp": gps_data.pop("timestamp")
-        }
-        gps_data["trip_data"] = [trip_data]
-        await db[MongoDocumentsEnum.GPS_DATA.value].insert_one(gps_data)
+    await append_sample(gps_data, compressor=trajectory_compressor)
 
 
-# Optimized formula for calculating distance between two geo points
-# https://stackoverflow.com/questions/27928/calculate-distance-between-two-latitude-longitude-points-haversine-formula
-def distance(lat1, lon1, lat2, lon2):
-    p = pi/180
-    a = 0.5 - cos((lat2-lat1)*p)/2 + cos(lat1*p) * \
-        cos(lat2*p) * (1-cos((lon2-lon1)*p))/2
-    return abs(12742 * asin(sqrt(a)))
-
-
-async def calculate_points_from_gps_data(gps_data):
-    final_gps_data = await db[MongoDocumentsEnum.GPS_DATA.value].find_one({"trip_id": gps_data.get("trip_id", None)})
+async def calculate_kilometres_from_gps_data(gps_data):
+    trip_data = await load_trip_samples(gps_data.get("trip_id", None))
 
     speed_boundaries_kilometeres = {
+        "0-60": 0.0,  # no points
         "60-80": 0.0,  # 1 point per km
         "80-100": 0.0,  # 2 points per km
         "100+": 0.0  # 5 points per km
     }
 
-    for i in range(0, len(final_gps_data["trip_data"])-1):
-        starting_speed_interval = final_gps_data["trip_data"][i]["speed"]
-        ending_speed_interval = final_gps_data["trip_data"][i+1]["speed"]
+    for i in range(0, len(trip_data)-1):
+        starting_speed_interval = trip_data[i]["speed"]
+        ending_speed_interval = trip_data[i+1]["speed"]
 
         avg_speed = int((starting_speed_interval+ending_speed_interval) / 2)
 
-        if avg_speed < 60:
-            continue
-
         key = ""
-        if avg_speed >= 60 and avg_speed < 80:
+        if avg_speed < 60:
+            key = "0-60"
+        elif avg_speed >= 60 and avg_speed < 80:
             key = "60-80"
         elif avg_speed >= 80 and avg_speed < 100:
             key = "80-100"
         else:
             key = "100+"
 
-        speed_boundaries_kilometeres[key] += distance(
-            final_gps_data["trip_data"][i]["current_geo_point"]["lat"],
-            final_gps_data["trip_data"][i]["current_geo_point"]["long"],
-            final_gps_data["trip_data"][i+1]["current_geo_point"]["lat"],
-            final_gps_data["trip_data"][i+1]["current_geo_point"]["long"]
-        )
+        for kilometres in pair_distances(trip_data[i], trip_data[i+1]):
+            speed_boundaries_kilometeres[key] += kilometres
 
-    return int(speed_boundaries_kilometeres["60-80"]) + \
-        int(speed_boundaries_kilometeres["80-100"])*2 + \
-        int(speed_boundaries_kilometeres["100+"])*5
+    return speed_boundaries_kilometeres
 
 
-async def consumer_handler(message, sending_channel):
-    await save_gps_data(message)
+async def calculate_points_from_gps_data(gps_data):
+    return points_from_kilometres(await calculate_kilometres_from_gps_data(gps_data))
 
-    if message.get("trip_finished", False):
-        points = await calculate_points_from_gps_data(message)
+
+async def award_points(message, sending_channel):
+    with span("points_published", message.get("trip_id", None)):
+        if (kilometres := await trip_scorer.finish(message.get("trip_id", None))) is None:
+            kilometres = await calculate_kilometres_from_gps_data(message)
+        points = points_from_kilometres(kilometres)
+
+        compression = None
+        if trajectory_compressor is not None and (compression := trajectory_compressor.finish(message.get("trip_id", None))):
+            logger.info(
+                "Trip %s kept %d of %d samples, %.2fx",
+                message.get("trip_id"), compression["stored"], compression["received"], compression["ratio"]
+            )
+
+        await trip_scorer.record_points(message.get("trip_id"), message.get("driver_id"), points, compression)
+
+        # Kilometres, vehicle and finish time feed the rollups
+        # of the fleet management service
         body = {
             "points": points,
             "trip_id": message.get("trip_id"),
-            "driver_id": message.get("driver_id")
-
+            "driver_id": message.get("driver_id"),
+            "vehicle_id": message.get("vehicle_id"),
+            "kilometres": kilometres,
+            "finished_at": message.get("timestamp")
         }
-        await publish(sending_channel, body, os.environ.get('SEND_POINTS_QUEUE'))
+        await publish(sending_channel, body, os.environ.get('SEND_POINTS_QUEUE'), trace_headers(message.get("trip_id", None)))
 
 
-async def main() -> None:
-    # logging.basicConfig(level=logging.DEBUG)
+async def consumer_handler(message, sending_channel):
+    await save_gps_data(message)
+    await update_positions([message])
+    await trip_scorer.add_samples([message])
+
+    if message.get("trip_finished", False):
+        await award_points(message, sending_channel)
+
+
+async def batch_handler(messages, sending_channel):
+    # Called with messages that are already stored
+    await update_positions(messages)
+    await trip_scorer.add_samples(messages)
+
+    for message in messages:
+        if message.get("trip_finished", False):
+            await award_points(message, sending_channel)
+
+
+async def report_stats(stats_queue, worker_index, pool, batcher):
+    # Sends stats of this worker process to the supervisor
+    while True:
+        await asyncio.sleep(CONSUMER_STATS_INTERVAL)
+        stats_queue.put((worker_index, {
+            **pool.stats(),
+            "flushed_batches": batcher.flushed_batches,
+            "flushed_messages": batcher.flushed_messages
+        }))
+
+
+async def main(worker_index=0, processes=1, stats_queue=None) -> None:
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+    await ensure_indexes()
+    # Every worker process exports its own metrics, on consecutive ports
+    await start_exporter(METRICS_PORT + worker_index if METRICS_PORT else 0)
+
     connection = await aio_pika.connect_robust(
         host=os.environ.get('RABBITMQ_HOST'),
         port=5672,
     )
 
-    queue_name = os.environ.get("RECEIVE_GPS_DATA_QUEUE")
     send_points_queue = os.environ.get("SEND_POINTS_QUEUE")
 
     async with connection:
         channel = await connection.channel()
 
-        await channel.set_qos(prefetch_count=10)
+        sending_channel = await connection.channel()
 
-        queue = await channel.declare_queue(
-            queue_name,
-            durable=True,
-            exclusive=False,
-            auto_delete=False
+        batcher = GpsBatcher(
+            lambda messages: batch_handler(messages, sending_channel),
+            compressor=trajectory_compressor
         )
 
-        sending_channel = await connection.channel()
-
-        await channel.declare_queue(
-            send_points_queue,
-            durable=True,
-            exclusive=False,
-            auto_delete=False
+        # Messages of a trip are handled one by one, in order,
+        # so trip_finished is scored only after all earlier samples are stored.
+        # Every worker waits until the batch holding its message is stored,
+        # pool has to be larger than a batch, otherwise the batch
+        # could only ever be flushed by the timeout. Trips share lanes,
+        # twice the batch size leaves room for lanes waiting on another trip
+        workers = max(CONSUMER_WORKERS, 2 * batcher.batch_size)
+        if workers > CONSUMER_WORKERS:
+            logger.warning(
+                "CONSUMER_WORKERS=%d can't fill batches of GPS_BATCH_SIZE=%d, using %d workers",
+                CONSUMER_WORKERS, batcher.batch_size, workers
+            )
+        pool = WorkerPool(
+            batcher.add,
+            workers=workers,
+            key=lambda gps_data: gps_data.get("trip_id", None)
         )
 
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    loop = asyncio.get_running_loop()
-                    loop.create_task(
-                        consumer_handler(
-                            message=json.loads(message.body),
-                            sending_channel=sending_channel
-                        )
-                    )
-                    if queue.name in message.body.decode():
-                        break
+        # Limit is shared by consumers of all partitions on this channel
+        await channel.set_qos(prefetch_count=pool.prefetch_count, global_=True)
+
+        # Partitions are bound here too, so no message published
+        # to the exchange is dropped when this service starts first
+        exchange = await declare_gps_data_exchange(channel)
+        queues = await declare_partition_queues(channel, os.environ.get("RECEIVE_GPS_DATA_QUEUE"), exchange)
+
+        await declare_queue(channel, send_points_queue)
+
+        pool.start()
+
+        if stats_queue is not None:
+            reporter = asyncio.create_task(report_stats(stats_queue, worker_index, pool, batcher))
+
+        # Every worker process consumes its own share of partitions
+        await asyncio.gather(*(
+            consume(queue, pool) for queue in queues[worker_index::processes]
+        ))
+
+        await pool.stop()
+
+        if stats_queue is not None:
+            reporter.cancel()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if VMS_PROCESSES > 1:
+        supervise(VMS_PROCESSES)
+    else:
+        asyncio.run(main())
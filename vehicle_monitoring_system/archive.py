@@ -0,0 +1,471 @@
+import os
+import sys
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import calendar
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Finished trips are moved out of the gps_data collection into columnar
+# files, partitioned by the UTC day the trip started.
+#
+#   ARCHIVE_PATH/2022-05-01/<segment>/trips.npy            one row per trip, with its kilometres in every scored speed band
+#                                    /timestamp_delta.npy  seconds since the previous sample of the trip, smallest uint that fits
+#                                                          when every timestamp is whole, float64 seconds since the trip started otherwise
+#                                    /lat.npy, long.npy    degrees times COORDINATE_SCALE, int32
+#                                    /speed.npy            km/h rounded, uint8
+#                                    /path_index.npy       samples that carry kilometres of samples dropped by trajectory
+#                                    /path_km.npy          compression, repeated for each pair, and the kilometres of the pairs
+#
+# Rounded coordinates and speeds can move a trip's kilometres in a band
+# past a whole kilometre, rescoring reads the band kilometres instead,
+# summed from the samples as received, pair by pair like scoring does.
+#
+# Samples of a trip are stored back to back in timestamp order, trips in
+# the order they started. Columns are memory-mapped, samples of a trip or
+# of trips started in a time range are views of the mapped files.
+#
+#   python3 archive.py run
+#   python3 archive.py stats
+#   python3 archive.py export --from 2022-05-01 --to 2022-05-02 --output trace.ndjson.gz
+
+ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH", "archive")
+# Trips are archived only once their last sample is this old,
+# so a late or redelivered sample still finds its bucket
+ARCHIVE_MIN_AGE_SECONDS = int(os.environ.get("ARCHIVE_MIN_AGE_SECONDS", 3600))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 1000))
+
+# 1e-7 degrees is about a centimetre, well below GPS precision
+COORDINATE_SCALE = 10 ** 7
+COLUMNS = ("timestamp_delta", "lat", "long", "speed")
+# Only a few samples carry kilometres, kept as indexes in the segment and values
+PATH_COLUMNS = ("path_index", "path_km")
+
+
+def day_of(timestamp):
+    return datetime.fromtimestamp(int(timestamp), timezone.utc).strftime("%Y-%m-%d")
+
+
+def encode_trips(trips):
+    # trips are dicts with trip_id, driver_id, vehicle_id and samples in
+    # timestamp order. Returns the trips table and the sample columns
+    from rescoring import band_kilometres
+    trips = sorted(trips, key=lambda trip: trip["samples"][0]["timestamp"])
+    counts = np.array([len(trip["samples"]) for trip in trips], dtype=np.int64)
+    offsets = np.zeros(len(trips) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    samples = [sample for trip in trips for sample in trip["samples"]]
+    timestamps = np.fromiter((sample["timestamp"] for sample in samples), dtype=np.float64, count=len(samples))
+    lat = np.fromiter((sample["current_geo_point"]["lat"] for sample in samples), dtype=np.float64, count=len(samples))
+    long = np.fromiter((sample["current_geo_point"]["long"] for sample in samples), dtype=np.float64, count=len(samples))
+    speed = np.fromiter((sample["speed"] or 0 for sample in samples), dtype=np.float64, count=len(samples))
+
+    # Kilometres carried from the sample before, as scoring.pair_distances reads them
+    path_from = np.fromiter((sample.get("path_from", np.nan) for sample in samples), dtype=np.float64, count=len(samples))
+    carried = np.zeros(len(samples), dtype=bool)
+    carried[1:] = path_from[1:] == timestamps[:-1]
+    carried[offsets[:-1]] = False
+    path_index, path_km = [], []
+    for index in np.flatnonzero(carried).tolist():
+        # Samples compressed before keep only the sum
+        kilometres = samples[index]["path_km"]
+        kilometres = kilometres if isinstance(kilometres, list) else [kilometres]
+        path_index.extend([index] * len(kilometres))
+        path_km.extend(kilometres)
+
+    # First sample of every trip has delta 0, the trip start is in the table.
+    # Pings come whole seconds apart, deltas mostly fit a byte. Fractions are
+    # kept as seconds since the trip started, which adding the start undoes exactly
+    if np.array_equal(timestamps, np.trunc(timestamps)):
+        timestamps = timestamps.astype(np.int64)
+        deltas = np.diff(timestamps, prepend=timestamps[:1])
+        deltas[offsets[:-1]] = 0
+        delta_type = np.min_scalar_type(deltas.max(initial=0))
+    else:
+        deltas = timestamps - np.repeat(timestamps[offsets[:-1]], counts)
+        delta_type = np.float64
+
+    def identifiers(field):
+        return np.array([str(trip.get(field) or "").encode() for trip in trips], dtype=np.bytes_)
+
+    trip_ids, driver_ids, vehicle_ids = identifiers("trip_id"), identifiers("driver_id"), identifiers("vehicle_id")
+    table = np.zeros(len(trips), dtype=[
+        ("trip_id", trip_ids.dtype),
+        ("driver_id", driver_ids.dtype),
+        ("vehicle_id", vehicle_ids.dtype),
+        ("started", timestamps.dtype),
+        ("ended", timestamps.dtype),
+        ("offset", np.int64),
+        ("count", np.int64),
+        ("kilometres", np.float64, (3,))
+    ])
+    table["trip_id"], table["driver_id"], table["vehicle_id"] = trip_ids, driver_ids, vehicle_ids
+    table["started"] = timestamps[offsets[:-1]]
+    table["ended"] = timestamps[offsets[1:] - 1]
+    table["offset"] = offsets[:-1]
+    table["count"] = counts
+    table["kilometres"] = band_kilometres(lat, long, speed, offsets, (np.array(path_index, dtype=np.int64), np.array(path_km)))
+
+    columns = {
+        "timestamp_delta": deltas.astype(delta_type),
+        "lat": np.rint(lat * COORDINATE_SCALE).astype(np.int32),
+        "long": np.rint(long * COORDINATE_SCALE).astype(np.int32),
+        "speed": np.clip(np.rint(speed), 0, 255).astype(np.uint8),
+        "path_index": np.array(path_index, dtype=np.int64),
+        "path_km": np.array(path_km, dtype=np.float64)
+    }
+    return table, columns
+
+
+def write_segment(path, trips):
+    # Written to a hidden directory and renamed, readers never see a
+    # segment that is half written. Returns the segment name per day
+    trips = [trip for trip in trips if trip["samples"]]
+    by_day = {}
+    for trip in trips:
+        by_day.setdefault(day_of(trip["samples"][0]["timestamp"]), []).append(trip)
+
+    name = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    segments = {}
+    for day, day_trips in by_day.items():
+        table, columns = encode_trips(day_trips)
+        day_path = os.path.join(path, day)
+        temporary_path = os.path.join(day_path, f".{name}")
+        os.makedirs(temporary_path)
+
+        for column, values in (("trips", table), *columns.items()):
+            with open(os.path.join(temporary_path, f"{column}.npy"), "wb") as file:
+                np.save(file, values)
+                file.flush()
+                os.fsync(file.fileno())
+
+        os.rename(temporary_path, os.path.join(day_path, name))
+        directory = os.open(day_path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        segments[day] = f"{day}/{name}"
+
+    return segments
+
+
+class Samples:
+    # Samples of trips stored back to back, the columns are views of the
+    # mapped files. Decoding to timestamps and degrees makes new arrays
+    def __init__(self, trips, timestamp_delta, lat, long, speed, path_index=None, path_km=None):
+        self.trips = trips
+        self.timestamp_delta = timestamp_delta
+        self.lat = lat
+        self.long = long
+        self.speed = speed
+        # Indexes are into these samples
+        self.path_index = path_index if path_index is not None else np.zeros(0, dtype=np.int64)
+        self.path_km = path_km if path_km is not None else np.zeros(0)
+
+    def __len__(self):
+        return len(self.speed)
+
+    @property
+    def offsets(self):
+        offsets = np.zeros(len(self.trips) + 1, dtype=np.int64)
+        np.cumsum(self.trips["count"], out=offsets[1:])
+        return offsets
+
+    def timestamps(self):
+        counts = self.trips["count"]
+        if self.timestamp_delta.dtype.kind == "f":
+            return self.timestamp_delta + np.repeat(self.trips["started"], counts)
+        elapsed = np.cumsum(self.timestamp_delta, dtype=np.int64)
+        trip_elapsed = elapsed[self.offsets[:-1]] if len(elapsed) else elapsed
+        return elapsed - np.repeat(trip_elapsed, counts) + np.repeat(self.trips["started"], counts)
+
+    def lat_degrees(self):
+        return self.lat / COORDINATE_SCALE
+
+    def long_degrees(self):
+        return self.long / COORDINATE_SCALE
+
+    def kilometres(self):
+        # Band kilometres of every trip, None in segments written without them
+        return self.trips["kilometres"] if "kilometres" in self.trips.dtype.names else None
+
+    def path(self):
+        # The path argument of rescoring.score_trips
+        return self.path_index.astype(np.int64), self.path_km
+
+    def to_messages(self):
+        # GPS data messages the trips were made of
+        timestamps = self.timestamps().tolist()
+        lat, long, speed = self.lat_degrees().tolist(), self.long_degrees().tolist(), self.speed.tolist()
+        path_km = {}
+        for index, kilometres in zip(self.path_index.tolist(), self.path_km.tolist()):
+            path_km.setdefault(index, []).append(kilometres)
+        for trip, start, end in zip(self.trips, self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            for index in range(start, end):
+                message = {
+                    "current_geo_point": {"lat": lat[index], "long": long[index]},
+                    "speed": speed[index],
+                    "driver_id": trip["driver_id"].decode() or None,
+                    "trip_id": trip["trip_id"].decode(),
+                    "vehicle_id": trip["vehicle_id"].decode() or None,
+                    "timestamp": timestamps[index]
+                }
+                if index in path_km:
+                    message.update(path_km=path_km[index], path_from=timestamps[index - 1])
+                if index == end - 1:
+                    message["trip_finished"] = True
+                yield message
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.trips = np.load(os.path.join(path, "trips.npy"), mmap_mode="r")
+        self.columns = {column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r") for column in COLUMNS}
+        # Segments written before trajectory compression have no path columns
+        self.path_columns = [
+            np.load(os.path.join(path, f"{column}.npy")) if os.path.exists(os.path.join(path, f"{column}.npy")) else None
+            for column in PATH_COLUMNS
+        ]
+
+    def samples(self, first, last):
+        # Trips first to last - 1, they are stored next to each other
+        trips = self.trips[first:last]
+        if len(trips) == 0:
+            return Samples(trips, *(values[:0] for values in self.columns.values()))
+        start = int(trips["offset"][0])
+        end = int(trips["offset"][-1] + trips["count"][-1])
+
+        path_index, path_km = self.path_columns
+        if path_index is not None:
+            path_start, path_end = np.searchsorted(path_index, [start, end])
+            path_index, path_km = path_index[path_start:path_end] - start, path_km[path_start:path_end]
+        return Samples(trips, *(values[start:end] for values in self.columns.values()), path_index, path_km)
+
+    def trip(self, trip_id):
+        matches = np.flatnonzero(self.trips["trip_id"] == str(trip_id).encode())
+        if len(matches) == 0:
+            return None
+        return self.samples(int(matches[-1]), int(matches[-1]) + 1)
+
+    def started_between(self, start=None, end=None):
+        started = self.trips["started"]
+        return self.samples(
+            int(np.searchsorted(started, start, "left")) if start is not None else 0,
+            int(np.searchsorted(started, end, "left")) if end is not None else len(started)
+        )
+
+
+class TripArchive:
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        self.opened = {}
+
+    def days(self, start=None, end=None):
+        if not os.path.isdir(self.path):
+            return []
+        days = sorted(day for day in os.listdir(self.path) if not day.startswith("."))
+        if start is not None:
+            days = [day for day in days if day >= day_of(start)]
+        if end is not None:
+            days = [day for day in days if day <= day_of(end)]
+        return days
+
+    def segments(self, start=None, end=None):
+        for day in self.days(start, end):
+            for name in sorted(os.listdir(os.path.join(self.path, day))):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(self.path, day, name)
+                if (segment := self.opened.get(path)) is None:
+                    segment = self.opened[path] = Segment(path)
+                yield segment
+
+    def trip(self, trip_id, started=None):
+        # With the start timestamp only the segments of that day are searched.
+        # Newest segment first, a trip archived twice is read from the last copy
+        for segment in reversed(list(self.segments(started, started))):
+            if (samples := segment.trip(trip_id)) is not None:
+                return samples
+        return None
+
+    def started_between(self, start=None, end=None):
+        # One Samples per segment, trips started at or after start and before
+        # end, without them all of the archive
+        for segment in self.segments(start, end - 1 if end is not None else None):
+            if len(samples := segment.started_between(start, end)):
+                yield samples
+
+
+async def find_finished_trips(min_age_seconds=ARCHIVE_MIN_AGE_SECONDS):
+    # Trips awarded points, not archived yet, without recent samples
+    trip_ids = [
+        trip_score["trip_id"]
+        async for trip_score in db[MongoDocumentsEnum.TRIP_SCORES.value].find(
+            {"points": {"$exists": True}, "archived": {"$exists": False}}, {"trip_id": 1}
+        )
+    ]
+
+    finished = []
+    for chunk_start in range(0, len(trip_ids), ARCHIVE_BATCH_SIZE):
+        async for trip in db[MongoDocumentsEnum.GPS_DATA.value].aggregate([
+            {"$match": {"trip_id": {"$in": trip_ids[chunk_start:chunk_start + ARCHIVE_BATCH_SIZE]}}},
+            {"$group": {"_id": "$trip_id", "ended": {"$max": "$last_timestamp"}}},
+            {"$match": {"ended": {"$lt": time.time() - min_age_seconds}}}
+        ]):
+            finished.append(trip["_id"])
+
+    return finished
+
+
+async def load_trips(trip_ids):
+    trips = {}
+
+    cursor = db[MongoDocumentsEnum.GPS_DATA.value].find(
+        {"trip_id": {"$in": trip_ids}},
+        {"trip_id": 1, "driver_id": 1, "vehicle_id": 1, "trip_data": 1}
+    ).sort([("first_timestamp", 1), ("_id", 1)])
+
+    async for bucket in cursor:
+        trip = trips.setdefault(bucket["trip_id"], {
+            "trip_id": bucket["trip_id"],
+            "driver_id": bucket.get("driver_id"),
+            "vehicle_id": bucket.get("vehicle_id"),
+            "samples": []
+        })
+        trip["samples"].extend(bucket["trip_data"])
+
+    # Same order load_trip_samples gives the scoring
+    for trip in trips.values():
+        trip["samples"].sort(key=lambda sample: sample["timestamp"])
+
+    return list(trips.values())
+
+
+async def delete_buckets(trip_ids):
+    await db[MongoDocumentsEnum.GPS_DATA.value].delete_many({"trip_id": {"$in": trip_ids}})
+    await db[MongoDocumentsEnum.TRIP_SCORES.value].update_many(
+        {"trip_id": {"$in": trip_ids}}, {"$unset": {"archiving": ""}}
+    )
+
+
+async def archive_trips(path=ARCHIVE_PATH, min_age_seconds=ARCHIVE_MIN_AGE_SECONDS, batch_size=ARCHIVE_BATCH_SIZE):
+    # Trips are marked archived before their buckets are deleted, buckets
+    # left by a run that stopped in between are deleted by the next one.
+    # A run that stopped before marking them archives them again,
+    # trip reads take the last copy
+    leftovers = [
+        trip_score["trip_id"]
+        async for trip_score in db[MongoDocumentsEnum.TRIP_SCORES.value].find({"archiving": True}, {"trip_id": 1})
+    ]
+    if leftovers:
+        await delete_buckets(leftovers)
+
+    trip_ids = await find_finished_trips(min_age_seconds)
+    logger.info("Archiving %d trips", len(trip_ids))
+    archived_trips = archived_samples = 0
+
+    for chunk_start in range(0, len(trip_ids), batch_size):
+        trips = await load_trips(trip_ids[chunk_start:chunk_start + batch_size])
+        if not trips:
+            continue
+        segments = await asyncio.get_running_loop().run_in_executor(None, write_segment, path, trips)
+
+        await db[MongoDocumentsEnum.TRIP_SCORES.value].bulk_write([
+            UpdateOne(
+                {"trip_id": trip["trip_id"]},
+                {"$set": {
+                    "archived": segments[day_of(trip["samples"][0]["timestamp"])],
+                    "started": trip["samples"][0]["timestamp"],
+                    "archiving": True
+                }}
+            )
+            for trip in trips
+        ], ordered=False)
+
+        await delete_buckets([trip["trip_id"] for trip in trips])
+
+        archived_trips += len(trips)
+        archived_samples += sum(len(trip["samples"]) for trip in trips)
+        logger.info("Archived %d/%d trips, %d samples", archived_trips, len(trip_ids), archived_samples)
+
+    return archived_trips, archived_samples
+
+
+def stats(path=ARCHIVE_PATH):
+    archive = TripArchive(path)
+    days = {}
+    for segment in archive.segments():
+        day = days.setdefault(os.path.basename(os.path.dirname(segment.path)), {"segments": 0, "trips": 0, "samples": 0, "bytes": 0})
+        day["segments"] += 1
+        day["trips"] += len(segment.trips)
+        day["samples"] += len(segment.columns["speed"])
+        day["bytes"] += sum(entry.stat().st_size for entry in os.scandir(segment.path))
+    return days
+
+
+def export(path, start, end, output):
+    # Trips started in the range as a GPS trace, for traces.py replay.
+    # Messages are in timestamp order, offsets are seconds since the first one
+    from traces import write_trace
+
+    messages = [
+        message
+        for samples in TripArchive(path).started_between(start, end)
+        for message in samples.to_messages()
+    ]
+    messages.sort(key=lambda message: message["timestamp"])
+    first = messages[0]["timestamp"] if messages else 0
+    return write_trace(output, ((message["timestamp"] - first, message) for message in messages))
+
+
+def parse_date(value):
+    return calendar.timegm(datetime.fromisoformat(value).utctimetuple())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive finished trips into columnar files")
+    parser.add_argument("--path", default=ARCHIVE_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Move finished trips from Mongo to the archive")
+    run_parser.add_argument("--min-age-seconds", type=int, default=ARCHIVE_MIN_AGE_SECONDS)
+    run_parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+
+    commands.add_parser("stats", help="Trips, samples and bytes per day")
+
+    export_parser = commands.add_parser("export", help="Write trips started in a range as a GPS trace")
+    export_parser.add_argument("--from", dest="date_from", type=parse_date, required=True, help="UTC date")
+    export_parser.add_argument("--to", dest="date_to", type=parse_date, help="UTC date, a day after --from by default")
+    export_parser.add_argument("--output", required=True)
+
+    arguments = parser.parse_args(argv)
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    if arguments.command == "run":
+        trips, samples = asyncio.run(archive_trips(arguments.path, arguments.min_age_seconds, arguments.batch_size))
+        print(f"archived {trips} trips, {samples} samples")
+    elif arguments.command == "stats":
+        for day, day_stats in stats(arguments.path).items():
+            print(day, " ".join(f"{name}={value}" for name, value in day_stats.items()))
+    else:
+        date_to = arguments.date_to if arguments.date_to is not None else arguments.date_from + int(timedelta(days=1).total_seconds())
+        count = export(arguments.path, arguments.date_from, date_to, arguments.output)
+        print(f"exported {count} messages to {arguments.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import numpy as np
+from bson import ObjectId, encode
+from archive import TripArchive, write_segment
+from bench_rescoring import generate_trips
+from gps_storage import GPS_BUCKET_SIZE
+from rescoring import points_from_band_kilometres, score_trips, to_arrays
+from traces import latency_summary
+
+# Size of the trip archive next to the gps_data buckets the trips came
+# from, and how fast trips are scanned and scored from either of them.
+# Prints one JSON object, bench_suite.py in the repository root
+# compares it with a baseline
+
+# Trips start ten minutes apart, so a few thousand of them span days
+FIRST_TRIP_STARTED = 1650000000
+TRIP_INTERVAL_SECONDS = 600
+
+
+def archive_trips(number_of_trips, samples_per_trip, seed):
+    trips = []
+    for index, samples in enumerate(generate_trips(number_of_trips, samples_per_trip, seed)):
+        started = FIRST_TRIP_STARTED + index * TRIP_INTERVAL_SECONDS
+        for sample in samples:
+            sample["timestamp"] += started
+        trips.append({
+            "trip_id": str(ObjectId()),
+            "driver_id": str(ObjectId()),
+            "vehicle_id": str(ObjectId()),
+            "samples": samples
+        })
+    return trips
+
+
+def bucket_bytes(trip, bucket_size=GPS_BUCKET_SIZE):
+    # Documents append_sample leaves in gps_data for the trip
+    total = 0
+    for start in range(0, len(trip["samples"]), bucket_size):
+        trip_data = trip["samples"][start:start + bucket_size]
+        total += len(encode({
+            "_id": ObjectId(),
+            "trip_id": trip["trip_id"],
+            "count": len(trip_data),
+            "first_timestamp": trip_data[0]["timestamp"],
+            "last_timestamp": trip_data[-1]["timestamp"],
+            "driver_id": trip["driver_id"],
+            "vehicle_id": trip["vehicle_id"],
+            "trip_data": trip_data
+        }))
+    return total
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def run(arguments):
+    trips = archive_trips(arguments.trips, arguments.samples, arguments.seed)
+    number_of_samples = sum(len(trip["samples"]) for trip in trips)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as path:
+        started = time.perf_counter()
+        write_segment(path, trips)
+        write_seconds = time.perf_counter() - started
+
+        bson_bytes = sum(bucket_bytes(trip) for trip in trips)
+        archive_bytes = directory_bytes(path)
+        results["storage"] = {
+            "samples": number_of_samples,
+            "bson_bytes": bson_bytes,
+            "archive_bytes": archive_bytes,
+            "bytes_per_sample": round(archive_bytes / number_of_samples, 2),
+            "ratio": round(bson_bytes / archive_bytes, 2)
+        }
+        results["write"] = {"samples": number_of_samples, "ops_per_second": round(number_of_samples / write_seconds, 1)}
+
+        # Every trip scored from the archived samples, and from
+        # the band kilometres kept with them the way rescoring does
+        archive = TripArchive(path)
+        started = time.perf_counter()
+        sample_points = np.concatenate([
+            score_trips(samples.lat_degrees(), samples.long_degrees(), samples.speed.astype(np.float64), samples.offsets, samples.path())
+            for samples in archive.started_between()
+        ])
+        scan_seconds = time.perf_counter() - started
+        archived_points = np.concatenate([points_from_band_kilometres(samples.kilometres()) for samples in archive.started_between()])
+        results["scan_archive"] = {"samples": number_of_samples, "ops_per_second": round(number_of_samples / scan_seconds, 1)}
+
+        # Same trips from documents already in memory, Mongo itself not included
+        started = time.perf_counter()
+        document_points = score_trips(*to_arrays([trip["samples"] for trip in trips]))
+        scan_seconds = time.perf_counter() - started
+        results["scan_documents"] = {"samples": number_of_samples, "ops_per_second": round(number_of_samples / scan_seconds, 1)}
+        results["scan_archive"]["score_mismatches"] = int(np.count_nonzero(archived_points != document_points))
+        # Coordinates are stored to 1e-7 degrees and speeds rounded, a trip whose
+        # kilometres in a band are that close to a whole kilometre can score differently
+        results["scan_archive"]["sample_score_mismatches"] = int(np.count_nonzero(sample_points != document_points))
+
+        rng = random.Random(arguments.seed)
+        latencies = []
+        for trip in rng.sample(trips, min(arguments.lookups, len(trips))):
+            started = time.perf_counter()
+            samples = archive.trip(trip["trip_id"], trip["samples"][0]["timestamp"])
+            latencies.append(time.perf_counter() - started)
+            if len(samples) != len(trip["samples"]):
+                raise RuntimeError(f"Trip {trip['trip_id']} has {len(samples)} archived samples")
+        results["trip_lookup"] = {"lookups": len(latencies), **latency_summary(latencies)}
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the trip archive")
+    parser.add_argument("--trips", type=int, default=2000)
+    parser.add_argument("--samples", type=int, default=500, help="samples per trip")
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args(argv)
+
+    print(json.dumps(run(arguments), indent=2))
+
+
+if __name__ == "__main__":
+    main()
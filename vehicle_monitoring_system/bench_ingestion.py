@@ -0,0 +1,155 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+from bench_rescoring import generate_trips
+from traces import CapturingChannel, latency_summary
+
+# Cost of storing GPS data and scoring trips, in process against an
+# in-memory Mongo. Prints one JSON object, bench_suite.py in the
+# repository root compares it with a baseline
+
+
+def trip_messages(trip_index, samples):
+    messages = [
+        {
+            **sample,
+            "trip_id": f"bench-trip-{trip_index}",
+            "driver_id": f"bench-driver-{trip_index % 100}",
+            "vehicle_id": f"bench-vehicle-{trip_index}"
+        }
+        for sample in samples
+    ]
+    messages[-1]["trip_finished"] = True
+    return messages
+
+
+def use_fake_db():
+    try:
+        from mongomock_motor import AsyncMongoMockClient, AsyncMongoMockCollection
+    except ImportError:
+        sys.exit("Ingestion benchmark needs mongomock-motor, pip install mongomock-motor")
+
+    import app
+    import scoring
+    import gps_storage
+
+    # with_options of mongomock-motor returns a synchronous collection,
+    # write concerns mean nothing to it anyway
+    AsyncMongoMockCollection.with_options = lambda collection, **options: collection
+
+    fake_db = AsyncMongoMockClient().vehicle_monitoring_system
+    gps_storage.db = fake_db
+    scoring.db = fake_db
+    app.trip_scorer = scoring.TripScorer()
+
+
+async def save_gps_data(messages):
+    # One message at a time, the way consumer_handler stores them
+    import app
+
+    latencies = []
+    started = time.perf_counter()
+    for message in messages:
+        handled = time.perf_counter()
+        await app.save_gps_data(message)
+        latencies.append(time.perf_counter() - handled)
+    elapsed = time.perf_counter() - started
+
+    return {"messages": len(messages), "ops_per_second": round(len(messages) / elapsed, 1), **latency_summary(latencies)}
+
+
+async def calculate_points(trip_index, samples, repeats):
+    # Reads and scores a stored trip with the batch calculation
+    import app
+    from gps_storage import append_samples
+
+    messages = trip_messages(trip_index, samples)
+    await append_samples(messages)
+
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        await app.calculate_points_from_gps_data(messages[-1])
+        latencies.append(time.perf_counter() - started)
+
+    return {"samples": len(samples), **latency_summary(latencies)}
+
+
+async def ping_to_points(trips, batch_size, batch_timeout_ms):
+    # Trips send their pings concurrently through the batcher, like the
+    # consumer lanes do. Latency is from the last ping of a trip arriving
+    # to its points being published
+    import app
+    from ingestion import GpsBatcher
+
+    channel = CapturingChannel()
+    batcher = GpsBatcher(lambda messages: app.batch_handler(messages, channel), batch_size, batch_timeout_ms)
+    latencies = []
+
+    async def send(messages):
+        for message in messages:
+            started = time.perf_counter()
+            await batcher.add(message)
+            if message.get("trip_finished", False):
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(messages) for messages in trips))
+    elapsed = time.perf_counter() - started
+    messages = sum(len(messages) for messages in trips)
+
+    return {
+        "messages": messages,
+        "trips_scored": len(channel.points),
+        "ops_per_second": round(messages / elapsed, 1),
+        **latency_summary(latencies)
+    }
+
+
+async def run(arguments):
+    use_fake_db()
+    results = {}
+
+    trip_index = 0
+    for trip_length in arguments.trip_lengths:
+        trips = generate_trips(max(arguments.messages // trip_length, 1), trip_length, arguments.seed)
+        messages = []
+        for samples in trips:
+            messages.extend(trip_messages(trip_index, samples))
+            trip_index += 1
+        results[f"save_gps_data.trip_length_{trip_length}"] = await save_gps_data(messages)
+
+    for sample_count in arguments.sample_counts:
+        samples = generate_trips(1, sample_count, arguments.seed)[0]
+        results[f"calculate_points.samples_{sample_count}"] = await calculate_points(trip_index, samples, arguments.repeats)
+        trip_index += 1
+
+    trips = [
+        trip_messages(trip_index + index, samples)
+        for index, samples in enumerate(generate_trips(arguments.trips, arguments.samples, arguments.seed))
+    ]
+    results["ping_to_points"] = await ping_to_points(trips, arguments.batch_size, arguments.batch_timeout_ms)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark VMS ingestion and scoring in process")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages stored per trip length")
+    parser.add_argument("--trip-lengths", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--sample-counts", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--trips", type=int, default=100, help="Concurrent trips of ping_to_points")
+    parser.add_argument("--samples", type=int, default=20, help="Pings per trip of ping_to_points")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-timeout-ms", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args(argv)
+
+    print(json.dumps(asyncio.run(run(arguments)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
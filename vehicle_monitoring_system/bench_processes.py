@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import uuid
+import signal
+import asyncio
+import argparse
+import subprocess
+import aio_pika
+from dotenv import load_dotenv
+from codec import encode_message
+from consumer_runtime import declare_partition_queues, declare_queue, partition_queue_name
+
+load_dotenv()
+
+# Measures end to end VMS throughput with a growing number of worker
+# processes. Needs a RabbitMQ broker and MongoDB as configured in .env.
+# Every run publishes the same synthetic trips to the GPS data partitions,
+# starts app.py and waits until points of all trips are published.
+#
+#   python3 bench_processes.py --processes 1 2 4 --trips 500 --samples 100
+
+
+def trip_messages(trip_id, samples):
+    messages = []
+    for timestamp in range(samples):
+        messages.append({
+            "current_geo_point": {"lat": 44.0 + timestamp * 0.001, "long": 18.0},
+            "speed": 60 + timestamp % 50,
+            "driver_id": f"driver-{trip_id}",
+            "trip_id": trip_id,
+            "vehicle_id": f"vehicle-{trip_id}",
+            "timestamp": timestamp
+        })
+    messages[-1]["trip_finished"] = True
+    return messages
+
+
+async def publish_trips(channel, queue_name, trips, samples):
+    # Trips are interleaved the way vehicles report at the same time
+    trip_ids = [str(uuid.uuid4()) for _ in range(trips)]
+    trips_messages = [trip_messages(trip_id, samples) for trip_id in trip_ids]
+
+    for index in range(samples):
+        for trip_id, messages in zip(trip_ids, trips_messages):
+            await channel.default_exchange.publish(
+                aio_pika.Message(**encode_message(messages[index])),
+                routing_key=partition_queue_name(queue_name, trip_id)
+            )
+
+
+async def run(processes, trips, samples, timeout):
+    connection = await aio_pika.connect_robust(host=os.environ.get('RABBITMQ_HOST'), port=5672)
+    queue_name = os.environ.get("RECEIVE_GPS_DATA_QUEUE")
+
+    async with connection:
+        channel = await connection.channel()
+
+        for queue in await declare_partition_queues(channel, queue_name):
+            await queue.purge()
+
+        points_queue = await declare_queue(channel, os.environ.get("SEND_POINTS_QUEUE"))
+        await points_queue.purge()
+
+        await publish_trips(channel, queue_name, trips, samples)
+
+        service = subprocess.Popen(
+            [sys.executable, "app.py"],
+            env={**os.environ, "VMS_PROCESSES": str(processes), "CONSUMER_STATS_INTERVAL": "0", "LOG_LEVEL": "WARNING"}
+        )
+        started = time.perf_counter()
+
+        try:
+            while True:
+                points_queue = await channel.declare_queue(points_queue.name, passive=True)
+                if points_queue.declaration_result.message_count >= trips:
+                    break
+                if time.perf_counter() - started > timeout:
+                    raise TimeoutError(f"{processes} processes didn't finish in {timeout} s")
+                await asyncio.sleep(0.1)
+
+            return time.perf_counter() - started
+        finally:
+            service.send_signal(signal.SIGTERM)
+            service.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark VMS throughput by number of worker processes")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--trips", type=int, default=500)
+    parser.add_argument("--samples", type=int, default=100, help="GPS messages per trip")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args(argv)
+
+    messages = args.trips * args.samples
+    baseline = None
+
+    print(f"{args.trips} trips, {messages} messages")
+    for processes in args.processes:
+        elapsed = asyncio.run(run(processes, args.trips, args.samples, args.timeout))
+        throughput = messages / elapsed
+        baseline = baseline or throughput
+        print(f"{processes} processes: {elapsed:.2f} s, {throughput:,.0f} msgs/s, {throughput/baseline:.2f}x")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import sys
+import time
+import random
+import argparse
+from rescoring import score_trips, to_arrays
+from scoring import add_sample, new_score_state, points_from_kilometres
+
+# Compares the scalar scoring path with the vectorized rescoring engine
+# on synthetic trips, no database is needed.
+#
+#   python3 bench_rescoring.py --trips 2000 --samples 500
+
+
+def generate_trips(number_of_trips, samples_per_trip, seed):
+    rng = random.Random(seed)
+    trips = []
+
+    for _ in range(number_of_trips):
+        lat, long, speed = rng.uniform(-60, 60), rng.uniform(-170, 170), rng.randint(50, 120)
+        samples = []
+        for timestamp in range(samples_per_trip):
+            lat += rng.uniform(-0.01, 0.01)
+            long += rng.uniform(-0.01, 0.01)
+            speed = max(0, speed + rng.randint(-5, 5))
+            samples.append({
+                "current_geo_point": {"lat": lat, "long": long},
+                "speed": speed,
+                "timestamp": timestamp
+            })
+        trips.append(samples)
+
+    return trips
+
+
+def score_scalar(trips):
+    points = []
+    for samples in trips:
+        state = new_score_state(None)
+        for sample in samples:
+            add_sample(state, sample)
+        points.append(points_from_kilometres(state["kilometres"]))
+    return points
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark scalar and vectorized trip scoring")
+    parser.add_argument("--trips", type=int, default=1000)
+    parser.add_argument("--samples", type=int, default=500, help="samples per trip")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    trips = generate_trips(args.trips, args.samples, args.seed)
+    number_of_samples = args.trips * args.samples
+
+    started = time.perf_counter()
+    scalar_points = score_scalar(trips)
+    scalar_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    arrays = to_arrays(trips)
+    conversion_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    vectorized_points = score_trips(*arrays).tolist()
+    vectorized_seconds = time.perf_counter() - started
+
+    mismatches = sum(1 for a, b in zip(scalar_points, vectorized_points) if a != b)
+
+    print(f"{args.trips} trips, {number_of_samples} samples")
+    print(f"scalar:     {scalar_seconds:.3f} s ({number_of_samples/scalar_seconds:,.0f} samples/s)")
+    print(f"to arrays:  {conversion_seconds:.3f} s")
+    print(f"vectorized: {vectorized_seconds:.3f} s ({number_of_samples/vectorized_seconds:,.0f} samples/s)")
+    print(f"speedup:    {scalar_seconds/vectorized_seconds:.1f}x, {mismatches} mismatching trips")
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+import os
+import logging
+from math import cos, hypot, pi
+from collections import OrderedDict
+from dotenv import load_dotenv
+from gps_storage import to_sample
+from scoring import pair_distances, speed_band
+from metrics import Counter
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Samples of a trip that lie on the straight line between the samples
+# around them, within COMPRESSION_TOLERANCE_METRES, are not kept in gps_data.
+#
+# Every sample is written when it arrives, as today. When the next sample
+# of the trip shows the last written one adds nothing, the next sample is
+# written over it instead of appended, so nothing waits in memory before
+# it is stored and a restarted service only loses compression, not samples.
+#
+# A sample is only dropped when the pairs around it and the pair that
+# replaces them all fall in the same speed band, so no band change is lost.
+# The kept sample carries the kilometres of every pair it replaces
+# (path_km, from the sample at path_from), the batch calculation,
+# rescoring and the archive add those one by one instead of the straight
+# line, in the same order incremental scoring, which sees every sample
+# before compression, adds them. Both come to exactly the same kilometres
+TRAJECTORY_COMPRESSION = os.environ.get("TRAJECTORY_COMPRESSION", "false").lower() == "true"
+COMPRESSION_TOLERANCE_METRES = float(os.environ.get("COMPRESSION_TOLERANCE_METRES", 10))
+# Longest run of dropped samples, every new sample is checked against all of them
+COMPRESSION_MAX_RUN = int(os.environ.get("COMPRESSION_MAX_RUN", 50))
+# Trips kept in memory, the least recently updated one is forgotten first
+COMPRESSION_MAX_TRIPS = int(os.environ.get("COMPRESSION_MAX_TRIPS", 100000))
+
+METRES_PER_DEGREE = 6371000 * pi / 180
+
+GPS_SAMPLES_COMPRESSED = Counter(
+    "gps_samples_compressed_total", "GPS samples seen by trajectory compression", ["outcome"]
+)
+
+
+def pair_band(first, second):
+    return speed_band(int((first["speed"]+second["speed"]) / 2))
+
+
+def project(origin, sample):
+    # Metres east and north of origin, flat over the length of a run
+    point, origin = sample["current_geo_point"], origin["current_geo_point"]
+    return (
+        (point["long"] - origin["long"]) * cos(origin["lat"] * pi / 180) * METRES_PER_DEGREE,
+        (point["lat"] - origin["lat"]) * METRES_PER_DEGREE
+    )
+
+
+def deviation(end, point):
+    # Distance of point from the segment between the origin and end
+    length = end[0] ** 2 + end[1] ** 2
+    along = min(max((point[0] * end[0] + point[1] * end[1]) / length, 0), 1) if length else 0
+    return hypot(point[0] - along * end[0], point[1] - along * end[1])
+
+
+def new_compression_state():
+    return {
+        "anchor": None,  # last sample that is kept for good
+        "last": None,  # last written sample, replaced by the next one when it adds nothing
+        "run": [],  # projected positions of samples dropped since the anchor, and of last
+        "band": None,  # speed band of every pair since the anchor
+        "path_km": [],  # kilometres of every pair from the anchor to last
+        "received": 0,
+        "stored": 0,
+        "disabled": False
+    }
+
+
+class TrajectoryCompressor:
+    def __init__(
+        self,
+        tolerance_metres=COMPRESSION_TOLERANCE_METRES,
+        max_run=COMPRESSION_MAX_RUN,
+        max_trips=COMPRESSION_MAX_TRIPS
+    ):
+        self.tolerance_metres = tolerance_metres
+        self.max_run = max_run
+        self.max_trips = max_trips
+        self.trips = OrderedDict()
+
+    def state(self, trip_id):
+        if (state := self.trips.pop(trip_id, None)) is None:
+            state = new_compression_state()
+        self.trips[trip_id] = state
+        if len(self.trips) > self.max_trips:
+            self.trips.popitem(last=False)
+        return state
+
+    def can_replace_last(self, state, sample):
+        anchor, last = state["anchor"], state["last"]
+        if len(state["run"]) >= self.max_run:
+            return False
+        if pair_band(last, sample) != state["band"] or pair_band(anchor, sample) != state["band"]:
+            return False
+
+        end = project(anchor, sample)
+        return all(deviation(end, point) <= self.tolerance_metres for point in state["run"])
+
+    def compress(self, gps_data):
+        # Returns the sample to write and the written sample it replaces,
+        # None when it is appended
+        state = self.state(gps_data.get("trip_id", None))
+        state["received"] += 1
+        sample = to_sample(gps_data)
+        last = state["last"] or state["anchor"]
+
+        if state["disabled"] or sample["speed"] is None or sample["current_geo_point"] is None:
+            state["disabled"] = True
+        elif last is not None and sample["timestamp"] < last["timestamp"]:
+            # Trip is scored by the batch calculation from here on,
+            # from every sample that arrives after this one
+            state["disabled"] = True
+            logger.info("Late sample of trip %s, compression stopped for it", gps_data.get("trip_id", None))
+
+        replaced = None
+        if state["disabled"] or state["anchor"] is None:
+            state.update(anchor=sample, last=None, run=[])
+        elif state["last"] is None:
+            state.update(last=sample, run=[project(state["anchor"], sample)], band=pair_band(state["anchor"], sample))
+            state["path_km"] = pair_distances(state["anchor"], sample)
+        elif self.can_replace_last(state, sample):
+            replaced = state["last"]
+            path_km = state["path_km"] + pair_distances(replaced, sample)
+            sample = {**sample, "path_km": path_km, "path_from": state["anchor"]["timestamp"]}
+            state["run"].append(project(state["anchor"], sample))
+            state.update(last=sample, path_km=path_km)
+        else:
+            state.update(anchor=state["last"], last=sample, band=pair_band(state["last"], sample))
+            state.update(run=[project(state["anchor"], sample)], path_km=pair_distances(state["anchor"], sample))
+
+        if replaced is None:
+            state["stored"] += 1
+            GPS_SAMPLES_COMPRESSED.labels(outcome="stored").inc()
+        else:
+            GPS_SAMPLES_COMPRESSED.labels(outcome="dropped").inc()
+        return sample, replaced
+
+    def forget(self, trip_ids):
+        # After a failed write the states may be ahead of gps_data
+        for trip_id in trip_ids:
+            self.trips.pop(trip_id, None)
+
+    def finish(self, trip_id):
+        # Samples received and stored for the trip, None when it
+        # isn't known, e.g. it started before a restart
+        if (state := self.trips.pop(trip_id, None)) is None:
+            return None
+        return {
+            "received": state["received"],
+            "stored": state["stored"],
+            "ratio": round(state["received"] / state["stored"], 2) if state["stored"] else None
+        }
@@ -0,0 +1,202 @@
+import os
+import time
+import zlib
+import asyncio
+import logging
+import aio_pika
+from dotenv import load_dotenv
+from codec import decode_message
+from metrics import HANDLER_SECONDS, IN_FLIGHT, MESSAGES_CONSUMED, MESSAGES_FAILED, remember_trace
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Same module is used by the gps simulator and the vehicle monitoring system,
+# every service is built from its own folder so each one keeps a copy
+CONSUMER_WORKERS = int(os.environ.get("CONSUMER_WORKERS", 10))
+CONSUMER_STATS_INTERVAL = float(os.environ.get("CONSUMER_STATS_INTERVAL", 60))
+
+# GPS data queue is split into this many queues, messages of a trip
+# always go to the same one. Must be equal in all services
+GPS_DATA_PARTITIONS = int(os.environ.get("GPS_DATA_PARTITIONS", 1))
+
+# GPS data is published to this exchange, routed by partition queue name.
+# Other services bind their own queues with "#" to get all of it
+GPS_DATA_EXCHANGE = os.environ.get("GPS_DATA_EXCHANGE", "gps_data_exchange")
+
+# Messages rejected for good are parked in "<queue>.dead" through this
+# exchange instead of being dropped. Queues get it from the dead-letter
+# policy of the broker (rabbitmq-policies in docker-compose.yml), so they
+# are declared with the same arguments as before and a running broker
+# keeps its queues. Messages keep their routing key, the queue name
+DEAD_LETTER_EXCHANGE = os.environ.get("DEAD_LETTER_EXCHANGE", "dead_letter_exchange")
+
+
+def lane_of(key, lanes):
+    # Stable across processes, unlike hash() of a str
+    return zlib.crc32(str(key).encode()) % lanes
+
+
+def partition_queue_names(queue_name, partitions=GPS_DATA_PARTITIONS):
+    if partitions == 1:
+        return [queue_name]
+    return [f"{queue_name}.{partition}" for partition in range(partitions)]
+
+
+def partition_queue_name(queue_name, key, partitions=GPS_DATA_PARTITIONS):
+    return partition_queue_names(queue_name, partitions)[lane_of(key, partitions)]
+
+
+async def declare_gps_data_exchange(channel):
+    return await channel.declare_exchange(GPS_DATA_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+
+
+async def declare_queue(channel, queue_name, dead_letter_queue=None):
+    dead_letter_queue = dead_letter_queue or f"{queue_name}.dead"
+    dead_letter_exchange = await channel.declare_exchange(DEAD_LETTER_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True)
+    parked = await channel.declare_queue(dead_letter_queue, durable=True, exclusive=False, auto_delete=False)
+    await parked.bind(dead_letter_exchange, routing_key=queue_name)
+
+    return await channel.declare_queue(queue_name, durable=True, exclusive=False, auto_delete=False)
+
+
+async def declare_partition_queues(channel, queue_name, exchange=None, partitions=GPS_DATA_PARTITIONS):
+    # Messages of all partitions are parked in one queue
+    queues = []
+    for partition_queue in partition_queue_names(queue_name, partitions):
+        queue = await declare_queue(channel, partition_queue, f"{queue_name}.dead")
+        if exchange is not None:
+            await queue.bind(exchange, routing_key=partition_queue)
+        queues.append(queue)
+    return queues
+
+
+async def consume(queue, pool):
+    async with queue.iterator() as queue_iter:
+        async for message in queue_iter:
+            await pool.submit(message)
+            if queue.name in message.body.decode(errors="replace"):
+                break
+
+
+class WorkerPool:
+    # Runs a fixed number of workers over incoming RabbitMQ messages.
+    # A message is acked only after its handler finished, a failed message
+    # is requeued once and dead lettered when it fails again.
+    # submit() blocks while all workers are busy and the queue is full,
+    # which stops the consumer from pulling more messages.
+    #
+    # With key set, every worker gets its own lane and messages with the
+    # same key always go to the same lane, so they are handled one by one
+    # in the order they arrived, while different keys run in parallel
+    def __init__(self, handler, workers=CONSUMER_WORKERS, queue_size=None, key=None, decode=decode_message, stats_interval=CONSUMER_STATS_INTERVAL):
+        self.handler = handler
+        self.workers = workers
+        self.key = key
+        self.decode = decode
+        self.stats_interval = stats_interval
+        self.tasks = []
+
+        queue_size = workers if queue_size is None else queue_size
+        if key is None:
+            self.queues = [asyncio.Queue(maxsize=queue_size)]
+        else:
+            self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+
+        self.in_flight = 0
+        self.handled = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def prefetch_count(self):
+        # Broker never delivers more than the pool can hold
+        return self.workers + sum(queue.maxsize for queue in self.queues)
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self.worker(self.queues[index % len(self.queues)]))
+            for index in range(self.workers)
+        ]
+        if self.stats_interval > 0:
+            self.tasks.append(asyncio.create_task(self.log_stats()))
+
+    async def stop(self):
+        for queue in self.queues:
+            await queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, message):
+        try:
+            payload = self.decode(message.body, message.content_type)
+        except ValueError:
+            self.failed += 1
+            MESSAGES_FAILED.labels(queue=message.routing_key).inc()
+            logger.warning("Rejecting malformed message %s", message.message_id)
+            await self.settle(message.reject(requeue=False))
+            return
+
+        remember_trace(message.headers)
+
+        queue = self.queues[0]
+        if self.key is not None:
+            queue = self.queues[lane_of(self.key(payload), len(self.queues))]
+
+        await queue.put((message, payload))
+
+    async def worker(self, queue):
+        while True:
+            message, payload = await queue.get()
+            self.in_flight += 1
+            IN_FLIGHT.labels(kind="messages").inc()
+            started = time.perf_counter()
+
+            try:
+                await self.handler(payload)
+            except Exception:
+                self.failed += 1
+                MESSAGES_FAILED.labels(queue=message.routing_key).inc()
+                logger.exception("Failed to handle message %s", message.message_id)
+                await self.settle(message.reject(requeue=not message.redelivered))
+            else:
+                self.handled += 1
+                MESSAGES_CONSUMED.labels(queue=message.routing_key).inc()
+                await self.settle(message.ack())
+            finally:
+                latency = time.perf_counter() - started
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                HANDLER_SECONDS.labels(queue=message.routing_key).observe(latency)
+                self.in_flight -= 1
+                IN_FLIGHT.labels(kind="messages").dec()
+                queue.task_done()
+
+    async def settle(self, acknowledgement):
+        # Worker has to survive a closed channel, broker redelivers
+        # unacknowledged messages after reconnect
+        try:
+            await acknowledgement
+        except Exception:
+            logger.exception("Failed to acknowledge message")
+
+    def stats(self):
+        completed = self.handled + self.failed
+        return {
+            "workers": self.workers,
+            "lanes": len(self.queues),
+            "queue_depth": sum(queue.qsize() for queue in self.queues),
+            "in_flight": self.in_flight,
+            "handled": self.handled,
+            "failed": self.failed,
+            "avg_latency_ms": self.total_latency / completed * 1000 if completed else 0.0,
+            "max_latency_ms": self.max_latency * 1000
+        }
+
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logger.info("Consumer stats %s", self.stats())
@@ -0,0 +1,11 @@
+import os
+import motor.motor_asyncio
+from metrics import MongoCommandListener
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# db
+client = motor.motor_asyncio.AsyncIOMotorClient(os.environ.get("MONGODB_URL"), event_listeners=[MongoCommandListener()])
+db = client.vehicle_monitoring_system
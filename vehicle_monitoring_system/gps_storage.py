@@ -0,0 +1,239 @@
+import os
+from pymongo import UpdateOne
+from pymongo.write_concern import WriteConcern
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+
+
+# GPS samples of a trip are stored in bucket documents of at most
+# GPS_BUCKET_SIZE samples, so every ping is a single atomic append
+# instead of a read and a rewrite of the whole trip
+GPS_BUCKET_SIZE = int(os.environ.get("GPS_BUCKET_SIZE", 200))
+
+
+def to_sample(gps_data):
+    sample = {
+        "current_geo_point": gps_data.get("current_geo_point"),
+        "speed": gps_data.get("speed"),
+        "timestamp": gps_data.get("timestamp")
+    }
+    # Left by trajectory compression, see compression.py
+    if "path_km" in gps_data:
+        sample.update(path_km=gps_data["path_km"], path_from=gps_data.get("path_from"))
+    return sample
+
+
+def append_sample_query(gps_data, bucket_size=GPS_BUCKET_SIZE, sample=None):
+    # Filter matches the open (not yet full) bucket of the trip,
+    # if there is none the upsert starts a new one
+    sample = sample if sample is not None else to_sample(gps_data)
+    timestamp = sample["timestamp"]
+
+    bucket_filter = {
+        "trip_id": gps_data.get("trip_id", None),
+        "count": {"$lt": bucket_size}
+    }
+    update = {
+        "$push": {"trip_data": sample},
+        "$inc": {"count": 1},
+        "$min": {"first_timestamp": timestamp},
+        "$max": {"last_timestamp": timestamp},
+        "$setOnInsert": {
+            "driver_id": gps_data.get("driver_id", None),
+            "vehicle_id": gps_data.get("vehicle_id", None)
+        }
+    }
+    return bucket_filter, update
+
+
+def replace_sample_query(gps_data, replaced, sample):
+    # Writes sample over the last written sample of the trip,
+    # in whichever bucket it is
+    bucket_filter = {
+        "trip_id": gps_data.get("trip_id", None),
+        "trip_data": replaced
+    }
+    update = {
+        "$set": {"trip_data.$": sample},
+        "$max": {"last_timestamp": sample["timestamp"]}
+    }
+    return bucket_filter, update
+
+
+def compress_sample(gps_data, compressor=None):
+    # Sample that stores gps_data and the sample it replaces, None for an append
+    if compressor is None:
+        return to_sample(gps_data), None
+    return compressor.compress(gps_data)
+
+
+def store_sample_query(gps_data, sample, replaced, bucket_size=GPS_BUCKET_SIZE):
+    # Filter, update and upsert of the write that stores sample
+    if replaced is None:
+        return (*append_sample_query(gps_data, bucket_size, sample), True)
+    return (*replace_sample_query(gps_data, replaced, sample), False)
+
+
+async def store_missed_samples(collection, writes, bucket_size=GPS_BUCKET_SIZE):
+    # A replace misses when the sample it replaces is not stored the way
+    # the compressor remembers it. writes are (gps_data, sample, replaced)
+    # in the order they were made. The last sample of every run of replaces
+    # has to be left stored, a missing one is written over the latest sample
+    # of its run that is, or appended when none is. Returns the trips of misses
+    trips = {}
+    for write in writes:
+        trips.setdefault(write[0].get("trip_id", None), []).append(write)
+
+    missed = set()
+    for trip_id, trip_writes in trips.items():
+        for index, (gps_data, sample, replaced) in enumerate(trip_writes):
+            if replaced is None or (index + 1 < len(trip_writes) and trip_writes[index + 1][2] is not None):
+                continue
+            if await collection.count_documents({"trip_id": trip_id, "trip_data": sample}, limit=1):
+                continue
+
+            missed.add(trip_id)
+            run = []
+            while index >= 0 and trip_writes[index][2] is not None:
+                run.append(trip_writes[index][2])
+                index -= 1
+            for stored in run:
+                if (await collection.update_one(*replace_sample_query(gps_data, stored, sample))).matched_count:
+                    break
+            else:
+                await collection.update_one(*append_sample_query(gps_data, bucket_size, sample), upsert=True)
+
+    return missed
+
+
+async def find_stored_timestamps(trips):
+    # (trip_id, timestamp) of stored samples of the trips from the earliest
+    # timestamp of each on. A message redelivered after its batch was stored
+    # but not handled finds its sample, samples arriving in order find none
+    clauses = []
+    for trip_id, trip_gps_data in trips.items():
+        timestamps = [gps_data["timestamp"] for gps_data in trip_gps_data if gps_data.get("timestamp") is not None]
+        if timestamps:
+            clauses.append({"trip_id": trip_id, "last_timestamp": {"$gte": min(timestamps)}})
+    if not clauses:
+        return set()
+
+    stored = set()
+    async for bucket in db[MongoDocumentsEnum.GPS_DATA.value].find({"$or": clauses}, {"trip_id": 1, "trip_data.timestamp": 1}):
+        stored.update((bucket["trip_id"], sample["timestamp"]) for sample in bucket["trip_data"])
+    return stored
+
+
+def unstored(trips, stored):
+    # Messages of the trips whose sample isn't stored, each timestamp once
+    stored = set(stored)
+    for trip_id, trip_gps_data in trips.items():
+        for gps_data in trip_gps_data:
+            if gps_data.get("timestamp") is not None:
+                if (trip_id, gps_data["timestamp"]) in stored:
+                    continue
+                stored.add((trip_id, gps_data["timestamp"]))
+            yield gps_data
+
+
+async def append_sample(gps_data, bucket_size=GPS_BUCKET_SIZE, compressor=None):
+    trips = {gps_data.get("trip_id", None): [gps_data]}
+    if not list(unstored(trips, await find_stored_timestamps(trips))):
+        return
+
+    collection = db[MongoDocumentsEnum.GPS_DATA.value]
+    sample, replaced = compress_sample(gps_data, compressor)
+    try:
+        result = await collection.update_one(*store_sample_query(gps_data, sample, replaced, bucket_size))
+        if replaced is not None and not result.matched_count:
+            # Compression starts over from the next sample of the trip
+            compressor.forget(await store_missed_samples(collection, [(gps_data, sample, replaced)], bucket_size))
+    except Exception:
+        if compressor is not None:
+            compressor.forget([gps_data.get("trip_id", None)])
+        raise
+
+
+async def append_samples(gps_data_list, bucket_size=GPS_BUCKET_SIZE, compressor=None):
+    # Samples are grouped by trip, within a trip they keep their arrival order.
+    # The bulk write is ordered so every append sees the bucket counts
+    # left by the previous one. Samples already stored are skipped,
+    # a redelivered batch doesn't add them again
+    trips = {}
+    for gps_data in gps_data_list:
+        trips.setdefault(gps_data.get("trip_id", None), []).append(gps_data)
+
+    writes = [
+        (gps_data, *compress_sample(gps_data, compressor))
+        for gps_data in unstored(trips, await find_stored_timestamps(trips))
+    ]
+
+    if not writes:
+        return None
+
+    collection = db[MongoDocumentsEnum.GPS_DATA.value].with_options(
+        write_concern=WriteConcern(j=True)
+    )
+    try:
+        result = await collection.bulk_write(
+            [UpdateOne(*store_sample_query(gps_data, sample, replaced, bucket_size)) for gps_data, sample, replaced in writes],
+            ordered=True
+        )
+        # Appends always match or upsert, only replaces can miss
+        if result.matched_count + result.upserted_count < len(writes):
+            compressor.forget(await store_missed_samples(collection, writes, bucket_size))
+        return result
+    except Exception:
+        if compressor is not None:
+            compressor.forget(trips.keys())
+        raise
+
+
+async def load_trip_samples(trip_id):
+    samples = []
+
+    cursor = db[MongoDocumentsEnum.GPS_DATA.value].find(
+        {"trip_id": trip_id},
+        {"trip_data": 1}
+    ).sort([("first_timestamp", 1), ("_id", 1)])
+
+    async for bucket in cursor:
+        samples.extend(bucket["trip_data"])
+
+    # Sort is stable, samples with equal timestamps keep their arrival order
+    samples.sort(key=lambda sample: sample["timestamp"])
+
+    return samples
+
+
+async def update_positions(gps_data_list):
+    # Latest position of every vehicle, as a GeoJSON point.
+    # Only the last sample of a vehicle in the batch is written
+    latest = {}
+    for gps_data in gps_data_list:
+        if gps_data.get("vehicle_id", None) is not None:
+            latest[gps_data["vehicle_id"]] = gps_data
+
+    if not latest:
+        return None
+
+    return await db[MongoDocumentsEnum.VEHICLE_POSITIONS.value].bulk_write([
+        UpdateOne(
+            {"vehicle_id": vehicle_id},
+            {
+                "$set": {
+                    "location": {
+                        "type": "Point",
+                        "coordinates": [gps_data["current_geo_point"]["long"], gps_data["current_geo_point"]["lat"]]
+                    },
+                    "speed": gps_data.get("speed"),
+                    "timestamp": gps_data.get("timestamp"),
+                    "trip_id": gps_data.get("trip_id", None),
+                    "driver_id": gps_data.get("driver_id", None)
+                },
+                "$currentDate": {"updated_at": True}
+            },
+            upsert=True
+        )
+        for vehicle_id, gps_data in latest.items()
+    ], ordered=False)
@@ -0,0 +1,92 @@
+import sys
+import asyncio
+import logging
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import OperationFailure
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+
+logger = logging.getLogger(__name__)
+
+# Indexes of every collection, ensured at startup.
+# create_indexes is a no-op for indexes that already exist
+INDEXES = {
+    MongoDocumentsEnum.GPS_DATA: [
+        # Serves appends to the open bucket of a trip
+        # and reading the buckets of a trip in order
+        IndexModel([("trip_id", ASCENDING), ("first_timestamp", ASCENDING)], name="trip_id_first_timestamp")
+    ],
+    MongoDocumentsEnum.TRIP_SCORES: [
+        IndexModel([("trip_id", ASCENDING)], name="trip_id_unique", unique=True),
+        IndexModel([("driver_id", ASCENDING)], name="driver_id")
+    ],
+    MongoDocumentsEnum.VEHICLE_POSITIONS: [
+        IndexModel([("vehicle_id", ASCENDING)], name="vehicle_id_unique", unique=True),
+        IndexModel([("location", GEOSPHERE)], name="location_2dsphere"),
+        # Fleet management service follows positions by update time
+        IndexModel([("updated_at", ASCENDING)], name="updated_at")
+    ]
+}
+
+# Queries on hot paths, each of them has to be served by an index
+HOT_QUERIES = [
+    (MongoDocumentsEnum.GPS_DATA, {"trip_id": "trip", "count": {"$lt": 200}}, None),
+    # Trajectory compression writing over the last sample of a trip
+    (MongoDocumentsEnum.GPS_DATA, {"trip_id": "trip", "trip_data": {"current_geo_point": {"lat": 0, "long": 0}, "speed": 0, "timestamp": 0}}, None),
+    (MongoDocumentsEnum.GPS_DATA, {"trip_id": "trip"}, [("first_timestamp", 1), ("_id", 1)]),
+    (MongoDocumentsEnum.TRIP_SCORES, {"trip_id": {"$in": ["trip"]}}, None),
+    (
+        MongoDocumentsEnum.VEHICLE_POSITIONS,
+        {"location": {"$nearSphere": {"$geometry": {"type": "Point", "coordinates": [0, 0]}, "$maxDistance": 5000}}},
+        None
+    ),
+    (MongoDocumentsEnum.VEHICLE_POSITIONS, {"updated_at": {"$gte": 0}}, None)
+]
+
+
+async def ensure_indexes():
+    for document, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                names = await db[document.value].create_indexes([index])
+                logger.info("Ensured indexes %s on %s", names, document.value)
+            except OperationFailure:
+                # Writes rely on unique indexes, the service doesn't start without them
+                if index.document.get("unique"):
+                    raise
+                logger.exception("Failed to ensure index %s on %s", index.document["name"], document.value)
+
+
+def plan_stages(plan):
+    yield plan["stage"]
+    for child in plan.get("inputStages", []) + [plan[key] for key in ("inputStage", "queryPlan") if key in plan]:
+        yield from plan_stages(child)
+
+
+async def check_hot_queries():
+    # Returns hot queries that would scan the whole collection
+    collection_scans = []
+
+    for document, query, sort in HOT_QUERIES:
+        cursor = db[document.value].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+
+        explanation = await cursor.explain()
+        stages = list(plan_stages(explanation["queryPlanner"]["winningPlan"]))
+        logger.info("%s %s: %s", document.value, query, " <- ".join(stages))
+
+        if "COLLSCAN" in stages:
+            collection_scans.append((document.value, query))
+
+    return collection_scans
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    await ensure_indexes()
+    return 1 if await check_hot_queries() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+import logging
+from gps_storage import append_samples
+
+logger = logging.getLogger(__name__)
+
+# Incoming GPS messages are buffered until either GPS_BATCH_SIZE messages
+# arrived or GPS_BATCH_TIMEOUT_MS passed since the first buffered message,
+# then written with a single bulk write
+GPS_BATCH_SIZE = int(os.environ.get("GPS_BATCH_SIZE", 100))
+GPS_BATCH_TIMEOUT_MS = int(os.environ.get("GPS_BATCH_TIMEOUT_MS", 50))
+
+
+class GpsBatcher:
+    def __init__(self, flushed_handler, batch_size=GPS_BATCH_SIZE, batch_timeout_ms=GPS_BATCH_TIMEOUT_MS, compressor=None):
+        # flushed_handler receives the GPS messages of every batch
+        # once they are stored, all of them, compressed or not
+        self.flushed_handler = flushed_handler
+        self.compressor = compressor
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout_ms / 1000
+
+        self.buffer = []
+        self.timer = None
+        self.lock = asyncio.Lock()
+
+        self.flushed_batches = 0
+        self.flushed_messages = 0
+        self.last_flush_size = 0
+        self.last_flush_latency_ms = 0.0
+
+    async def add(self, gps_data):
+        # Returns once the batch holding gps_data is stored and handled,
+        # raises if it couldn't be stored or handled, so the caller can ack afterwards
+        stored = asyncio.get_running_loop().create_future()
+        self.buffer.append((gps_data, stored))
+
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self.flush_after_timeout())
+
+        await stored
+
+    async def flush_after_timeout(self):
+        await asyncio.sleep(self.batch_timeout)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        # Lock keeps batches in arrival order, a batch is stored
+        # only after the previous one is
+        async with self.lock:
+            if self.timer is not None and self.timer is not asyncio.current_task():
+                self.timer.cancel()
+                self.timer = None
+
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+
+            gps_data_list = [gps_data for gps_data, _ in batch]
+
+            started = time.perf_counter()
+            try:
+                await append_samples(gps_data_list, compressor=self.compressor)
+            except Exception as error:
+                logger.exception("Failed to store %d GPS messages", len(batch))
+                for _, stored in batch:
+                    if not stored.done():
+                        stored.set_exception(error)
+                return
+
+            latency_ms = (time.perf_counter() - started) * 1000
+
+            self.flushed_batches += 1
+            self.flushed_messages += len(batch)
+            self.last_flush_size = len(batch)
+            self.last_flush_latency_ms = latency_ms
+            logger.info(
+                "Flushed %d GPS messages in %.1f ms (%d batches, %d messages in total)",
+                len(batch), latency_ms, self.flushed_batches, self.flushed_messages
+            )
+
+            try:
+                await self.flushed_handler(gps_data_list)
+            except Exception as error:
+                # Failed messages are rejected and redelivered
+                # instead of acked, so their points aren't lost
+                logger.exception("Failed to handle flushed GPS messages")
+                for _, stored in batch:
+                    if not stored.done():
+                        stored.set_exception(error)
+                return
+
+            for _, stored in batch:
+                if not stored.done():
+                    stored.set_result(None)
@@ -0,0 +1,275 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+try:
+    from pymongo import monitoring
+except ImportError:
+    # The gps simulator has no database
+    monitoring = None
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Same module is used by all three services, every service is built
+# from its own folder so each one keeps a copy.
+#
+# Counters, gauges and histograms rendered in the Prometheus text format,
+# served on /metrics by the fleet management service and by a small
+# HTTP exporter on METRICS_PORT in the other services.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# With tracing enabled, messages of a trip carry its id and the time it was
+# dispatched in headers, from the trip dispatch to the points award
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() == "true"
+CORRELATION_ID_HEADER = "x-correlation-id"
+TRACE_STARTED_HEADER = "x-trace-started"
+TRACES_LIMIT = int(os.environ.get("TRACES_LIMIT", 10000))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TRACE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # Updated from Mongo driver threads too
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def labels(self, **labels):
+        return BoundMetric(self, tuple(str(labels[name]) for name in self.label_names))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values):
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+    def render_value(self, label_values, value):
+        return [f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"]
+
+
+class BoundMetric:
+    def __init__(self, metric, label_values):
+        self.metric = metric
+        self.label_values = label_values
+
+    def inc(self, amount=1):
+        self.metric.inc(self.label_values, amount)
+
+    def dec(self, amount=1):
+        self.metric.inc(self.label_values, -amount)
+
+    def set(self, value):
+        self.metric.set(self.label_values, value)
+
+    def observe(self, value):
+        self.metric.observe(self.label_values, value)
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = (*sorted(buckets), float("inf"))
+
+    def observe(self, label_values, value):
+        with self.lock:
+            if (counts := self.values.get(label_values)) is None:
+                # Bucket counts, then sum
+                counts = self.values[label_values] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-1] += value
+
+    def render_value(self, label_values, counts):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(self.label_names, label_values, [('le', format_value(bound))])} {cumulative}")
+        labels = format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {format_value(counts[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+MESSAGES_CONSUMED = Counter("messages_consumed_total", "Messages handled successfully", ["queue"])
+MESSAGES_FAILED = Counter("messages_failed_total", "Messages whose handler failed or that couldn't be decoded", ["queue"])
+MESSAGES_PUBLISHED = Counter("messages_published_total", "Messages published", ["queue"])
+HANDLER_SECONDS = Histogram("message_handler_seconds", "Time spent handling a message", ["queue"])
+IN_FLIGHT = Gauge("in_flight_tasks", "Messages or requests being handled right now", ["kind"])
+MONGO_COMMAND_SECONDS = Histogram("mongo_command_seconds", "Duration of Mongo commands", ["collection", "command"])
+MONGO_COMMAND_FAILURES = Counter("mongo_command_failures_total", "Failed Mongo commands", ["collection", "command"])
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "Duration of HTTP requests", ["method", "route", "status"])
+TRACE_SECONDS = Histogram("trace_seconds", "Time from trip dispatch to a stage of the trip", ["stage"], TRACE_BUCKETS)
+
+
+if monitoring is not None:
+    class MongoCommandListener(monitoring.CommandListener):
+        # Passed to the Mongo client in event_listeners.
+        # Called from the driver threads, commands are matched by request id
+        def __init__(self):
+            self.commands = {}
+
+        def started(self, event):
+            collection = event.command.get(event.command_name)
+            self.commands[(event.connection_id, event.request_id)] = (
+                collection if isinstance(collection, str) else "",
+                event.command_name
+            )
+
+        def succeeded(self, event):
+            if (labels := self.commands.pop((event.connection_id, event.request_id), None)) is not None:
+                MONGO_COMMAND_SECONDS.observe(labels, event.duration_micros / 1e6)
+
+        def failed(self, event):
+            if (labels := self.commands.pop((event.connection_id, event.request_id), None)) is not None:
+                MONGO_COMMAND_SECONDS.observe(labels, event.duration_micros / 1e6)
+                MONGO_COMMAND_FAILURES.inc(labels)
+
+
+async def serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        logger.exception("Failed to serve metrics")
+    finally:
+        writer.close()
+
+
+async def start_exporter(port=METRICS_PORT):
+    # Serves GET /metrics, port 0 disables it
+    if not port:
+        return None
+    server = await asyncio.start_server(serve_metrics, "0.0.0.0", port)
+    logger.info("Serving metrics on port %d", port)
+    return server
+
+
+# Trace start times of recent trips, by correlation id. Messages of a trip
+# are handled in different tasks, after batching, so the start is looked up
+# by id instead of being passed along
+traces = OrderedDict()
+
+
+def remember_trace(headers):
+    if not TRACING_ENABLED or not headers or CORRELATION_ID_HEADER not in headers:
+        return
+
+    correlation_id = str(headers[CORRELATION_ID_HEADER])
+    traces[correlation_id] = float(headers.get(TRACE_STARTED_HEADER, time.time()))
+    traces.move_to_end(correlation_id)
+    while len(traces) > TRACES_LIMIT:
+        traces.popitem(last=False)
+
+
+def trace_headers(correlation_id):
+    # Headers for a message of the trip, a trip seen for the first time
+    # starts its trace now
+    if not TRACING_ENABLED or correlation_id is None:
+        return None
+
+    correlation_id = str(correlation_id)
+    if correlation_id not in traces:
+        remember_trace({CORRELATION_ID_HEADER: correlation_id, TRACE_STARTED_HEADER: time.time()})
+    return {CORRELATION_ID_HEADER: correlation_id, TRACE_STARTED_HEADER: traces[correlation_id]}
+
+
+@contextmanager
+def span(stage, correlation_id):
+    # Logs how long the stage took and how long after the dispatch it ended
+    if not TRACING_ENABLED or correlation_id is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        trace_started = traces.get(str(correlation_id))
+        since_start = time.time() - trace_started if trace_started is not None else None
+        if since_start is not None:
+            TRACE_SECONDS.observe((stage,), since_start)
+        logger.info(
+            "span stage=%s correlation_id=%s duration_ms=%.3f since_dispatch_ms=%s",
+            stage, correlation_id, duration * 1000,
+            f"{since_start * 1000:.3f}" if since_start is not None else "unknown"
+        )
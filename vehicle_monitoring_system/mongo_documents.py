@@ -0,0 +1,9 @@
+from enum import Enum
+
+
+# Define all kinds of documents here
+# So that names of documents can be managed easily
+class MongoDocumentsEnum(Enum):
+    GPS_DATA = "gps_data"
+    TRIP_SCORES = "trip_scores"
+    VEHICLE_POSITIONS = "vehicle_positions"
@@ -0,0 +1,311 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import calendar
+import aio_pika
+import numpy as np
+from datetime import datetime
+from pymongo import UpdateOne
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+from archive import TripArchive
+from codec import encode_message
+
+# Recomputes points of finished trips from their stored GPS samples.
+# Every changed trip is sent to the fleet management service as a points
+# message with its previous points, which corrects the trip result,
+# its driver and the rollups there.
+#
+#   python3 rescoring.py --from 2022-01-01 --to 2022-04-01 --driver <id>
+
+RESCORING_CHUNK_SIZE = int(os.environ.get("RESCORING_CHUNK_SIZE", 1000))
+
+# Point multipliers of "60-80", "80-100" and "100+" bands
+BAND_POINTS = np.array([1, 2, 5], dtype=np.int64)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Vectorized form of scoring.distance, evaluated in the same order
+    p = np.pi/180
+    a = 0.5 - np.cos((lat2-lat1)*p)/2 + np.cos(lat1*p) * \
+        np.cos(lat2*p) * (1-np.cos((lon2-lon1)*p))/2
+    return np.abs(12742 * np.arcsin(np.sqrt(a)))
+
+
+def band_kilometres(lat, long, speed, offsets, path=None):
+    # Kilometres of every trip in the "60-80", "80-100" and "100+" bands.
+    # lat, long and speed hold samples of all trips back to back,
+    # samples of trip i are in [offsets[i], offsets[i+1]). path holds
+    # (path_index, path_km), the kilometres of every pair a sample kept
+    # by trajectory compression carries from the sample before it,
+    # its index repeated for each, in the order they were received
+    number_of_trips = len(offsets) - 1
+    if len(speed) < 2:
+        return np.zeros((number_of_trips, 3))
+
+    trip_index = np.repeat(np.arange(number_of_trips), np.diff(offsets))
+
+    # Pairs of consecutive samples that belong to the same trip
+    same_trip = trip_index[:-1] == trip_index[1:]
+
+    avg_speed = np.trunc((speed[:-1]+speed[1:]) / 2)
+    band = np.select(
+        [avg_speed < 60, avg_speed < 80, avg_speed < 100],
+        [-1, 0, 1],
+        default=2
+    )
+    mask = same_trip & (band >= 0)
+
+    kilometres = haversine(lat[:-1][mask], long[:-1][mask], lat[1:][mask], long[1:][mask])
+    bins = trip_index[:-1][mask]*3 + band[mask]
+    if path is not None and len(path[0]):
+        # A pair that carries kilometres takes one slot for each of them
+        path_index, path_km = path
+        pairs = path_index - 1
+        scored = mask[pairs]
+        slots = (np.cumsum(mask) - 1)[pairs[scored]]
+        counts = np.bincount(slots, minlength=len(kilometres))
+        repeats = np.maximum(counts, 1)
+        bins, kilometres = np.repeat(bins, repeats), np.repeat(kilometres, repeats)
+        first_slot = np.cumsum(repeats) - repeats
+        kilometres[first_slot[slots] + np.arange(len(slots)) - np.searchsorted(slots, slots)] = path_km[scored]
+
+    # bincount adds weights in sample order, same as the scalar loop
+    return np.bincount(
+        bins,
+        weights=kilometres,
+        minlength=number_of_trips*3
+    ).reshape(number_of_trips, 3)
+
+
+def points_from_band_kilometres(kilometres_by_band):
+    return (np.trunc(kilometres_by_band).astype(np.int64) * BAND_POINTS).sum(axis=1)
+
+
+def score_trips(lat, long, speed, offsets, path=None):
+    return points_from_band_kilometres(band_kilometres(lat, long, speed, offsets, path))
+
+
+def to_arrays(trips_samples):
+    lengths = [len(samples) for samples in trips_samples]
+    offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    count = int(offsets[-1])
+    samples = [sample for trip_samples in trips_samples for sample in trip_samples]
+    lat = np.fromiter((sample["current_geo_point"]["lat"] for sample in samples), dtype=np.float64, count=count)
+    long = np.fromiter((sample["current_geo_point"]["long"] for sample in samples), dtype=np.float64, count=count)
+    speed = np.fromiter((sample["speed"] for sample in samples), dtype=np.float64, count=count)
+
+    # Same rule as scoring.pair_distances, path_km only counts
+    # when the sample before it is the one it was carried from
+    path_from = np.fromiter((sample.get("path_from", np.nan) for sample in samples), dtype=np.float64, count=count)
+    timestamp = np.fromiter((sample["timestamp"] for sample in samples), dtype=np.float64, count=count)
+    carried = np.zeros(count, dtype=bool)
+    carried[1:] = path_from[1:] == timestamp[:-1]
+    carried[offsets[:-1][offsets[:-1] < count]] = False
+
+    path_index, path_km = [], []
+    for index in np.flatnonzero(carried).tolist():
+        # Samples compressed before keep only the sum
+        kilometres = samples[index]["path_km"]
+        kilometres = kilometres if isinstance(kilometres, list) else [kilometres]
+        path_index.extend([index] * len(kilometres))
+        path_km.extend(kilometres)
+
+    return lat, long, speed, offsets, (np.array(path_index, dtype=np.int64), np.array(path_km, dtype=np.float64))
+
+
+async def find_trips(date_from=None, date_to=None, driver_ids=None):
+    # Only trips that were awarded points are rescored
+    match = {"points": {"$exists": True}}
+    if driver_ids:
+        match["driver_id"] = {"$in": driver_ids}
+
+    trips = {}
+    async for trip_score in db[MongoDocumentsEnum.TRIP_SCORES.value].find(
+        match, {"trip_id": 1, "driver_id": 1, "points": 1, "kilometres": 1, "last_sample.timestamp": 1, "archived": 1, "started": 1}
+    ):
+        trips[trip_score["trip_id"]] = trip_score
+
+    if date_from is None and date_to is None:
+        return list(trips.values())
+
+    started = {}
+    if date_from is not None:
+        started["$gte"] = date_from
+    if date_to is not None:
+        started["$lt"] = date_to
+
+    # Archived trips keep their start with the score, their samples are gone
+    trip_ids = [
+        trip_id for trip_id, trip in trips.items()
+        if "archived" in trip
+        and (date_from is None or trip["started"] >= date_from)
+        and (date_to is None or trip["started"] < date_to)
+    ]
+    async for trip in db[MongoDocumentsEnum.GPS_DATA.value].aggregate([
+        {"$match": {"trip_id": {"$in": [trip_id for trip_id, trip in trips.items() if "archived" not in trip]}}},
+        {"$group": {"_id": "$trip_id", "started": {"$min": "$first_timestamp"}}},
+        {"$match": {"started": started}}
+    ]):
+        trip_ids.append(trip["_id"])
+
+    return [trips[trip_id] for trip_id in trip_ids]
+
+
+async def load_trips_samples(trip_ids):
+    samples = {trip_id: [] for trip_id in trip_ids}
+
+    cursor = db[MongoDocumentsEnum.GPS_DATA.value].find(
+        {"trip_id": {"$in": trip_ids}},
+        {"trip_id": 1, "trip_data": 1}
+    ).sort([("first_timestamp", 1), ("_id", 1)])
+
+    async for bucket in cursor:
+        samples[bucket["trip_id"]].extend(bucket["trip_data"])
+
+    for trip_samples in samples.values():
+        trip_samples.sort(key=lambda sample: sample["timestamp"])
+
+    return [samples[trip_id] for trip_id in trip_ids]
+
+
+async def load_trips_arrays(trips, archive):
+    # Arrays of band_kilometres, samples of archived trips are read from the
+    # archive. Archived trips with their band kilometres in it are scored
+    # from those, its coordinates and speeds are rounded. Returns the arrays,
+    # those kilometres, zero for other trips, and whether every trip was found
+    live_ids = [trip["trip_id"] for trip in trips if "archived" not in trip]
+    live_samples = dict(zip(live_ids, await load_trips_samples(live_ids))) if live_ids else {}
+
+    parts, found = [], []
+    kilometres = np.zeros((len(trips), 3))
+    for index, trip in enumerate(trips):
+        if trip["trip_id"] in live_samples:
+            lat, long, speed, _, (path_index, path_km) = to_arrays([live_samples[trip["trip_id"]]])
+            parts.append((lat, long, speed, path_index, path_km))
+            found.append(True)
+        elif (samples := archive.trip(trip["trip_id"], trip.get("started"))) is not None and samples.kilometres() is not None:
+            kilometres[index] = samples.kilometres()[0]
+            parts.append((np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0)))
+            found.append(True)
+        elif samples is not None:
+            parts.append((
+                samples.lat_degrees(), samples.long_degrees(), samples.speed.astype(np.float64), *samples.path()
+            ))
+            found.append(True)
+        else:
+            parts.append((np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0)))
+            found.append(False)
+
+    offsets = np.zeros(len(parts)+1, dtype=np.int64)
+    np.cumsum([len(part[2]) for part in parts], out=offsets[1:])
+    # Path indexes are per trip, shifted to where its samples start
+    parts = [(*part[:3], part[3] + offset, part[4]) for part, offset in zip(parts, offsets)]
+    lat, long, speed, path_index, path_km = (
+        np.concatenate([part[column] for part in parts]) if parts else np.zeros(0, dtype=np.int64 if column == 3 else np.float64)
+        for column in range(5)
+    )
+
+    return (lat, long, speed, offsets, (path_index, path_km)), kilometres, found
+
+
+def correction_message(trip, points):
+    # Kilometres and finish time let the fleet management
+    # service add a trip it has no result of yet
+    return {
+        "trip_id": trip["trip_id"],
+        "driver_id": trip["driver_id"],
+        "points": points,
+        "previous_points": trip["points"],
+        "kilometres": trip.get("kilometres"),
+        "finished_at": (trip.get("last_sample") or {}).get("timestamp") or trip.get("started")
+    }
+
+
+async def send_corrections(channel, corrections, queue_name):
+    for correction in corrections:
+        await channel.default_exchange.publish(
+            aio_pika.Message(**encode_message(correction), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+            routing_key=queue_name
+        )
+
+
+async def rescore(channel, date_from=None, date_to=None, driver_ids=None, dry_run=False, chunk_size=RESCORING_CHUNK_SIZE, archive=None,
+                  queue_name=None):
+    queue_name = queue_name or os.environ.get("SEND_POINTS_QUEUE")
+    archive = archive if archive is not None else TripArchive()
+    trips = await find_trips(date_from, date_to, driver_ids)
+    print(f"Rescoring {len(trips)} trips")
+
+    driver_corrections = {}
+    started = time.perf_counter()
+
+    for chunk_start in range(0, len(trips), chunk_size):
+        chunk = trips[chunk_start:chunk_start+chunk_size]
+
+        arrays, kilometres, found = await load_trips_arrays(chunk, archive)
+        points = points_from_band_kilometres(band_kilometres(*arrays) + kilometres)
+
+        trip_updates, corrections = [], []
+        for trip, trip_points, trip_found in zip(chunk, points.tolist(), found):
+            if not trip_found:
+                # Scoring no samples would take all points of the trip away
+                print(f"Samples of archived trip {trip['trip_id']} not found in {archive.path}, skipped")
+                continue
+            if trip_points == trip["points"]:
+                continue
+
+            driver_id = trip["driver_id"]
+            driver_corrections[driver_id] = driver_corrections.get(driver_id, 0) + trip_points - trip["points"]
+            trip_updates.append(UpdateOne({"trip_id": trip["trip_id"]}, {"$set": {"points": trip_points}}))
+            corrections.append(correction_message(trip, trip_points))
+
+        # Trip scores are corrected once their corrections are sent,
+        # a failure in between sends them again next time
+        if trip_updates and not dry_run:
+            await send_corrections(channel, corrections, queue_name)
+            await db[MongoDocumentsEnum.TRIP_SCORES.value].bulk_write(trip_updates, ordered=False)
+
+        done = chunk_start + len(chunk)
+        elapsed = time.perf_counter() - started
+        print(f"Rescored {done}/{len(trips)} trips ({done/elapsed:.0f} trips/s), {len(driver_corrections)} drivers corrected so far")
+
+    corrected = sum(correction != 0 for correction in driver_corrections.values())
+    print(f"Corrected points of {corrected} drivers" + (" (dry run)" if dry_run else ""))
+    return driver_corrections
+
+
+def parse_date(value):
+    return calendar.timegm(datetime.fromisoformat(value).utctimetuple())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute driver points of finished trips")
+    parser.add_argument("--from", dest="date_from", type=parse_date, help="only trips started at or after this UTC date")
+    parser.add_argument("--to", dest="date_to", type=parse_date, help="only trips started before this UTC date")
+    parser.add_argument("--driver", dest="driver_ids", action="append", help="only trips of this driver, can be repeated")
+    parser.add_argument("--chunk-size", type=int, default=RESCORING_CHUNK_SIZE, help="trips scored together")
+    parser.add_argument("--dry-run", action="store_true", help="report corrections without writing them")
+    args = parser.parse_args(argv)
+
+    async def run():
+        connection = await aio_pika.connect_robust(host=os.environ.get("RABBITMQ_HOST"), port=5672)
+        async with connection:
+            await rescore(
+                await connection.channel(),
+                date_from=args.date_from,
+                date_to=args.date_to,
+                driver_ids=args.driver_ids,
+                dry_run=args.dry_run,
+                chunk_size=args.chunk_size
+            )
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
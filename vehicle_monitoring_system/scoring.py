@@ -0,0 +1,150 @@
+from math import cos, asin, sqrt, pi
+from pymongo import UpdateOne
+from dependencies import db
+from mongo_documents import MongoDocumentsEnum
+
+
+# Optimized formula for calculating distance between two geo points
+# https://stackoverflow.com/questions/27928/calculate-distance-between-two-latitude-longitude-points-haversine-formula
+def distance(lat1, lon1, lat2, lon2):
+    p = pi/180
+    a = 0.5 - cos((lat2-lat1)*p)/2 + cos(lat1*p) * \
+        cos(lat2*p) * (1-cos((lon2-lon1)*p))/2
+    return abs(12742 * asin(sqrt(a)))
+
+
+def pair_distances(previous, sample):
+    # Kilometres from previous to sample, one value per pair of received
+    # samples. A sample kept by trajectory compression carries those of the
+    # samples dropped before it, added one by one they sum up exactly like
+    # incremental scoring of every received sample did
+    if "path_km" in sample and sample.get("path_from") == previous["timestamp"]:
+        # Samples compressed before keep only their sum
+        return sample["path_km"] if isinstance(sample["path_km"], list) else [sample["path_km"]]
+    return [distance(
+        previous["current_geo_point"]["lat"],
+        previous["current_geo_point"]["long"],
+        sample["current_geo_point"]["lat"],
+        sample["current_geo_point"]["long"]
+    )]
+
+
+def speed_band(avg_speed):
+    if avg_speed < 60:
+        return None
+
+    if avg_speed >= 60 and avg_speed < 80:
+        return "60-80"
+    elif avg_speed >= 80 and avg_speed < 100:
+        return "80-100"
+    else:
+        return "100+"
+
+
+def points_from_kilometres(speed_boundaries_kilometeres):
+    return int(speed_boundaries_kilometeres["60-80"]) + \
+        int(speed_boundaries_kilometeres["80-100"])*2 + \
+        int(speed_boundaries_kilometeres["100+"])*5
+
+
+def new_score_state(trip_id):
+    return {
+        "trip_id": trip_id,
+        "kilometres": {
+            "0-60": 0.0,  # no points, only counts towards the trip distance
+            "60-80": 0.0,  # 1 point per km
+            "80-100": 0.0,  # 2 points per km
+            "100+": 0.0  # 5 points per km
+        },
+        "last_sample": None,
+        "samples": 0,
+        "out_of_order": False
+    }
+
+
+def add_sample(state, gps_data):
+    # Same per pair arithmetic, in the same order, as the batch calculation,
+    # so the running totals match it exactly
+    sample = {
+        "current_geo_point": gps_data.get("current_geo_point"),
+        "speed": gps_data.get("speed"),
+        "timestamp": gps_data.get("timestamp")
+    }
+    if "path_km" in gps_data:
+        sample.update(path_km=gps_data["path_km"], path_from=gps_data.get("path_from"))
+    last_sample = state["last_sample"]
+
+    if last_sample is not None:
+        if sample["timestamp"] < last_sample["timestamp"]:
+            # Batch calculation orders samples by timestamp,
+            # a late sample can only be scored exactly by it
+            state["out_of_order"] = True
+
+        avg_speed = int((last_sample["speed"]+sample["speed"]) / 2)
+
+        # States saved before slow kilometres were counted have no "0-60"
+        key = speed_band(avg_speed) or "0-60"
+        for kilometres in pair_distances(last_sample, sample):
+            state["kilometres"][key] = state["kilometres"].get(key, 0.0) + kilometres
+
+    state["last_sample"] = sample
+    state["samples"] += 1
+    return state
+
+
+class TripScorer:
+    # Keeps the running score of every active trip in memory and persists
+    # it in the trip_scores collection, so a restarted service continues
+    # where it stopped
+    def __init__(self):
+        self.states = {}
+
+    async def load_states(self, trip_ids):
+        missing = [trip_id for trip_id in trip_ids if trip_id not in self.states]
+        if not missing:
+            return
+
+        async for state in db[MongoDocumentsEnum.TRIP_SCORES.value].find(
+            {"trip_id": {"$in": missing}}, {"_id": 0}
+        ):
+            self.states[state["trip_id"]] = state
+
+        for trip_id in missing:
+            self.states.setdefault(trip_id, new_score_state(trip_id))
+
+    async def add_samples(self, gps_data_list):
+        trip_ids = list(dict.fromkeys(gps_data.get("trip_id", None) for gps_data in gps_data_list))
+        await self.load_states(trip_ids)
+
+        for gps_data in gps_data_list:
+            add_sample(self.states[gps_data.get("trip_id", None)], gps_data)
+
+        if trip_ids:
+            await db[MongoDocumentsEnum.TRIP_SCORES.value].bulk_write([
+                UpdateOne({"trip_id": trip_id}, {"$set": self.states[trip_id]}, upsert=True)
+                for trip_id in trip_ids
+            ], ordered=False)
+
+    async def finish(self, trip_id):
+        # Kilometres of the trip per speed band,
+        # None when the trip can't be scored incrementally
+        await self.load_states([trip_id])
+        state = self.states.pop(trip_id)
+
+        if state["out_of_order"]:
+            return None
+
+        return state["kilometres"]
+
+    async def record_points(self, trip_id, driver_id, points, compression=None):
+        # Awarded points are kept with the trip score,
+        # rescoring compares against them. compression holds samples
+        # received and stored for the trip when it was compressed
+        update = {"driver_id": driver_id, "points": points}
+        if compression is not None:
+            update["compression"] = compression
+        await db[MongoDocumentsEnum.TRIP_SCORES.value].update_one(
+            {"trip_id": trip_id},
+            {"$set": update},
+            upsert=True
+        )
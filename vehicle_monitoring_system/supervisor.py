@@ -0,0 +1,120 @@
+import os
+import time
+import queue
+import signal
+import asyncio
+import logging
+import multiprocessing
+from dotenv import load_dotenv
+from consumer_runtime import CONSUMER_STATS_INTERVAL, GPS_DATA_PARTITIONS
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# With more than one process the service runs as a supervisor that starts
+# VMS_PROCESSES worker processes, each consuming its own share of the
+# GPS data partitions, and restarts the ones that crash
+VMS_PROCESSES = int(os.environ.get("VMS_PROCESSES", 1))
+VMS_RESTART_DELAY = float(os.environ.get("VMS_RESTART_DELAY", 1))
+
+
+def run_worker(worker_index, processes, stats_queue):
+    # Every worker imports the service from scratch, so it opens
+    # its own RabbitMQ connection and Mongo client
+    from app import main
+    asyncio.run(main(worker_index, processes, stats_queue))
+
+
+def aggregate_stats(stats_by_worker):
+    totals = {
+        "processes": len(stats_by_worker),
+        "queue_depth": 0,
+        "in_flight": 0,
+        "handled": 0,
+        "failed": 0,
+        "flushed_batches": 0,
+        "flushed_messages": 0,
+        "avg_latency_ms": 0.0,
+        "max_latency_ms": 0.0
+    }
+
+    for stats in stats_by_worker.values():
+        completed = stats["handled"] + stats["failed"]
+        totals["avg_latency_ms"] += stats["avg_latency_ms"] * completed
+        totals["max_latency_ms"] = max(totals["max_latency_ms"], stats["max_latency_ms"])
+        for key in ("queue_depth", "in_flight", "handled", "failed", "flushed_batches", "flushed_messages"):
+            totals[key] += stats[key]
+
+    completed = totals["handled"] + totals["failed"]
+    totals["avg_latency_ms"] = totals["avg_latency_ms"] / completed if completed else 0.0
+    return totals
+
+
+def supervise(processes=VMS_PROCESSES, stats_interval=CONSUMER_STATS_INTERVAL):
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    if processes > GPS_DATA_PARTITIONS:
+        logger.warning(
+            "Only %d GPS data partitions, starting %d processes instead of %d",
+            GPS_DATA_PARTITIONS, GPS_DATA_PARTITIONS, processes
+        )
+        processes = GPS_DATA_PARTITIONS
+
+    # Mongo clients are not fork safe, workers start in a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    stats_queue = context.Queue()
+    workers = {}
+    started = {}
+    stats_by_worker = {}
+    stopping = False
+
+    def start_worker(worker_index):
+        worker = context.Process(
+            target=run_worker,
+            args=(worker_index, processes, stats_queue),
+            name=f"vms-worker-{worker_index}",
+            daemon=True
+        )
+        worker.start()
+        workers[worker_index] = worker
+        started[worker_index] = time.monotonic()
+        logger.info("Started worker %d (pid %d)", worker_index, worker.pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker_index in range(processes):
+        start_worker(worker_index)
+
+    last_report = time.monotonic()
+
+    while not stopping and workers:
+        try:
+            worker_index, stats = stats_queue.get(timeout=1)
+            stats_by_worker[worker_index] = stats
+        except queue.Empty:
+            pass
+
+        for worker_index, worker in list(workers.items()):
+            if worker.is_alive():
+                continue
+
+            if worker.exitcode == 0:
+                logger.info("Worker %d finished", worker_index)
+                del workers[worker_index]
+            elif time.monotonic() - started[worker_index] >= VMS_RESTART_DELAY:
+                logger.error("Worker %d exited with %s, restarting it", worker_index, worker.exitcode)
+                start_worker(worker_index)
+
+        if stats_interval > 0 and time.monotonic() - last_report >= stats_interval:
+            last_report = time.monotonic()
+            logger.info("Supervisor stats %s", aggregate_stats(stats_by_worker))
+
+    for worker in workers.values():
+        worker.terminate()
+    for worker in workers.values():
+        worker.join()
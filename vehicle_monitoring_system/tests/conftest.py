@@ -0,0 +1,43 @@
+import os
+import sys
+import pytest
+
+# Modules of the service import each other by name, as when run from its folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    # Every module that imported db gets the same in-memory database
+    import gps_storage
+    import indexes
+    import scoring
+
+    monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "with_options", lambda collection, **options: collection, raising=False)
+    database = mongomock_motor.AsyncMongoMockClient().vehicle_monitoring_system
+    for module in (gps_storage, indexes, scoring):
+        monkeypatch.setattr(module, "db", database)
+    return database
+
+
+@pytest.fixture
+def published(monkeypatch, fake_db):
+    # Points messages app.py publishes, with a fresh trip scorer
+    import app
+    from scoring import TripScorer
+
+    published = []
+
+    async def publish(channel, body, queue_name, headers=None):
+        published.append(body)
+
+    monkeypatch.setattr(app, "publish", publish)
+    monkeypatch.setattr(app, "trip_scorer", TripScorer())
+    return published
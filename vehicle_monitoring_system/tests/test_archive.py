@@ -0,0 +1,40 @@
+import numpy as np
+from archive import COORDINATE_SCALE, TripArchive, write_segment
+from rescoring import band_kilometres, to_arrays
+
+
+def trip(trip_id, timestamps, speeds):
+    samples = [
+        {
+            "current_geo_point": {"lat": 43.85 + index * 0.000123456789, "long": 18.38 - index * 0.000987654321},
+            "speed": speed,
+            "timestamp": timestamp
+        }
+        for index, (timestamp, speed) in enumerate(zip(timestamps, speeds))
+    ]
+    samples[-1].update(path_km=[0.1, 0.2], path_from=timestamps[-2])
+    return {"trip_id": trip_id, "driver_id": f"driver-{trip_id}", "vehicle_id": f"vehicle-{trip_id}", "samples": samples}
+
+
+def test_samples_read_back(tmp_path):
+    trips = [
+        trip("whole", [1650000000 + index * 3 for index in range(5)], [60, 70, 80, 90, 300]),
+        trip("fractional", [1650000001.25 + index * 2.1 for index in range(5)], [59.5, 60.4, 99.6, 100.2, 120.7])
+    ]
+    write_segment(str(tmp_path), trips)
+
+    archive = TripArchive(str(tmp_path))
+    for expected in trips:
+        samples = archive.trip(expected["trip_id"], expected["samples"][0]["timestamp"])
+        assert samples.lat.dtype == samples.long.dtype == np.int32 and samples.speed.dtype == np.uint8
+
+        messages = list(samples.to_messages())
+        for message, sample in zip(messages, expected["samples"]):
+            assert message["timestamp"] == sample["timestamp"]
+            assert abs(message["current_geo_point"]["lat"] - sample["current_geo_point"]["lat"]) <= 1 / COORDINATE_SCALE
+            assert message["speed"] == min(round(sample["speed"]), 255)
+        assert messages[-1]["path_km"] == [0.1, 0.2]
+        assert messages[-1]["path_from"] == expected["samples"][-2]["timestamp"]
+
+        # Band kilometres are those of the samples as received
+        assert samples.kilometres().tolist() == band_kilometres(*to_arrays([expected["samples"]])).tolist()
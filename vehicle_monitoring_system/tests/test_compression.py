@@ -0,0 +1,86 @@
+import random
+import pytest
+import app
+from archive import COLUMNS, Samples, encode_trips
+from compression import TrajectoryCompressor
+from gps_storage import append_sample, append_samples, load_trip_samples
+from ingestion import GpsBatcher
+from rescoring import points_from_band_kilometres, score_trips, to_arrays
+
+pytestmark = pytest.mark.anyio
+
+
+def straight_trip(trip_id, samples, seed=0):
+    # Steady stretches along a line, most samples are dropped
+    rng = random.Random(seed)
+    messages = [
+        {
+            "trip_id": trip_id,
+            "driver_id": f"driver-{trip_id}",
+            "vehicle_id": f"vehicle-{trip_id}",
+            "current_geo_point": {"lat": 43.85 + index * 0.0005 + rng.uniform(0, 0.00001), "long": 18.38},
+            "speed": 70 + rng.randint(0, 5) if (index // 40) % 2 else 105 + rng.randint(0, 5),
+            "timestamp": 1650000000 + index
+        }
+        for index in range(samples)
+    ]
+    messages[-1]["trip_finished"] = True
+    return messages
+
+
+async def test_compressed_trip_scores_exactly(fake_db, published, monkeypatch):
+    compressor = TrajectoryCompressor()
+    monkeypatch.setattr(app, "trajectory_compressor", compressor)
+    messages = straight_trip("trip", 300)
+
+    batcher = GpsBatcher(lambda batch: app.batch_handler(batch, None), batch_size=7, batch_timeout_ms=1, compressor=compressor)
+    for message in messages:
+        await batcher.add(message)
+
+    stored = await load_trip_samples("trip")
+    assert len(stored) < len(messages) / 5
+
+    # Incremental scoring saw every sample, the rest add what was stored
+    kilometres = published[0]["kilometres"]
+    assert await app.calculate_kilometres_from_gps_data({"trip_id": "trip"}) == kilometres
+    assert score_trips(*to_arrays([stored])).tolist() == [published[0]["points"]]
+
+    table, columns = encode_trips([{"trip_id": "trip", "samples": stored}])
+    samples = Samples(table, *(columns[column] for column in COLUMNS), columns["path_index"], columns["path_km"])
+    assert points_from_band_kilometres(samples.kilometres()).tolist() == [published[0]["points"]]
+
+
+async def test_missed_replace_is_appended(fake_db):
+    compressor = TrajectoryCompressor()
+    messages = straight_trip("trip", 6)
+    for message in messages[:3]:
+        await append_sample(message, compressor=compressor)
+
+    # The sample the next one replaces is gone, e.g. written by another process
+    last = (await load_trip_samples("trip"))[-1]
+    await fake_db.gps_data.update_one({"trip_id": "trip"}, {"$pull": {"trip_data": last}, "$inc": {"count": -1}})
+
+    for message in messages[3:]:
+        await append_sample(message, compressor=compressor)
+
+    stored = await load_trip_samples("trip")
+    # Appended after the sample it was carried from, then compression starts over
+    assert [sample["timestamp"] for sample in stored][:2] == [messages[0]["timestamp"], messages[3]["timestamp"]]
+    assert len(stored[1]["path_km"]) == 3
+    assert stored[-1]["timestamp"] == messages[-1]["timestamp"]
+
+
+async def test_missed_replaces_in_a_batch_keep_the_last(fake_db):
+    compressor = TrajectoryCompressor()
+    messages = straight_trip("trip", 6)
+    await append_samples(messages[:3], compressor=compressor)
+
+    last = (await load_trip_samples("trip"))[-1]
+    await fake_db.gps_data.update_one({"trip_id": "trip"}, {"$pull": {"trip_data": last}, "$inc": {"count": -1}})
+
+    # Every replace of the batch misses, only the sample left by the last one is kept
+    await append_samples(messages[3:], compressor=compressor)
+
+    stored = await load_trip_samples("trip")
+    assert [sample["timestamp"] for sample in stored] == [messages[0]["timestamp"], messages[-1]["timestamp"]]
+    assert len(stored[1]["path_km"]) == 5
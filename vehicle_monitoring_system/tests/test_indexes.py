@@ -0,0 +1,43 @@
+import os
+import pytest
+import indexes
+from pymongo.errors import OperationFailure
+from indexes import HOT_QUERIES, check_hot_queries, ensure_indexes
+from mongo_documents import MongoDocumentsEnum
+
+pytestmark = pytest.mark.anyio
+
+
+def leading_fields(query, sort):
+    # Fields an index can start with to serve the query
+    return set(query) | ({sort[0][0]} if sort else set())
+
+
+async def test_hot_queries_are_indexed(fake_db):
+    # mongomock has no query planner, an index is a candidate when its first key is filtered or sorted on
+    await ensure_indexes()
+    for document, query, sort in HOT_QUERIES:
+        information = await fake_db[document.value].index_information()
+        first_keys = {next(iter(dict(index["key"]))) for name, index in information.items() if name != "_id_"}
+        assert first_keys & leading_fields(query, sort), (document.value, query)
+
+
+@pytest.mark.skipif("TEST_MONGODB_URL" not in os.environ, reason="explain needs a MongoDB server")
+async def test_hot_queries_do_not_scan_collections(monkeypatch):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(os.environ["TEST_MONGODB_URL"])
+    monkeypatch.setattr(indexes, "db", client.test_vehicle_monitoring_system)
+    try:
+        await ensure_indexes()
+        assert await check_hot_queries() == []
+    finally:
+        await client.drop_database("test_vehicle_monitoring_system")
+
+
+async def test_duplicate_trip_scores_stop_startup(fake_db):
+    trip_scores = fake_db[MongoDocumentsEnum.TRIP_SCORES.value]
+    await trip_scores.insert_many([{"trip_id": "trip", "points": 1}, {"trip_id": "trip", "points": 2}])
+
+    with pytest.raises(OperationFailure):
+        await ensure_indexes()
@@ -0,0 +1,155 @@
+import random
+import asyncio
+import pytest
+import app
+from codec import encode_message
+from consumer_runtime import WorkerPool
+from gps_storage import GPS_BUCKET_SIZE, load_trip_samples
+from ingestion import GpsBatcher
+from scoring import distance, points_from_kilometres, speed_band
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeMessage:
+    # The part of aio_pika.IncomingMessage the worker pool uses
+    def __init__(self, body, redelivered=False):
+        encoded = encode_message(body)
+        self.body = encoded["body"]
+        self.content_type = encoded["content_type"]
+        self.routing_key = "gps_data_queue"
+        self.message_id = None
+        self.headers = {}
+        self.redelivered = redelivered
+        self.settled = None
+
+    async def ack(self):
+        self.settled = "ack"
+
+    async def reject(self, requeue=False):
+        self.settled = "requeue" if requeue else "reject"
+
+
+def trip_messages(trip_id, samples, seed=0):
+    rng = random.Random(seed)
+    messages = [
+        {
+            "trip_id": trip_id,
+            "driver_id": f"driver-{trip_id}",
+            "vehicle_id": f"vehicle-{trip_id}",
+            "current_geo_point": {"lat": 43.85 + index * 0.002, "long": 18.38 + rng.uniform(-0.001, 0.001)},
+            "speed": rng.randint(40, 130),
+            "timestamp": 1650000000 + index
+        }
+        for index in range(samples)
+    ]
+    messages[-1]["trip_finished"] = True
+    return messages
+
+
+def expected_points(messages):
+    # Scalar scoring of the samples in timestamp order, as the VMS did before batching
+    samples = sorted(messages, key=lambda message: message["timestamp"])
+    kilometres = {"0-60": 0.0, "60-80": 0.0, "80-100": 0.0, "100+": 0.0}
+    for previous, sample in zip(samples, samples[1:]):
+        band = speed_band(int((previous["speed"] + sample["speed"]) / 2)) or "0-60"
+        kilometres[band] += distance(
+            previous["current_geo_point"]["lat"], previous["current_geo_point"]["long"],
+            sample["current_geo_point"]["lat"], sample["current_geo_point"]["long"]
+        )
+    return points_from_kilometres(kilometres)
+
+
+async def assert_buckets(fake_db, trip_id, messages):
+    buckets = [bucket async for bucket in fake_db.gps_data.find({"trip_id": trip_id})]
+    assert sum(bucket["count"] for bucket in buckets) == len(messages)
+    for bucket in buckets:
+        timestamps = [sample["timestamp"] for sample in bucket["trip_data"]]
+        assert bucket["count"] == len(timestamps) <= GPS_BUCKET_SIZE
+        assert bucket["first_timestamp"] == min(timestamps)
+        assert bucket["last_timestamp"] == max(timestamps)
+
+    stored = await load_trip_samples(trip_id)
+    assert [sample["timestamp"] for sample in stored] == sorted(message["timestamp"] for message in messages)
+
+
+async def test_out_of_order_batches(fake_db, published):
+    messages = trip_messages("trip", GPS_BUCKET_SIZE * 2 + 50)
+    # Late samples everywhere but the last one, which finishes the trip
+    shuffled = messages[:-1]
+    random.Random(1).shuffle(shuffled)
+    shuffled.append(messages[-1])
+
+    batcher = GpsBatcher(lambda batch: app.batch_handler(batch, None), batch_size=7, batch_timeout_ms=1)
+    for message in shuffled:
+        await batcher.add(message)
+
+    await assert_buckets(fake_db, "trip", messages)
+    assert [body["points"] for body in published] == [expected_points(messages)]
+    trip_score = await fake_db.trip_scores.find_one({"trip_id": "trip"})
+    assert trip_score["out_of_order"]
+    assert trip_score["points"] == expected_points(messages)
+
+
+async def test_concurrent_batches(fake_db, published):
+    trips = {f"trip-{index}": trip_messages(f"trip-{index}", 60 + index * 11, seed=index) for index in range(8)}
+
+    batcher = GpsBatcher(lambda batch: app.batch_handler(batch, None), batch_size=8, batch_timeout_ms=2)
+    pool = WorkerPool(batcher.add, workers=16, key=lambda message: message.get("trip_id"), stats_interval=0)
+    pool.start()
+
+    # Trips interleaved, every trip in order, each fed by its own producer
+    async def produce(messages):
+        for message in messages:
+            await pool.submit(FakeMessage(message))
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(produce(messages) for messages in trips.values()))
+    await pool.stop()
+
+    assert pool.failed == 0
+    for trip_id, messages in trips.items():
+        await assert_buckets(fake_db, trip_id, messages)
+        # Lanes keep samples of a trip in order, so it was scored incrementally
+        assert not (await fake_db.trip_scores.find_one({"trip_id": trip_id}))["out_of_order"]
+    assert {body["trip_id"]: body["points"] for body in published} == {
+        trip_id: expected_points(messages) for trip_id, messages in trips.items()
+    }
+
+
+async def test_failed_handling_requeues_the_batch(fake_db, published):
+    async def failing_handler(batch):
+        raise RuntimeError("broker down")
+
+    batcher = GpsBatcher(failing_handler, batch_size=3, batch_timeout_ms=1)
+    pool = WorkerPool(batcher.add, workers=3, key=lambda message: message.get("trip_id"), stats_interval=0)
+    pool.start()
+
+    messages = [FakeMessage(message) for message in trip_messages("trip", 3)]
+    for message in messages:
+        await pool.submit(message)
+    await pool.stop()
+
+    assert [message.settled for message in messages] == ["requeue"] * 3
+
+
+async def test_redelivered_batch_is_stored_once(fake_db, published):
+    failures = {"left": 1}
+
+    async def handler(batch):
+        if failures["left"]:
+            failures["left"] -= 1
+            raise RuntimeError("broker down")
+        await app.batch_handler(batch, None)
+
+    messages = trip_messages("trip", 10)
+    batcher = GpsBatcher(handler, batch_size=5, batch_timeout_ms=1)
+
+    # The first batch is stored, fails to be handled and is redelivered
+    # with the rest of the trip
+    results = await asyncio.gather(*(batcher.add(message) for message in messages[:5]), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    await asyncio.gather(*(batcher.add(message) for message in messages))
+
+    await assert_buckets(fake_db, "trip", messages)
+    assert [body["points"] for body in published] == [expected_points(messages)]
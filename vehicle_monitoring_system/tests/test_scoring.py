@@ -0,0 +1,91 @@
+import random
+import pytest
+import app
+from gps_storage import append_samples, load_trip_samples
+from scoring import distance
+
+pytestmark = pytest.mark.anyio
+
+
+def baseline_kilometres(trip_data):
+    # Batch calculation as it was before incremental scoring
+    speed_boundaries_kilometeres = {
+        "60-80": 0.0,  # 1 point per km
+        "80-100": 0.0,  # 2 points per km
+        "100+": 0.0  # 5 points per km
+    }
+
+    for i in range(0, len(trip_data)-1):
+        starting_speed_interval = trip_data[i]["speed"]
+        ending_speed_interval = trip_data[i+1]["speed"]
+
+        avg_speed = int((starting_speed_interval+ending_speed_interval) / 2)
+
+        if avg_speed < 60:
+            continue
+
+        key = ""
+        if avg_speed >= 60 and avg_speed < 80:
+            key = "60-80"
+        elif avg_speed >= 80 and avg_speed < 100:
+            key = "80-100"
+        else:
+            key = "100+"
+
+        speed_boundaries_kilometeres[key] += distance(
+            trip_data[i]["current_geo_point"]["lat"],
+            trip_data[i]["current_geo_point"]["long"],
+            trip_data[i+1]["current_geo_point"]["lat"],
+            trip_data[i+1]["current_geo_point"]["long"]
+        )
+
+    return speed_boundaries_kilometeres
+
+
+def baseline_points(trip_data):
+    speed_boundaries_kilometeres = baseline_kilometres(trip_data)
+    return int(speed_boundaries_kilometeres["60-80"]) + \
+        int(speed_boundaries_kilometeres["80-100"])*2 + \
+        int(speed_boundaries_kilometeres["100+"])*5
+
+
+def random_trip(trip_id, samples, seed):
+    # Speeds around the band boundaries, whole and fractional
+    rng = random.Random(seed)
+    lat, long = 43.85, 18.38
+    messages = []
+    for index in range(samples):
+        lat += rng.uniform(-0.002, 0.004)
+        long += rng.uniform(-0.002, 0.004)
+        speed = rng.choice([rng.randint(0, 140), rng.choice([59, 60, 79, 80, 99, 100]) + rng.choice([0, 0.5, 1])])
+        messages.append({
+            "trip_id": trip_id,
+            "driver_id": f"driver-{trip_id}",
+            "vehicle_id": f"vehicle-{trip_id}",
+            "current_geo_point": {"lat": lat, "long": long},
+            "speed": speed,
+            "timestamp": 1650000000 + index * 5
+        })
+    messages[-1]["trip_finished"] = True
+    return messages
+
+
+async def test_batch_and_incremental_scores_match_baseline(fake_db, published):
+    trips = {f"trip-{seed}": random_trip(f"trip-{seed}", 400, seed) for seed in range(10)}
+
+    for messages in trips.values():
+        for start in range(0, len(messages), 37):
+            batch = messages[start:start + 37]
+            await append_samples(batch)
+            await app.batch_handler(batch, None)
+
+    points = {body["trip_id"]: body for body in published}
+    for trip_id, messages in trips.items():
+        expected = baseline_kilometres(await load_trip_samples(trip_id))
+        kilometres = await app.calculate_kilometres_from_gps_data({"trip_id": trip_id})
+
+        # Same floats in every band that earns points, slow kilometres are only added
+        assert {band: kilometres[band] for band in expected} == expected
+        assert {band: points[trip_id]["kilometres"][band] for band in expected} == expected
+        assert await app.calculate_points_from_gps_data({"trip_id": trip_id}) == baseline_points(messages)
+        assert points[trip_id]["points"] == baseline_points(messages) > 0
@@ -0,0 +1,318 @@
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import logging
+import argparse
+import aio_pika
+from dotenv import load_dotenv
+from codec import decode_message, encode_message
+from consumer_runtime import declare_gps_data_exchange, declare_queue, partition_queue_name
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Record GPS data into a trace file and replay it, so benchmarks of the
+# VMS run on the same input every time.
+#
+# A trace is gzipped NDJSON. The first line is a header, every other line
+# is {"t": seconds since the first message, "m": message}.
+#
+#   python traces.py record --output trace.ndjson.gz --duration 60
+#   python traces.py replay trace.ndjson.gz --in-process
+#   python traces.py replay trace.ndjson.gz --speed 10 --collect-points
+
+TRACE_FORMAT = "gps-trace"
+TRACE_VERSION = 1
+
+
+def write_trace(path, messages):
+    # messages are (offset seconds, message) pairs
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as trace:
+        trace.write(json.dumps({"format": TRACE_FORMAT, "version": TRACE_VERSION, "recorded_at": time.time()}) + "\n")
+        for offset, message in messages:
+            trace.write(json.dumps({"t": round(offset, 6), "m": message}, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+def read_trace(path):
+    with gzip.open(path, "rt", encoding="utf-8") as trace:
+        header = json.loads(trace.readline())
+        if header.get("format") != TRACE_FORMAT or header.get("version") != TRACE_VERSION:
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} GPS trace")
+        return [(line["t"], line["m"]) for line in map(json.loads, trace) if line]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def latency_summary(seconds):
+    return {
+        name: round(value * 1000, 3) if value is not None else None
+        for name, value in (
+            ("p50_ms", percentile(seconds, 0.5)),
+            ("p95_ms", percentile(seconds, 0.95)),
+            ("p99_ms", percentile(seconds, 0.99)),
+            ("max_ms", max(seconds) if seconds else None)
+        )
+    }
+
+
+def driver_points(points_messages):
+    totals = {}
+    for message in points_messages:
+        totals[message["driver_id"]] = totals.get(message["driver_id"], 0) + message["points"]
+    return dict(sorted(totals.items()))
+
+
+async def record(arguments):
+    # Gets its own copy of everything published to the GPS data exchange,
+    # the VMS keeps consuming its partitions as usual
+    connection = await aio_pika.connect_robust(host=os.environ.get('RABBITMQ_HOST'), port=5672)
+    messages = []
+
+    async with connection:
+        channel = await connection.channel()
+        exchange = await declare_gps_data_exchange(channel)
+        queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+        await queue.bind(exchange, routing_key="#")
+
+        loop = asyncio.get_running_loop()
+        started, first = loop.time(), None
+        logger.info("Recording GPS data, stops after %s s or %s messages", arguments.duration, arguments.max_messages)
+
+        async with queue.iterator(no_ack=True) as queue_iter:
+            while loop.time() - started < arguments.duration and len(messages) < arguments.max_messages:
+                try:
+                    message = await asyncio.wait_for(queue_iter.__anext__(), arguments.duration - (loop.time() - started))
+                except asyncio.TimeoutError:
+                    break
+                now = loop.time()
+                first = first if first is not None else now
+                messages.append((now - first, decode_message(message.body, message.content_type)))
+
+    count = write_trace(arguments.output, messages)
+    print(f"recorded {count} messages to {arguments.output}")
+
+
+class CapturingChannel:
+    # Stands in for the channel points are published on
+    def __init__(self):
+        self.default_exchange = self
+        self.points = []
+
+    async def publish(self, message, routing_key):
+        self.points.append(decode_message(message.body, message.content_type))
+
+
+async def replay_in_process(arguments, trace):
+    # Messages are handled one by one in trace order by the consumer handler,
+    # against an in-memory Mongo, so the result only depends on the trace
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("In-process replay needs mongomock-motor, pip install mongomock-motor")
+
+    import app
+    import scoring
+    import gps_storage
+    import compression
+    from mongo_documents import MongoDocumentsEnum
+
+    fake_db = AsyncMongoMockClient().vehicle_monitoring_system
+    gps_storage.db = fake_db
+    scoring.db = fake_db
+    app.trip_scorer = scoring.TripScorer()
+    if arguments.compression_tolerance is not None:
+        app.trajectory_compressor = compression.TrajectoryCompressor(arguments.compression_tolerance)
+    elif compression.TRAJECTORY_COMPRESSION:
+        app.trajectory_compressor = compression.TrajectoryCompressor()
+
+    channel = CapturingChannel()
+    latencies, finished = [], []
+
+    started = time.perf_counter()
+    for _, message in trace:
+        handled = time.perf_counter()
+        await app.consumer_handler(message, channel)
+        latencies.append(time.perf_counter() - handled)
+        if message.get("trip_finished", False):
+            finished.append(message)
+    elapsed = time.perf_counter() - started
+
+    # Incremental scoring has to award what the batch calculation would,
+    # with compression it only has the samples that were kept
+    mismatches = []
+    awarded = {points["trip_id"]: points["points"] for points in channel.points}
+    for message in finished:
+        expected = await app.calculate_points_from_gps_data(message)
+        if awarded.get(message["trip_id"]) != expected:
+            mismatches.append({"trip_id": message["trip_id"], "awarded": awarded.get(message["trip_id"]), "batch": expected})
+
+    stored_samples = 0
+    async for bucket in fake_db[MongoDocumentsEnum.GPS_DATA.value].find({}, {"trip_data": 1}):
+        stored_samples += len(bucket["trip_data"])
+    trip_ratios = [
+        trip_score["compression"]["ratio"]
+        async for trip_score in fake_db[MongoDocumentsEnum.TRIP_SCORES.value].find({"compression.ratio": {"$ne": None}})
+    ]
+
+    return {
+        "mode": "in-process",
+        "messages": len(trace),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(len(trace) / elapsed, 1) if elapsed else None,
+        "latency": latency_summary(latencies),
+        "trips_finished": len(finished),
+        "scoring_mismatches": mismatches,
+        "stored_samples": stored_samples,
+        "compression": {
+            "ratio": round(len(trace) / stored_samples, 2) if stored_samples else None,
+            "trips": len(trip_ratios),
+            "trip_ratio_min": min(trip_ratios, default=None),
+            "trip_ratio_p50": percentile(trip_ratios, 0.5),
+            "trip_ratio_max": max(trip_ratios, default=None)
+        },
+        "driver_points": driver_points(channel.points)
+    }
+
+
+async def replay_amqp(arguments, trace):
+    # Publishes the trace the way the simulator does. With speed 0 messages
+    # go out as fast as possible, otherwise at speed times the recorded pace
+    connection = await aio_pika.connect_robust(host=os.environ.get('RABBITMQ_HOST'), port=5672)
+    queue_name = os.environ.get("RECEIVE_GPS_DATA_QUEUE")
+
+    async with connection:
+        channel = await connection.channel()
+        exchange = await declare_gps_data_exchange(channel)
+
+        points, points_received_at = [], {}
+        trips_finished = sum(1 for _, message in trace if message.get("trip_finished", False))
+        all_points = asyncio.Event()
+        if trips_finished == 0:
+            all_points.set()
+
+        if arguments.collect_points:
+            # Competes with the fleet management service for points messages,
+            # meant for runs without it
+            points_queue = await declare_queue(channel, os.environ.get("SEND_POINTS_QUEUE"))
+
+            async def collect(message):
+                body = decode_message(message.body, message.content_type)
+                points.append(body)
+                points_received_at[body["trip_id"]] = time.perf_counter()
+                if len(points) >= trips_finished:
+                    all_points.set()
+
+            await points_queue.consume(collect, no_ack=True)
+
+        published_at = {}
+        loop = asyncio.get_running_loop()
+        started, perf_started = loop.time(), time.perf_counter()
+        for offset, message in trace:
+            if arguments.speed > 0 and (delay := offset / arguments.speed - (loop.time() - started)) > 0:
+                await asyncio.sleep(delay)
+
+            await exchange.publish(
+                aio_pika.Message(**encode_message(message), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                routing_key=partition_queue_name(queue_name, message.get("trip_id", None))
+            )
+            if message.get("trip_finished", False):
+                published_at[message["trip_id"]] = time.perf_counter()
+        publish_seconds = time.perf_counter() - perf_started
+
+        result = {
+            "mode": "amqp",
+            "speed": arguments.speed,
+            "messages": len(trace),
+            "publish_seconds": round(publish_seconds, 3),
+            "messages_per_second": round(len(trace) / publish_seconds, 1) if publish_seconds else None,
+            "trips_finished": trips_finished
+        }
+
+        if arguments.collect_points:
+            try:
+                await asyncio.wait_for(all_points.wait(), arguments.timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Got points of %d out of %d trips in %s s", len(points), trips_finished, arguments.timeout)
+
+            # Latency of a trip is from publishing its last message to its points
+            result.update({
+                "seconds_to_points": round(time.perf_counter() - perf_started, 3),
+                "trip_latency": latency_summary([
+                    points_received_at[trip_id] - published
+                    for trip_id, published in published_at.items() if trip_id in points_received_at
+                ]),
+                "trips_scored": len(points),
+                "driver_points": driver_points(points)
+            })
+
+        return result
+
+
+async def replay(arguments):
+    trace = read_trace(arguments.trace)
+    if arguments.in_process:
+        result = await replay_in_process(arguments, trace)
+    else:
+        result = await replay_amqp(arguments, trace)
+
+    print(json.dumps(result, indent=2))
+    if arguments.output:
+        with open(arguments.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    failed = bool(result.get("scoring_mismatches"))
+    if arguments.expect_points:
+        with open(arguments.expect_points) as expected:
+            expected_points = json.load(expected)
+        expected_points = expected_points.get("driver_points", expected_points)
+        if expected_points != result.get("driver_points"):
+            logger.error("Driver points differ from %s", arguments.expect_points)
+            failed = True
+
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record and replay GPS data traces")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="Record GPS data published to the exchange")
+    record_parser.add_argument("--output", required=True)
+    record_parser.add_argument("--duration", type=float, default=60, help="Seconds")
+    record_parser.add_argument("--max-messages", type=int, default=10 ** 7)
+
+    replay_parser = commands.add_parser("replay", help="Replay a trace")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--in-process", action="store_true", help="Call consumer_handler directly against an in-memory Mongo")
+    replay_parser.add_argument("--speed", type=float, default=1, help="1 is the recorded pace, 0 is as fast as possible")
+    replay_parser.add_argument("--collect-points", action="store_true", help="Consume points messages and report per driver points")
+    replay_parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for points")
+    replay_parser.add_argument("--output", help="Write the result as JSON")
+    replay_parser.add_argument("--expect-points", help="Result JSON of an earlier replay, fails when driver points differ")
+    replay_parser.add_argument(
+        "--compression-tolerance", type=float,
+        help="In-process only, compress trajectories with this tolerance in metres, as TRAJECTORY_COMPRESSION otherwise"
+    )
+
+    arguments = parser.parse_args(argv)
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+    if arguments.command == "record":
+        asyncio.run(record(arguments))
+        return 0
+    return asyncio.run(replay(arguments))
+
+
+if __name__ == "__main__":
+    sys.exit(main())